@@ -4,5 +4,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# sync views run in threads of a pool under ASGI and a persistent connection is kept per thread, which are not reused
+# as under WSGI, so connections would pile up; close them after every request unless DB_CONN_MAX_AGE is set
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
@@ -0,0 +1,57 @@
+"""
+Cache settings chosen by environment variables.
+
+CACHE_PROFILE=file (default) keeps caches in files under CACHE_DIR (.cache next to manage.py), so they are shared by
+all processes of one host, like workers of uvicorn. CACHE_PROFILE=redis uses REDIS_URL and is shared by hosts too
+(needs the redis package). CACHE_PROFILE=local keeps them in memory of each process, only for a single process.
+
+'default' holds cached responses, version counters of cached lists and of the availability index and throttling
+buckets, up to CACHE_MAX_ENTRIES of them. 'tokens' holds copies of CustomUser.tokens_valid_after checked by
+authentication of every request. It is apart from responses, so their eviction never drops a revocation, its entries
+do not expire and are culled only beyond TOKEN_CACHE_MAX_ENTRIES (with Redis put it into REDIS_TOKENS_URL, a database
+without eviction). A culled entry is read from the database again.
+"""
+from .database import env_int
+
+PROFILES = ('file', 'redis', 'local')
+
+BACKENDS = {
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'local': 'django.core.cache.backends.locmem.LocMemCache',
+}
+
+
+def cache_settings(environ, base_dir) -> dict:
+    """ Returns 'default' and 'tokens' caches for CACHE_PROFILE"""
+    profile = environ.get('CACHE_PROFILE', 'file')
+    if profile not in PROFILES:
+        raise ValueError(f'CACHE_PROFILE should be one of: {", ".join(PROFILES)}')
+
+    caches = {
+        'default': {
+            'BACKEND': BACKENDS[profile],
+            'OPTIONS': {'MAX_ENTRIES': env_int(environ, 'CACHE_MAX_ENTRIES', 10000)},
+        },
+        'tokens': {
+            'BACKEND': BACKENDS[profile],
+            'TIMEOUT': None,
+            'OPTIONS': {'MAX_ENTRIES': env_int(environ, 'TOKEN_CACHE_MAX_ENTRIES', 1000000)},
+        },
+    }
+    if profile == 'file':
+        cache_dir = environ.get('CACHE_DIR') or base_dir / '.cache'
+        caches['default']['LOCATION'] = f'{cache_dir}/default'
+        caches['tokens']['LOCATION'] = f'{cache_dir}/tokens'
+    elif profile == 'redis':
+        redis_url = environ.get('REDIS_URL', 'redis://localhost:6379/0')
+        caches['default']['LOCATION'] = redis_url
+        caches['tokens']['LOCATION'] = environ.get('REDIS_TOKENS_URL') or redis_url
+        # Redis evicts by its maxmemory policy, MAX_ENTRIES is not used
+        for cache in caches.values():
+            cache['OPTIONS'] = {}
+        caches['tokens']['KEY_PREFIX'] = 'tokens'
+    else:
+        caches['default']['LOCATION'] = 'fitness-default'
+        caches['tokens']['LOCATION'] = 'fitness-tokens'
+    return caches
@@ -0,0 +1,86 @@
+"""
+Database settings chosen by environment variables.
+
+DATABASE_PROFILE=sqlite (default) is for development and single-node deployments: db.sqlite3 next to manage.py with
+pragmas of sqlite_pragmas() applied to every new connection (see fitness/signals.py). WAL lets reads go on while
+a booking is written, busy_timeout makes concurrent writers wait for the lock instead of failing.
+
+DATABASE_PROFILE=postgresql reads POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST and POSTGRES_PORT.
+Connections are kept for DB_CONN_MAX_AGE seconds and checked before reuse, except under ASGI (config/asgi.py), where
+it defaults to 0: each request runs in some thread of a pool there and kept connections would pile up. Django 5.0 has
+no connection pool of its own, so for many workers put PgBouncer in transaction mode in front of PostgreSQL and set
+DB_PGBOUNCER=1, which turns off server-side cursors (PgBouncer can't keep them between transactions, exports are then
+read by chunks of the client).
+"""
+import re
+
+PROFILES = ('sqlite', 'postgresql')
+
+PRAGMA_VALUE = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+def env_int(environ, name, default):
+    value = environ.get(name)
+    return default if value in (None, '') else int(value)
+
+
+def env_bool(environ, name, default=False):
+    value = environ.get(name)
+    return default if value in (None, '') else value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def conn_max_age(environ):
+    """ Seconds a connection is kept, 'none' keeps it forever"""
+    value = environ.get('DB_CONN_MAX_AGE', '')
+    if value.lower() == 'none':
+        return None
+    return env_int(environ, 'DB_CONN_MAX_AGE', 60)
+
+
+def sqlite_pragmas(environ) -> dict:
+    """ Pragmas set on every new SQLite connection"""
+    pragmas = {
+        # first, so switching the journal mode waits for other connections too
+        'busy_timeout': str(env_int(environ, 'SQLITE_BUSY_TIMEOUT', 5000)), # milliseconds
+        'journal_mode': environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+        # with WAL, NORMAL syncs on checkpoints only, a power loss may lose the last transactions but not corrupt the file
+        'synchronous': environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+    }
+    for name, value in pragmas.items():
+        if not PRAGMA_VALUE.match(value):
+            raise ValueError(f'Invalid value of SQLite pragma {name}: {value!r}')
+    return pragmas
+
+
+def database_settings(environ, base_dir) -> dict:
+    """ Returns the default database for DATABASE_PROFILE"""
+    profile = environ.get('DATABASE_PROFILE', 'sqlite')
+    if profile not in PROFILES:
+        raise ValueError(f'DATABASE_PROFILE should be one of: {", ".join(PROFILES)}')
+
+    if profile == 'postgresql':
+        return {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': environ.get('POSTGRES_DB', 'fitness'),
+            'USER': environ.get('POSTGRES_USER', 'fitness'),
+            'PASSWORD': environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': conn_max_age(environ),
+            'CONN_HEALTH_CHECKS': True,
+            'DISABLE_SERVER_SIDE_CURSORS': env_bool(environ, 'DB_PGBOUNCER'),
+            'OPTIONS': {
+                'connect_timeout': env_int(environ, 'POSTGRES_CONNECT_TIMEOUT', 5),
+            },
+        }
+
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': environ.get('SQLITE_PATH') or base_dir / 'db.sqlite3',
+        'CONN_MAX_AGE': conn_max_age(environ),
+        'CONN_HEALTH_CHECKS': True,
+        # file based test database, in-memory SQLite can not be shared between threads of concurrency tests
+        'TEST': {
+            'NAME': base_dir / 'test_db.sqlite3',
+        },
+    }
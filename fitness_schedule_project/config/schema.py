@@ -0,0 +1,119 @@
+"""
+OpenAPI schema of the API is generated once and then served from memory.
+
+Generation introspects every viewset and serializer, so it is done by the `generate_schema` management command on
+deploy, which writes the schema to OPENAPI_SCHEMA_PATH. A process reads that file on the first request for the schema;
+if it is missing (local development), the schema is generated in the process once. Responses carry an ETag,
+so polling clients get 304 Not Modified until the next deploy.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson, yaml_sane_dump
+from drf_yasg.generators import OpenAPISchemaGenerator
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+API_INFO = openapi.Info(
+   title="Swagger of Fitness API",
+   default_version='v1',
+   description="Swagger of Fitness API v1",
+   terms_of_service="https://www.google.com/policies/terms/",
+   contact=openapi.Contact(email="contact@snippets.local"),
+   license=openapi.License(name="BSD License"),
+)
+
+
+def generate_schema():
+    """ Generates public schema of the whole API and returns it as JSON bytes"""
+    generator = OpenAPISchemaGenerator(API_INFO)
+    return OpenAPICodecJson(validators=[]).encode(generator.get_schema(request=None, public=True))
+
+
+def write_schema(path=None):
+    """ Generates the schema and writes it to the file which is served by the schema views"""
+    path = path or settings.OPENAPI_SCHEMA_PATH
+    content = generate_schema()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as schema_file:
+        schema_file.write(content)
+    return content
+
+
+class SchemaDocument:
+    """ Schema in JSON and YAML with their ETags, loaded once per process"""
+
+    def __init__(self, json_content):
+        self.json = json_content
+        self.etag = '"{}"'.format(hashlib.sha1(json_content).hexdigest())
+        self.yaml_etag = '"{}-yaml"'.format(self.etag.strip('"'))
+
+    def content(self, media_type):
+        if 'yaml' in media_type:
+            return self.yaml, self.yaml_etag
+        return self.json, self.etag
+
+    @property
+    def yaml(self):
+        if not hasattr(self, '_yaml'):
+            self._yaml = yaml_sane_dump(json.loads(self.json, object_pairs_hook=OrderedDict), binary=True)
+        return self._yaml
+
+
+_document = None
+_document_lock = threading.Lock()
+
+
+def get_schema_document():
+    global _document
+    if _document is None:
+        with _document_lock:
+            if _document is None:
+                try:
+                    with open(settings.OPENAPI_SCHEMA_PATH, 'rb') as schema_file:
+                        content = schema_file.read()
+                except FileNotFoundError:
+                    content = generate_schema()
+                _document = SchemaDocument(content)
+    return _document
+
+
+def reset_schema_document():
+    """ Forgets the loaded schema, the next request reads it again"""
+    global _document
+    _document = None
+
+
+BaseSchemaView = get_schema_view(
+   API_INFO,
+   public=True,
+   permission_classes=(permissions.AllowAny,),
+)
+
+
+class SchemaView(BaseSchemaView):
+    """ Serves pre-generated schema instead of generating it on each request
+
+    Swagger UI and ReDoc pages are rendered by drf-yasg as before, they do not introspect the API.
+    """
+
+    def get(self, request, version='', format=None):
+        renderer = request.accepted_renderer
+        if renderer.format not in ('openapi', '.json', '.yaml'):
+            return super().get(request, version, format)
+
+        content, etag = get_schema_document().content(renderer.media_type)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type=renderer.media_type)
+        response['ETag'] = etag
+        # clients have to revalidate, the schema changes only on deploy
+        patch_cache_control(response, no_cache=True)
+        return response
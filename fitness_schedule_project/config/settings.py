@@ -2,6 +2,9 @@ import os
 from pathlib import Path
 from datetime import timedelta
 
+from .caches import cache_settings
+from .database import database_settings, env_bool, env_int, sqlite_pragmas
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 SECRET_KEY = 'django-insecure-(nyobi(3lsm1!8aa&(x0-7)5^b=^=c*79fb8$gim45!6ggy06p'
@@ -28,6 +31,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'fitness.instrumentation.InstrumentationMiddleware',
+    'fitness.throttling.LoadSheddingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,13 +63,21 @@ TEMPLATES = [
 WSGI_APPLICATION = 'config.wsgi.application'
 
 
+# DATABASE_PROFILE=sqlite|postgresql and other variables, see config/database.py
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': database_settings(os.environ, BASE_DIR),
 }
 
+if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    # trigram lookups of the trainer search, the app needs psycopg
+    INSTALLED_APPS.append('django.contrib.postgres')
+
+# applied on connect to SQLite databases
+SQLITE_PRAGMAS = sqlite_pragmas(os.environ)
+
+# CACHE_PROFILE=file|redis|local and other variables, see config/caches.py
+CACHES = cache_settings(os.environ, BASE_DIR)
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -92,19 +105,29 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATIC_URL = 'static/'
 
+# written by `manage.py generate_schema` on deploy and served by the swagger views
+OPENAPI_SCHEMA_PATH = os.path.join(STATIC_ROOT, 'openapi.json')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'fitness.CustomUser'
 
 REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': (
+        'fitness.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'fitness.authentication.StatelessJWTAuthentication',
     ),
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
+    # reverse proxies in front of the app adding X-Forwarded-For, 0 keys rate limits on REMOTE_ADDR; unset (None) would
+    # trust the whole header, which clients can forge
+    'NUM_PROXIES': env_int(os.environ, 'NUM_PROXIES', 0),
 }
 
 SIMPLE_JWT = {
@@ -125,6 +148,8 @@ SIMPLE_JWT = {
 
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
+    'TOKEN_USER_CLASS': 'fitness.authentication.FitnessTokenUser',
+    'TOKEN_OBTAIN_SERIALIZER': 'fitness.authentication.FitnessTokenObtainPairSerializer',
 
     'JTI_CLAIM': 'jti',
 
@@ -133,6 +158,79 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
+# seconds for which token revocation times are kept in memory of the process, other processes see a revocation after it
+TOKEN_REVOCATION_LOCAL_TTL = 5
+
+# Server-Timing header with time of queries, serializers and the whole request
+SERVER_TIMING_HEADER = True
+
+# addresses allowed to read /metrics (comma separated in METRICS_ALLOWED_IPS), local only by default,
+# '*' exposes metrics to any address
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1')
+METRICS_ALLOWED_IPS = None if METRICS_ALLOWED_IPS == '*' else [ip.strip() for ip in METRICS_ALLOWED_IPS.split(',') if ip.strip()]
+
+# most queries a request of the view may make, more are logged as warnings and counted in /metrics
+QUERY_BUDGETS = {
+    'schedule-list': 2,
+    'schedule-detail': 1,
+    'schedule-get-own-schedule': 1,
+    'schedule-availability': 2,
+    'schedule-calendar': 1,
+    'schedule-analytics': 5,
+    'schedule-export': 1,
+    'schedule-create-schedule': 6,
+    'schedule-create-schedules': 9,
+    'schedule-add-this-schedule': 12, # a dated booking may create its occurrence
+    'schedule-add-schedules': 10,
+    'booking-list': 2, # ?page= counts rows
+    'booking-get-own-bookings': 2, # tokens issued before the role claim load the user
+    'booking-calendar': 2,
+    'booking-export': 1,
+    'customuser-list': 2,
+    'customuser-detail': 1,
+    'customuser-register': 4,
+    'customuser-import-users': 4, # existing emails, then one INSERT in a savepoint
+    'customuser-trainers': 2, # trainers, then their gyms
+    'async-schedule-list': 2,
+    'async-schedule-detail': 1,
+    'async-schedule-get-own-schedule': 1,
+    'async-schedule-availability': 2,
+    'async-booking-get-own-bookings': 1,
+    'async-events': 0,
+}
+
+# seconds for which schedule list and retrieve responses are cached, changes of schedules invalidate them earlier
+SCHEDULE_CACHE_TIMEOUT = 300
+
+# days ahead for which dated occurrences of schedules are kept, see the materialize_occurrences command
+OCCURRENCE_HORIZON_DAYS = 28
+
+# change events of schedules and bookings streamed at /api/async/events/, see fitness/events.py
+EVENT_BROKER = 'fitness.events.LocalBroker'
+EVENT_STREAM_QUEUE_SIZE = 100 # events kept for a slow client, older ones are dropped and the client is told to reload
+EVENT_STREAM_HEARTBEAT = 15 # seconds between keepalive comments of an idle stream
+EVENT_STREAM_RETRY_MS = 3000 # reconnection delay sent to clients
+EVENT_STREAM_MAX_CONNECTIONS = 20000 # streams of one process
+
+# token bucket rate limits, 'number/period' allows bursts of number requests, see fitness/throttling.py
+THROTTLE_BACKEND = 'fitness.throttling.LocalBuckets' # or CacheBuckets to share limits through the default cache
+# THROTTLE_ENABLED=0 turns the limits off, like for stress_booking --url
+THROTTLE_RATES = {} if not env_bool(os.environ, 'THROTTLE_ENABLED', True) else {
+    'booking': '30/min', # per user
+    'booking-ip': '120/min', # per address, clients of a gym may share one
+    'register': '10/min', # per address
+    'token': '20/min', # per address
+}
+# views whose POST requests are rejected before authentication when their scope's bucket of the client address is empty
+THROTTLED_VIEWS = {
+    'customuser-register': 'register',
+    'token_obtain_pair': 'token',
+    'schedule-add-this-schedule': 'booking-ip',
+    'schedule-add-schedules': 'booking-ip',
+}
+# requests of THROTTLED_VIEWS handled at once by a process (bookings wait for the lock of their schedule), more are rejected with 503, None for no limit
+LOAD_SHEDDING_MAX_IN_FLIGHT = 32
+
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH': False,
     'SECURITY_DEFINITIONS': {
@@ -1,34 +1,31 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include, re_path
+from django.views.static import serve
 
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
-from rest_framework import permissions
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Swagger of Fitness API",
-      default_version='v1',
-      description="Swagger of Fitness API v1",
-      terms_of_service="https://www.google.com/policies/terms/",
-      contact=openapi.Contact(email="contact@snippets.local"),
-      license=openapi.License(name="BSD License"),
-   ),
-   public=True,
-   permission_classes=(permissions.AllowAny,),
-)
+from fitness.instrumentation import metrics_view
+
+from .schema import SchemaView
+
+
+def static_file(request, path):
+    # uvicorn serves no files, assets of admin and Swagger are served from STATIC_ROOT filled by collectstatic
+    return serve(request, path, document_root=settings.STATIC_ROOT)
+
 
 urlpatterns = [
-    path('swagger<format>/', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('swagger<format>/', SchemaView.without_ui(cache_timeout=0), name='schema-json'),
+    path('swagger/', SchemaView.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('redoc/', SchemaView.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/', include('fitness.urls')),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    re_path(rf'^{settings.STATIC_URL.strip("/")}/(?P<path>.*)$', static_file, name='static'),
 ]
\ No newline at end of file
@@ -1,7 +1,39 @@
 from django.contrib import admin
-from .models import CustomUser, Gym, Schedule, Booking
+from .models import CustomUser, Gym, Schedule, ScheduleOccurrence, ScheduleHourSummary, TrainerGym, Booking
 
 admin.site.register(CustomUser)
 admin.site.register(Gym)
-admin.site.register(Schedule)
-admin.site.register(Booking)
+
+
+@admin.register(Schedule)
+class ScheduleAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'capacity')
+    list_select_related = ('trainer', 'gym')
+
+
+@admin.register(ScheduleOccurrence)
+class ScheduleOccurrenceAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'trainer', 'gym', 'date', 'start_time', 'end_time')
+    list_select_related = ('trainer', 'gym')
+    list_filter = ('gym',)
+    date_hierarchy = 'date'
+
+
+@admin.register(Booking)
+class BookingAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'client', 'schedule', 'start_time', 'end_time')
+    list_select_related = ('client', 'schedule__trainer', 'schedule__gym')
+
+
+@admin.register(ScheduleHourSummary)
+class ScheduleHourSummaryAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'trainer', 'gym', 'capacity_minutes', 'booked_minutes', 'bookings')
+    list_select_related = ('trainer', 'gym')
+    list_filter = ('gym', 'weekday')
+
+
+@admin.register(TrainerGym)
+class TrainerGymAdmin(admin.ModelAdmin):
+    list_display = ('trainer', 'gym')
+    list_select_related = ('trainer', 'gym')
+    list_filter = ('gym',)
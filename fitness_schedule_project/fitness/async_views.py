@@ -0,0 +1,148 @@
+"""
+Async versions of the hot read endpoints, served under /api/async/.
+
+They return the same data as the viewsets, but the database is queried with async ORM and the token is checked without
+the database, so under ASGI (see config/asgi.py) a worker is not held by a slow client. Only GET requests with
+JWT authentication are accepted.
+
+/api/async/events/ streams changes of schedules and bookings (see events.py), so clients don't need to poll the list.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+
+from . import events
+from .authentication import StatelessJWTAuthentication
+from .availability import availability_index
+from .fast_serializers import ScheduleValuesSerializer, BookingValuesSerializer
+from .filters import ScheduleFilter
+from .pagination import ScheduleCursorPagination
+from .renderers import FastJSONRenderer
+from .models import WEEKDAYS
+from .serializers import AvailabilityQuerySerializer, EventStreamQuerySerializer
+from .views import ExpandMixin, ScheduleViewSet, BookingViewSet
+
+
+def json_response(data, status=status.HTTP_200_OK, headers=None):
+    return HttpResponse(FastJSONRenderer().render(data), status=status, content_type='application/json', headers=headers)
+
+
+def async_api_view(view):
+    """ Authenticates the request by JWT and turns API errors into responses the same way as DRF views do"""
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        authentication = StatelessJWTAuthentication()
+        request = Request(request)
+        try:
+            if request.method != 'GET':
+                raise exceptions.MethodNotAllowed(request.method)
+
+            user_auth = await authentication.aauthenticate(request)
+            if user_auth is None:
+                raise exceptions.NotAuthenticated()
+            request.user, request.auth = user_auth
+
+            return await view(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            headers = None
+            if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+                headers = {'WWW-Authenticate': authentication.authenticate_header(request)}
+            data = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return json_response(data, status=exc.status_code, headers=headers)
+
+    return wrapper
+
+
+def expand_context(request, expand_related):
+    expand = ExpandMixin.parse_expand(request.query_params, expand_related)
+    return expand, {'request': request, 'expand': expand}
+
+
+@async_api_view
+async def schedule_list(request):
+    """ Same as GET /api/schedules/"""
+    expand, context = expand_context(request, ScheduleViewSet.expand_related)
+    queryset = ExpandMixin.select_expanded(ScheduleViewSet.queryset.all(), expand, ScheduleViewSet.expand_related)
+
+    # trainer and gym filters check that the object exists
+    filterset = ScheduleFilter(request.query_params, queryset=queryset, request=request)
+    if not await sync_to_async(filterset.is_valid)():
+        raise exceptions.ValidationError(filterset.errors)
+
+    paginator = ScheduleCursorPagination()
+    rows = ScheduleValuesSerializer.values(filterset.qs, expand, extra=paginator.ordering)
+    page = await paginator.apaginate_queryset(rows, request)
+    serializer = ScheduleValuesSerializer(page, many=True, context=context)
+    return json_response(paginator.get_paginated_response(serializer.data).data)
+
+
+@async_api_view
+async def schedule_detail(request, pk):
+    """ Same as GET /api/schedules/<pk>/"""
+    expand, context = expand_context(request, ScheduleViewSet.expand_related)
+    queryset = ExpandMixin.select_expanded(ScheduleViewSet.queryset.all(), expand, ScheduleViewSet.expand_related)
+
+    schedule = await ScheduleValuesSerializer.values(queryset.filter(pk=pk), expand).afirst()
+    if schedule is None:
+        raise exceptions.NotFound(_('No Schedule matches the given query.'))
+    return json_response(ScheduleValuesSerializer(schedule, context=context).data)
+
+
+@async_api_view
+async def get_own_schedule(request):
+    """ Same as GET /api/schedules/get_own_schedule/"""
+    if not request.user.role == "trainer":
+        return json_response({'error': 'This method is only for trainers'}, status=status.HTTP_403_FORBIDDEN)
+
+    expand, context = expand_context(request, ScheduleViewSet.expand_related)
+    queryset = ExpandMixin.select_expanded(ScheduleViewSet.queryset.filter(trainer_id=request.user.pk), expand, ScheduleViewSet.expand_related)
+    schedules = [schedule async for schedule in ScheduleValuesSerializer.values(queryset, expand)]
+    return json_response(ScheduleValuesSerializer(schedules, many=True, context=context).data)
+
+
+@async_api_view
+async def availability(request):
+    """ Same as GET /api/schedules/availability/"""
+    serializer = AvailabilityQuerySerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return json_response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    data = serializer.validated_data
+    slots = await availability_index.afree_slots(data['gym'], data['day_of_week'], data['start_time'], data['end_time'])
+    return json_response([ScheduleViewSet.free_slot_data(slot) for slot in slots])
+
+
+@async_api_view
+async def get_own_bookings(request):
+    """ Same as GET /api/bookings/get_own_bookings/"""
+    if not request.user.role == "client":
+        return json_response({'error': 'Only clients have permissions to watch booking'}, status=status.HTTP_403_FORBIDDEN)
+
+    expand, context = expand_context(request, BookingViewSet.expand_related)
+    queryset = ExpandMixin.select_expanded(BookingViewSet.queryset.filter(client_id=request.user.pk), expand, BookingViewSet.expand_related)
+    bookings = [booking async for booking in BookingValuesSerializer.values(queryset, expand)]
+    return json_response(BookingValuesSerializer(bookings, many=True, context=context).data)
+
+
+@async_api_view
+async def event_stream(request):
+    """ Server-Sent Events of created, changed and deleted schedules and bookings of a gym, a trainer or a day if they are given"""
+    serializer = EventStreamQuerySerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return json_response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    if events.broker.stats()['streams'] >= settings.EVENT_STREAM_MAX_CONNECTIONS:
+        return json_response({'error': 'Too many event streams, try again later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                             headers={'Retry-After': str(settings.EVENT_STREAM_RETRY_MS // 1000)})
+
+    data = serializer.validated_data
+    weekday = WEEKDAYS.index(data['day_of_week']) if 'day_of_week' in data else None
+    response = StreamingHttpResponse(events.stream(data.get('gym'), data.get('trainer'), weekday), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # nginx must not buffer the stream
+    return response
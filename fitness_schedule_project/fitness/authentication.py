@@ -0,0 +1,175 @@
+"""
+Stateless JWT authentication: user id, role and active flag are read from token claims instead of the database.
+
+Tokens are revoked by time: when role, active flag or password of a user is changed, CustomUser.tokens_valid_after is
+set and tokens issued before it are not accepted anymore. The time is read from the database once and then kept in the
+'tokens' cache (shared by processes, see config/caches.py) and for a few seconds in memory of the process. Revocation
+deletes both copies, other processes see it when their copy in memory expires.
+"""
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+
+AUTH_TIME_CLAIM = 'auth_time'
+
+TOKENS_CACHE = 'tokens'
+
+VALID_AFTER_CACHE_KEY = 'fitness:tokens-valid-after:{}'
+
+
+class TTLCache:
+    """ Small in-memory cache, values live for ttl seconds, the oldest values are dropped if it is full"""
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        value = self.values.get(key)
+        if value is None or value[1] < time.monotonic():
+            return default
+        return value[0]
+
+    def set(self, key, value):
+        with self.lock:
+            if len(self.values) >= self.max_size:
+                for old_key in list(self.values)[:self.max_size // 10 or 1]:
+                    del self.values[old_key]
+            self.values.pop(key, None)
+            self.values[key] = (value, time.monotonic() + self.ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+valid_after_times = TTLCache(ttl=getattr(settings, 'TOKEN_REVOCATION_LOCAL_TTL', 5))
+
+
+def valid_after_in_database(user_id) -> float:
+    """ Timestamp after which tokens of the user are accepted, tokens of deleted users are never accepted"""
+    values = list(get_user_model().objects.filter(pk=user_id).values_list('tokens_valid_after', flat=True)[:1])
+    if not values:
+        return math.inf
+    return values[0].timestamp() if values[0] else 0
+
+
+def revoke_tokens(user_id):
+    """ Drops copies of the time after which tokens of the user are accepted, the next request reads it from the database"""
+    caches[TOKENS_CACHE].delete(VALID_AFTER_CACHE_KEY.format(user_id))
+    valid_after_times.delete(str(user_id))
+
+
+def remember_tokens_valid_after(user):
+    """ Copies the time of a user loaded from the database to the cache, unless a revocation has put a newer one"""
+    valid_after = user.tokens_valid_after.timestamp() if user.tokens_valid_after else 0
+    caches[TOKENS_CACHE].add(VALID_AFTER_CACHE_KEY.format(user.pk), valid_after)
+
+
+def tokens_valid_after(user_id) -> float:
+    user_id = str(user_id)
+    valid_after = valid_after_times.get(user_id)
+    if valid_after is None:
+        key = VALID_AFTER_CACHE_KEY.format(user_id)
+        valid_after = caches[TOKENS_CACHE].get(key)
+        if valid_after is None:
+            valid_after = valid_after_in_database(user_id)
+            # add() does not overwrite a time put by a concurrent revocation
+            caches[TOKENS_CACHE].add(key, valid_after)
+        valid_after_times.set(user_id, valid_after)
+    return valid_after
+
+
+async def atokens_valid_after(user_id) -> float:
+    user_id = str(user_id)
+    valid_after = valid_after_times.get(user_id)
+    if valid_after is None:
+        key = VALID_AFTER_CACHE_KEY.format(user_id)
+        valid_after = await caches[TOKENS_CACHE].aget(key)
+        if valid_after is None:
+            valid_after = await sync_to_async(valid_after_in_database)(user_id)
+            await caches[TOKENS_CACHE].aadd(key, valid_after)
+        valid_after_times.set(user_id, valid_after)
+    return valid_after
+
+
+class FitnessTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """ Puts role and active flag of the user into the tokens"""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['role'] = user.role
+        token['is_active'] = user.is_active
+        token[AUTH_TIME_CLAIM] = time.time()
+        # the first request with the token does not read the user again
+        remember_tokens_valid_after(user)
+        return token
+
+
+class FitnessTokenUser(TokenUser):
+    """ User made from token claims, has only id, role and active flag of CustomUser"""
+
+    @cached_property
+    def role(self):
+        return self.token.get('role')
+
+    @cached_property
+    def is_active(self):
+        return self.token.get('is_active', False)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """ JWT authentication without user lookup for tokens that have role claim
+
+    Tokens issued before role claim was added are still checked against the database.
+    """
+
+    def get_user(self, validated_token):
+        if 'role' not in validated_token:
+            return super().get_user(validated_token)
+        user = FitnessTokenUser(validated_token)
+        return self.check_token_user(user, tokens_valid_after(user.id))
+
+    async def aget_user(self, validated_token):
+        if 'role' not in validated_token:
+            return await sync_to_async(super().get_user)(validated_token)
+        user = FitnessTokenUser(validated_token)
+        return self.check_token_user(user, await atokens_valid_after(user.id))
+
+    def check_token_user(self, user, valid_after):
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if user.token.get(AUTH_TIME_CLAIM, 0) <= valid_after:
+            raise AuthenticationFailed(_('Token is revoked'), code='token_revoked')
+        return user
+
+    async def aauthenticate(self, request):
+        """ Same as authenticate() for async views, the database is queried only for tokens without role claim"""
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
@@ -0,0 +1,276 @@
+"""
+In-process index of free trainer time, answers "which trainers are free at gym X on Tuesday 18:00-19:30"
+without going to the database.
+
+Free time of a schedule is its interval minus the moments when capacity is fully booked. Free intervals are kept
+per (gym, weekday) in an interval tree. Model signals (see signals.py) mark changed schedules, and they are reloaded
+from the database on the next query of their gym and day. Every process has its own index, so signals also bump
+a version of the day in the default cache (shared by processes, see config/caches.py): a day is served only while
+its version is the one it was loaded with, other processes load it again after a change. Bulk inserts, which send
+no signals, call invalidate() to bump the version of all days.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from .models import Schedule, Booking, WEEKDAYS, minute_of_week, end_minute_of_week
+
+FreeSlot = namedtuple('FreeSlot', ['schedule_id', 'trainer_id', 'start_minute', 'end_minute'])
+
+VERSION_KEY = 'fitness:availability:version:{}'
+
+ALL_DAYS = 'all'
+
+
+def version_key(day=ALL_DAYS):
+    """ Cache key of the version of a (gym_id, weekday) day, of all days by default"""
+    return VERSION_KEY.format(day if day == ALL_DAYS else '{}:{}'.format(*day))
+
+
+def free_intervals(start, end, capacity, booked_intervals):
+    """ Returns parts of [start, end) where less than capacity of booked intervals are going at the same time"""
+    events = []
+    for booked_start, booked_end in booked_intervals:
+        booked_start, booked_end = max(booked_start, start), min(booked_end, end)
+        if booked_start < booked_end:
+            events.append((booked_start, 1))
+            events.append((booked_end, -1))
+    # at the same moment finished booking is counted before started one
+    events.sort()
+    events.append((end, 0))
+
+    intervals = []
+    booked = 0
+    position = start
+    for moment, delta in events:
+        if moment > position:
+            if booked < capacity:
+                if intervals and intervals[-1][1] == position:
+                    intervals[-1] = (intervals[-1][0], moment)
+                else:
+                    intervals.append((position, moment))
+            position = moment
+        booked += delta
+    return intervals
+
+
+class IntervalTree:
+    """ Centered interval tree of [start, end) intervals, finds intervals that contain a given one
+
+    Each node keeps the intervals that contain its center point, sorted by start and by end,
+    the other intervals go to the left or the right subtree.
+    """
+
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, items):
+        # median start is inside at least one interval, so every node keeps some of them
+        starts = sorted(item.start_minute for item in items)
+        self.center = starts[len(starts) // 2] if starts else 0
+
+        here, left, right = [], [], []
+        for item in items:
+            if item.end_minute <= self.center:
+                left.append(item)
+            elif item.start_minute > self.center:
+                right.append(item)
+            else:
+                here.append(item)
+
+        self.by_start = sorted(here, key=lambda item: item.start_minute)
+        self.by_end = sorted(here, key=lambda item: item.end_minute, reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def containing(self, start, end):
+        """ Returns intervals that contain the whole [start, end)"""
+        found = []
+        node = self
+        while node is not None:
+            if start < node.center:
+                # intervals of the node go past the center, so only their start and end are checked
+                for item in node.by_start:
+                    if item.start_minute > start:
+                        break
+                    if item.end_minute >= end:
+                        found.append(item)
+                node = node.left
+            else:
+                # intervals of the node start before the center, so only their end is checked
+                for item in node.by_end:
+                    if item.end_minute < end:
+                        break
+                    found.append(item)
+                node = node.right
+        return found
+
+
+class DayAvailability:
+    """ Free slots of one gym on one weekday
+
+    Changed schedules are not put into the tree right away: their old slots are skipped and new ones are checked
+    one by one, the tree is rebuilt when too many of them are collected.
+    """
+
+    REBUILD_AFTER = 64
+
+    def __init__(self, slots=(), version=None):
+        self.version = version # versions of all days and of the day it was loaded with
+        self.slots = {}
+        for slot in slots:
+            self.slots.setdefault(slot.schedule_id, []).append(slot)
+        self.outdated = set() # schedules that have to be reloaded from the database
+        self.rebuild()
+
+    def rebuild(self):
+        self.tree = IntervalTree([slot for schedule_slots in self.slots.values() for slot in schedule_slots])
+        self.changed = set()
+
+    def replace(self, schedule_id, slots):
+        """ Replaces free slots of the schedule, empty slots remove it"""
+        if slots:
+            self.slots[schedule_id] = slots
+        else:
+            self.slots.pop(schedule_id, None)
+        self.changed.add(schedule_id)
+        if len(self.changed) > self.REBUILD_AFTER:
+            self.rebuild()
+
+    def free_slots(self, start_minute, end_minute):
+        found = [slot for slot in self.tree.containing(start_minute, end_minute) if slot.schedule_id not in self.changed]
+        for schedule_id in self.changed:
+            for slot in self.slots.get(schedule_id, ()):
+                if slot.start_minute <= start_minute and slot.end_minute >= end_minute:
+                    found.append(slot)
+        return sorted(found, key=lambda slot: (slot.start_minute, slot.schedule_id))
+
+
+def load_free_slots(schedules):
+    """ Computes free slots of the given schedules with one query for their bookings"""
+    schedules = list(schedules)
+    booked_intervals = {}
+    bookings = Booking.objects.filter(schedule__in=[schedule['id'] for schedule in schedules]).values_list('schedule_id', 'start_minute', 'end_minute')
+    for schedule_id, start_minute, end_minute in bookings:
+        booked_intervals.setdefault(schedule_id, []).append((start_minute, end_minute))
+
+    slots = {}
+    for schedule in schedules:
+        slots[schedule['id']] = [
+            FreeSlot(schedule['id'], schedule['trainer_id'], start, end)
+            for start, end in free_intervals(schedule['start_minute'], schedule['end_minute'], schedule['capacity'], booked_intervals.get(schedule['id'], ()))
+        ]
+    return slots
+
+
+SCHEDULE_FIELDS = ('id', 'trainer_id', 'gym_id', 'weekday', 'start_minute', 'end_minute', 'capacity')
+
+
+class AvailabilityIndex:
+
+    def __init__(self):
+        self.days = {} # (gym_id, weekday) -> DayAvailability
+        self.schedule_days = {} # schedule_id -> (gym_id, weekday) for loaded schedules
+        self.lock = threading.RLock()
+
+    def free_slots(self, gym_id, day_of_week, start_time, end_time):
+        """ Returns free slots of trainers at the gym that contain whole given time of the day"""
+        key = (gym_id, WEEKDAYS.index(day_of_week))
+        # read before loading, so a change made during the load makes the day outdated
+        version = self.shared_version(key)
+        with self.lock:
+            day = self.days.get(key)
+            if day is None or day.version != version:
+                day = self.load_day(key, version)
+            elif day.outdated:
+                self.reload_schedules(key, day)
+            return day.free_slots(minute_of_week(day_of_week, start_time), end_minute_of_week(day_of_week, end_time))
+
+    async def afree_slots(self, gym_id, day_of_week, start_time, end_time):
+        """ Same as free_slots() for async views, goes to a thread if the day has to be loaded from the database
+
+        The event loop never waits for the lock: a thread may hold it while it loads a day, then the query goes to a thread too.
+        """
+        key = (gym_id, WEEKDAYS.index(day_of_week))
+        versions = await cache.aget_many([version_key(), version_key(key)])
+        version = (versions.get(version_key()), versions.get(version_key(key)))
+        if None not in version and self.lock.acquire(blocking=False):
+            try:
+                day = self.days.get(key)
+                if day is not None and day.version == version and not day.outdated:
+                    return day.free_slots(minute_of_week(day_of_week, start_time), end_minute_of_week(day_of_week, end_time))
+            finally:
+                self.lock.release()
+        return await sync_to_async(self.free_slots)(gym_id, day_of_week, start_time, end_time)
+
+    def shared_version(self, key) -> tuple:
+        """ Versions of all days and of the day, a missing version starts from current time, so it does not repeat an old one"""
+        keys = [version_key(), version_key(key)]
+        versions = cache.get_many(keys)
+        for missing in set(keys) - versions.keys():
+            cache.add(missing, time.time_ns(), timeout=None)
+            versions[missing] = cache.get(missing)
+        return tuple(versions[cache_key] for cache_key in keys)
+
+    def load_day(self, key, version=None):
+        gym_id, weekday = key
+        schedules = Schedule.objects.filter(gym_id=gym_id, weekday=weekday).values(*SCHEDULE_FIELDS)
+        slots = load_free_slots(schedules)
+        day = DayAvailability((slot for schedule_slots in slots.values() for slot in schedule_slots), version)
+        for schedule_id in slots:
+            self.schedule_days[schedule_id] = key
+        self.days[key] = day
+        return day
+
+    def reload_schedules(self, key, day):
+        gym_id, weekday = key
+        schedule_ids, day.outdated = day.outdated, set()
+        schedules = Schedule.objects.filter(pk__in=schedule_ids, gym_id=gym_id, weekday=weekday).values(*SCHEDULE_FIELDS)
+        slots = load_free_slots(schedules)
+        for schedule_id in schedule_ids:
+            day.replace(schedule_id, slots.get(schedule_id))
+            if schedule_id in slots:
+                self.schedule_days[schedule_id] = key
+            elif self.schedule_days.get(schedule_id) == key:
+                del self.schedule_days[schedule_id]
+
+    def schedule_changed(self, schedule_id, days=()):
+        """ Marks the schedule to be reloaded in the day it was loaded in and in the given (gym_id, weekday) days
+
+        Versions of these days are bumped for other processes, this one reloads only the schedule.
+        """
+        with self.lock:
+            keys = {self.schedule_days.get(schedule_id), *days} - {None}
+            for key in keys:
+                if key in self.days:
+                    self.days[key].outdated.add(schedule_id)
+
+        for key in keys:
+            try:
+                version = cache.incr(version_key(key))
+            except ValueError: # the version is not in the cache
+                cache.set(version_key(key), time.time_ns(), timeout=None)
+                continue
+            with self.lock:
+                day = self.days.get(key)
+                # no other process has changed the day since it was loaded, the marked schedule is enough
+                if day is not None and day.version is not None and day.version[1] == version - 1:
+                    day.version = (day.version[0], version)
+
+    def invalidate(self):
+        """ Makes every process load all days again, for changes made without signals like bulk inserts"""
+        try:
+            cache.incr(version_key())
+        except ValueError:
+            cache.set(version_key(), time.time_ns(), timeout=None)
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.days.clear()
+            self.schedule_days.clear()
+
+
+availability_index = AvailabilityIndex()
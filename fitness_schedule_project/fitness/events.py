@@ -0,0 +1,223 @@
+"""
+Change events of schedules and bookings, pushed to clients as Server-Sent Events.
+
+Model signals (see signals.py) publish an Event after commit to the broker of EVENT_BROKER. LocalBroker hands events
+to streams opened in this process. With several processes or hosts a broker publishes events to a shared channel
+(like Redis pub/sub) instead and calls deliver() for every event it receives from there, streams stay the same.
+
+Every stream keeps at most EVENT_STREAM_QUEUE_SIZE events. A client that reads slower than events come loses older
+events instead of holding memory of the process or the publisher, and gets a resync event telling it to reload what it
+shows. An idle stream is a coroutine waiting for an asyncio.Event, so a process under ASGI holds tens of thousands of them.
+"""
+import asyncio
+import itertools
+import threading
+from collections import deque, namedtuple
+from datetime import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import Schedule, Booking, WEEKDAYS, MINUTES_IN_DAY
+from .renderers import FastJSONRenderer
+
+# gym_ids, trainer_ids and weekdays are matched with filters of streams, a changed schedule has old and new ones
+Event = namedtuple('Event', ['id', 'type', 'gym_ids', 'trainer_ids', 'weekdays', 'data'])
+
+RESYNC = 'resync'
+
+_event_ids = itertools.count(1)
+
+
+def make_event(event_type, data, gym_ids, trainer_ids, weekdays) -> Event:
+    return Event(next(_event_ids), event_type, frozenset(gym_ids), frozenset(trainer_ids), frozenset(weekdays), data)
+
+
+def minute_time(minute) -> time:
+    return time(minute % MINUTES_IN_DAY // 60, minute % 60)
+
+
+def schedule_event(event_type, schedule) -> Event:
+    loaded = getattr(schedule, '_loaded_owners', {})
+    return make_event(
+        f'schedule.{event_type}',
+        {
+            "schedule": schedule.pk,
+            "gym": schedule.gym_id,
+            "trainer": schedule.trainer_id,
+            "day_of_week": schedule.day_of_week,
+            "start_time": schedule.start_time,
+            "end_time": schedule.end_time,
+            "capacity": schedule.capacity,
+        },
+        {schedule.gym_id, loaded.get('gym_id', schedule.gym_id)},
+        {schedule.trainer_id, loaded.get('trainer_id', schedule.trainer_id)},
+        {schedule.weekday, loaded.get('weekday', schedule.weekday)},
+    )
+
+
+def booking_event(event_type, booking) -> Event | None:
+    """ Returns event of the booking, None if its schedule does not exist anymore. Client of the booking is not sent"""
+    if Booking.schedule.is_cached(booking):
+        schedule = booking.schedule
+    else:
+        schedule = Schedule.objects.only('gym_id', 'trainer_id', 'weekday').filter(pk=booking.schedule_id).first()
+        if schedule is None:
+            return None
+    return make_event(
+        f'booking.{event_type}',
+        {
+            "booking": booking.pk,
+            "schedule": booking.schedule_id,
+            "occurrence": booking.occurrence_id,
+            "gym": schedule.gym_id,
+            "trainer": schedule.trainer_id,
+            "day_of_week": WEEKDAYS[schedule.weekday],
+            "start_time": minute_time(booking.start_minute),
+            "end_time": minute_time(booking.end_minute),
+        },
+        {schedule.gym_id}, {schedule.trainer_id}, {schedule.weekday},
+    )
+
+
+def format_event(event_type, data, event_id=None) -> bytes:
+    head = f'event: {event_type}\ndata: ' if event_id is None else f'id: {event_id}\nevent: {event_type}\ndata: '
+    return head.encode() + FastJSONRenderer().render(data) + b'\n\n'
+
+
+class Subscription:
+    """ Queue of events of one stream, filtered by gym, trainer and week day (None matches any)"""
+
+    def __init__(self, gym=None, trainer=None, weekday=None, max_queued=100):
+        self.gym = gym
+        self.trainer = trainer
+        self.weekday = weekday
+        self.max_queued = max_queued
+        self.events = deque()
+        self.lost = 0
+        self.ready = asyncio.Event()
+        self.loop = None
+
+    def matches(self, event) -> bool:
+        return ((self.gym is None or self.gym in event.gym_ids)
+                and (self.trainer is None or self.trainer in event.trainer_ids)
+                and (self.weekday is None or self.weekday in event.weekdays))
+
+    def put(self, event) -> int:
+        """ Queues the event, returns number of dropped events if the queue was full. Called in the loop of the stream"""
+        dropped = 0
+        if len(self.events) >= self.max_queued:
+            # the client will reload everything after the resync event, so old events are not needed
+            dropped = len(self.events)
+            self.lost += dropped
+            self.events.clear()
+        self.events.append(event)
+        self.ready.set()
+        return dropped
+
+    async def get(self, timeout) -> tuple:
+        """ Waits up to timeout seconds for events, returns queued events and number of lost ones"""
+        if not self.events:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.ready.clear()
+        events, lost = list(self.events), self.lost
+        self.events.clear()
+        self.lost = 0
+        return events, lost
+
+
+class LocalBroker:
+    """ Delivers events to streams of this process, streams of every event loop are kept by gym of their filter"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {} # loop -> {gym or None: set of subscriptions}
+        self.streams = 0
+        self.delivered = 0
+        self.lost = 0
+
+    def publish(self, event):
+        self.deliver(event)
+
+    def deliver(self, event):
+        """ Hands the event to every event loop with streams, may be called from any thread"""
+        with self.lock:
+            loops = list(self.subscriptions)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        for loop in loops:
+            if loop is running_loop:
+                self.dispatch(loop, event)
+                continue
+            try:
+                loop.call_soon_threadsafe(self.dispatch, loop, event)
+            except RuntimeError:
+                # the loop was closed with its streams
+                with self.lock:
+                    self.subscriptions.pop(loop, None)
+
+    def dispatch(self, loop, event):
+        by_gym = self.subscriptions.get(loop, {})
+        candidates = [by_gym.get(None, ())] + [by_gym.get(gym, ()) for gym in event.gym_ids]
+        for subscriptions in candidates:
+            for subscription in subscriptions:
+                if subscription.matches(event):
+                    self.delivered += 1
+                    self.lost += subscription.put(event)
+
+    def subscribe(self, gym=None, trainer=None, weekday=None, max_queued=100) -> Subscription:
+        """ Starts a stream, should be called in its event loop"""
+        subscription = Subscription(gym, trainer, weekday, max_queued)
+        subscription.loop = asyncio.get_running_loop()
+        with self.lock:
+            self.subscriptions.setdefault(subscription.loop, {}).setdefault(gym, set()).add(subscription)
+            self.streams += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            by_gym = self.subscriptions.get(subscription.loop, {})
+            subscriptions = by_gym.get(subscription.gym, set())
+            if subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            self.streams -= 1
+            if not subscriptions:
+                del by_gym[subscription.gym]
+            if not by_gym:
+                del self.subscriptions[subscription.loop]
+
+    def stats(self) -> dict:
+        return {'streams': self.streams, 'delivered': self.delivered, 'lost': self.lost}
+
+
+broker = import_string(settings.EVENT_BROKER)()
+
+
+def publish(event):
+    if event is not None:
+        broker.publish(event)
+
+
+async def stream(gym=None, trainer=None, weekday=None):
+    """ Yields events matching filters in Server-Sent Events format, and a comment every EVENT_STREAM_HEARTBEAT seconds
+    without events, so proxies don't close the connection
+    """
+    subscription = broker.subscribe(gym, trainer, weekday, settings.EVENT_STREAM_QUEUE_SIZE)
+    try:
+        yield f'retry: {settings.EVENT_STREAM_RETRY_MS}\n\n'.encode()
+        while True:
+            events, lost = await subscription.get(settings.EVENT_STREAM_HEARTBEAT)
+            chunks = []
+            if lost:
+                chunks.append(format_event(RESYNC, {"lost": lost}))
+            chunks.extend(format_event(event.type, event.data, event.id) for event in events)
+            yield b''.join(chunks) or b': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,83 @@
+"""
+Streaming export of querysets as CSV or NDJSON.
+
+Rows are read as values() with .iterator(), which uses a server-side cursor where the database supports it,
+and written to the response in chunks, so memory does not grow with the number of rows. Under ASGI Django reads
+a sync iterator to the end before sending anything, so there chunks are made one by one in the sync thread and
+the response gets an async iterator.
+"""
+import csv
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+# ?format= is taken by DRF for content negotiation
+FORMAT_PARAM = 'export_format'
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(rows, fields, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for number, row in enumerate(rows, 1):
+        writer.writerow([csv_value(row[field]) for field in fields])
+        if number % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, fields, chunk_size):
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode({field: row[field] for field in fields}))
+        if len(lines) == chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+CHUNK_WRITERS = {
+    'csv': csv_chunks,
+    'ndjson': ndjson_chunks,
+}
+
+
+async def async_chunks(chunks):
+    """ Yields chunks of a sync generator, each one is made in the thread of sync views, where its cursor is"""
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        yield chunk
+
+
+def export_response(queryset, fields, export_format, filename, chunk_size=DEFAULT_CHUNK_SIZE, asynchronous=False):
+    """ Streams fields of every row of the queryset, export_format is one of CONTENT_TYPES
+
+    asynchronous should be set for requests served by ASGI, the chunks are sent as they are made then.
+    """
+    rows = queryset.values(*fields).iterator(chunk_size=chunk_size)
+    chunks = CHUNK_WRITERS[export_format](rows, fields, chunk_size)
+    response = StreamingHttpResponse(async_chunks(chunks) if asynchronous else chunks, content_type=CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
@@ -0,0 +1,104 @@
+"""
+Read-only serializers that build dicts from values() rows.
+
+ModelSerializer runs fields, their to_representation() and ReturnDict for every value of every row, which is most of
+the CPU time of a large page. These serializers read only needed columns (joined ones for ?expand=) with values() and
+build each dict by precomputed getters. Values are left as they come from the database (UUID, time, date), the JSON
+renderer writes them the same way as DRF fields would, so the response body does not change.
+"""
+from operator import itemgetter
+
+from .instrumentation import timed_serialization
+from .serializers import ScheduleSerializer, BookingSerializer, UserShortSerializer, GymSerializer
+
+
+class ValuesSerializer:
+    """ Serializer of values() rows, with the same output as serializer_class
+
+    fields are pairs of output name and column, expandable maps names of ?expand= to serializers of the related
+    object, the related object is read by the column of the field with its name as prefix.
+    """
+    serializer_class = None
+    fields = ()
+    expandable = {}
+
+    def __init__(self, instance=None, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    @classmethod
+    def columns(cls, expand, prefix=''):
+        columns = []
+        for name, column in cls.fields:
+            if name in cls.expandable and name in expand:
+                columns.extend(cls.expandable[name].columns(expand, f'{prefix}{name}__'))
+            else:
+                columns.append(prefix + column)
+        return columns
+
+    @classmethod
+    def values(cls, queryset, expand, extra=()):
+        """ Turns the queryset into values() of columns needed for the expand, extra columns are used by pagination"""
+        return queryset.values(*dict.fromkeys([*cls.columns(expand), *extra]))
+
+    @classmethod
+    def builder(cls, expand, prefix=''):
+        """ Returns function making output dict of a row, nested objects are None if their id is None"""
+        getters = []
+        for name, column in cls.fields:
+            if name in cls.expandable and name in expand:
+                getters.append((name, cls.expandable[name].nested_builder(expand, f'{prefix}{name}__')))
+            else:
+                getters.append((name, itemgetter(prefix + column)))
+
+        def build(row):
+            return {name: getter(row) for name, getter in getters}
+        return build
+
+    @classmethod
+    def nested_builder(cls, expand, prefix):
+        build = cls.builder(expand, prefix)
+        id_column = prefix + dict(cls.fields)['id']
+
+        def build_nested(row):
+            return None if row[id_column] is None else build(row)
+        return build_nested
+
+    @property
+    def data(self):
+        build = self.builder(self.context.get('expand', ()))
+        with timed_serialization():
+            if self.many:
+                return [build(row) for row in self.instance]
+            return build(self.instance)
+
+
+class UserShortValuesSerializer(ValuesSerializer):
+    serializer_class = UserShortSerializer
+    fields = (('id', 'id'), ('full_name', 'full_name'), ('gender', 'gender'))
+
+
+class GymValuesSerializer(ValuesSerializer):
+    serializer_class = GymSerializer
+    fields = (('id', 'id'), ('name', 'name'))
+
+
+class ScheduleValuesSerializer(ValuesSerializer):
+    serializer_class = ScheduleSerializer
+    # in the order of ModelSerializer: primary key, other fields, then relations
+    fields = (
+        ('id', 'id'), ('day_of_week', 'day_of_week'), ('start_time', 'start_time'), ('end_time', 'end_time'),
+        ('capacity', 'capacity'), ('trainer', 'trainer_id'), ('gym', 'gym_id'),
+    )
+    expandable = {'trainer': UserShortValuesSerializer, 'gym': GymValuesSerializer}
+
+
+class BookingValuesSerializer(ValuesSerializer):
+    serializer_class = BookingSerializer
+    fields = (
+        ('id', 'id'), ('start_time', 'start_time'), ('end_time', 'end_time'),
+        ('client', 'client_id'), ('schedule', 'schedule_id'), ('occurrence', 'occurrence_id'),
+    )
+    # trainer and gym are expanded inside of expanded schedule, like in BookingSerializer
+    expandable = {'client': UserShortValuesSerializer, 'schedule': ScheduleValuesSerializer}
@@ -0,0 +1,33 @@
+from django_filters import rest_framework as filters
+
+from .models import Schedule, Booking, DAYS_OF_WEEK, day_minutes_range
+
+
+class DayOfWeekFilter(filters.ChoiceFilter):
+    """ Accepts day name, but filters by range of minutes of the week, which is indexed"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('choices', DAYS_OF_WEEK)
+        super().__init__(*args, **kwargs)
+
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        day_start, day_end = day_minutes_range(value)
+        return qs.filter(**{f'{self.field_name}__gte': day_start, f'{self.field_name}__lt': day_end})
+
+
+class ScheduleFilter(filters.FilterSet):
+    day_of_week = DayOfWeekFilter(field_name='start_minute')
+
+    class Meta:
+        model = Schedule
+        fields = ['trainer', 'gym', 'day_of_week', 'start_time', 'end_time']
+
+
+class BookingFilter(filters.FilterSet):
+    schedule__day_of_week = DayOfWeekFilter(field_name='start_minute')
+
+    class Meta:
+        model = Booking
+        fields = ['client', 'schedule', 'start_time', 'end_time', 'schedule__day_of_week', 'schedule__start_time', 'schedule__end_time']
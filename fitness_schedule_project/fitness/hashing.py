@@ -0,0 +1,31 @@
+"""
+Password hashing in a pool of processes.
+
+PBKDF2 is slow on purpose and holds the GIL, so hashing many passwords (like in user_import.py) is spread over
+processes, one per core. Workers are spawned, not forked: forking a process with threads (like a web server) may
+deadlock. A spawned worker imports this module before django.setup(), so it must not import models.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.hashers import make_password
+
+# a pool takes about a second to start, fewer passwords are hashed in this process
+MIN_POOL_PASSWORDS = 16
+
+
+def setup_worker():
+    django.setup()
+
+
+def hash_passwords(passwords, workers=None) -> list:
+    """ Returns make_password() of every password, None gives an unusable password"""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < MIN_POOL_PASSWORDS:
+        return [make_password(password) for password in passwords]
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=setup_worker) as executor:
+        return list(executor.map(make_password, passwords, chunksize=max(len(passwords) // (workers * 4), 1)))
@@ -0,0 +1,276 @@
+"""
+Per-request performance instrumentation.
+
+InstrumentationMiddleware counts queries and their time (by a wrapper installed on every database connection,
+see signals.py), time of serializers (see TimedRepresentationMixin) and total time of the request. They are sent
+back in the Server-Timing header, logged to the 'fitness.requests' logger and aggregated by view name in memory of the
+process, which is exposed in Prometheus text format at /metrics. Views with more queries than their QUERY_BUDGETS
+entry are logged as warnings, tests can check the same budgets with assert_query_budget().
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import events, schedule_cache, throttling
+
+logger = logging.getLogger('fitness.requests')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class RequestTimings:
+    """ What a request has spent, filled while it is handled"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+
+    def server_timing(self) -> str:
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'serializer;dur={self.serializer_time * 1000:.1f}',
+            f'app;dur={self.duration * 1000:.1f}',
+        ])
+
+
+_timings = contextvars.ContextVar('fitness_request_timings', default=None)
+
+
+def current_timings():
+    """ Returns timings of the request being handled, None outside of requests"""
+    return _timings.get()
+
+
+def query_timer(execute, sql, params, many, context):
+    """ Database execute wrapper, counts queries of the current request"""
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.db_time += time.perf_counter() - started
+
+
+@contextmanager
+def timed_serialization():
+    """ Adds time of the block to serializer time of the request, nested serializers are counted once"""
+    timings = _timings.get()
+    if timings is None or timings.serializing:
+        yield
+        return
+
+    timings.serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serializer_time += time.perf_counter() - started
+        timings.serializing = False
+
+
+class TimedRepresentationMixin:
+    """ Serializer mixin which counts time of to_representation() as serializer time of the request"""
+
+    def to_representation(self, instance):
+        with timed_serialization():
+            return super().to_representation(instance)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels) -> str:
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+class Metrics:
+    """ Request metrics of this process by view name"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = defaultdict(int) # (view, method, status) -> count
+        self.durations = defaultdict(lambda: Histogram(DURATION_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERIES_BUCKETS))
+        self.db_seconds = defaultdict(float)
+        self.serializer_seconds = defaultdict(float)
+        self.budget_exceeded = defaultdict(int)
+
+    def observe(self, view, method, status, timings, over_budget):
+        with self.lock:
+            self.requests[view, method, status] += 1
+            self.durations[view].observe(timings.duration)
+            self.queries[view].observe(timings.queries)
+            self.db_seconds[view] += timings.db_time
+            self.serializer_seconds[view] += timings.serializer_time
+            if over_budget:
+                self.budget_exceeded[view] += 1
+
+    def render(self) -> str:
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{{{format_labels(labels)}}} {value}')
+
+        def histogram_samples(histograms):
+            for view, histogram in sorted(histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    yield '_bucket', [('view', view), ('le', bound)], count
+                yield '_bucket', [('view', view), ('le', '+Inf')], histogram.count
+                yield '_sum', [('view', view)], histogram.sum
+                yield '_count', [('view', view)], histogram.count
+
+        with self.lock:
+            add('fitness_http_requests_total', 'counter', 'Handled requests',
+                [('', [('view', view), ('method', method), ('status', status)], count)
+                 for (view, method, status), count in sorted(self.requests.items())])
+            add('fitness_http_request_duration_seconds', 'histogram', 'Time of handling requests',
+                histogram_samples(self.durations))
+            add('fitness_http_request_queries', 'histogram', 'Database queries per request',
+                histogram_samples(self.queries))
+            add('fitness_http_request_db_seconds_total', 'counter', 'Time of database queries',
+                [('', [('view', view)], value) for view, value in sorted(self.db_seconds.items())])
+            add('fitness_http_request_serializer_seconds_total', 'counter', 'Time of serializers',
+                [('', [('view', view)], value) for view, value in sorted(self.serializer_seconds.items())])
+            add('fitness_http_request_query_budget_exceeded_total', 'counter', 'Requests with more queries than QUERY_BUDGETS allows',
+                [('', [('view', view)], count) for view, count in sorted(self.budget_exceeded.items())])
+
+        event_stats = events.broker.stats()
+        add('fitness_event_streams', 'gauge', 'Open event streams of this process', [('', [], event_stats['streams'])])
+        add('fitness_events_delivered_total', 'counter', 'Events queued to streams', [('', [], event_stats['delivered'])])
+        add('fitness_events_lost_total', 'counter', 'Events dropped from queues of slow streams', [('', [], event_stats['lost'])])
+
+        throttle_stats = throttling.limiter.stats()
+        add('fitness_throttle_decisions_total', 'counter', 'Requests allowed and throttled by token buckets',
+            [('', [('scope', scope), ('result', result)], count) for (scope, result), count in sorted(throttle_stats['decisions'].items())])
+        add('fitness_load_shedding_in_flight', 'gauge', 'Requests of throttled views being handled', [('', [], throttle_stats['in_flight'])])
+        add('fitness_load_shedding_rejected_total', 'counter', 'Requests rejected with 503 by load shedding',
+            [('', [('view', view)], count) for view, count in sorted(throttle_stats['shed'].items())])
+
+        cache_stats = schedule_cache.stats.as_dict()
+        add('fitness_schedule_cache_requests_total', 'counter', 'Lookups of the schedules response cache',
+            [('', [('result', 'hit')], cache_stats['hits']), ('', [('result', 'miss')], cache_stats['misses'])])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def view_name(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
+
+
+def query_budget(view) -> int | None:
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(view)
+
+
+def assert_query_budget(response, view=None):
+    """ Test helper: fails if the request of the response made more queries than QUERY_BUDGETS allows for its view"""
+    timings = response.request_timings
+    view = view or response.request_view
+    budget = query_budget(view)
+    if budget is None:
+        raise AssertionError(f'View {view} has no query budget')
+    if timings.queries > budget:
+        raise AssertionError(f'View {view} made {timings.queries} queries, its budget is {budget}')
+
+
+class InstrumentationMiddleware:
+    """ Measures every request, should be the first middleware to include time of the others"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        # content of streaming responses is produced later, only time till the first byte is measured
+        timings.duration = time.perf_counter() - timings.started
+        view = view_name(request)
+        budget = query_budget(view)
+        over_budget = budget is not None and timings.queries > budget
+
+        metrics.observe(view, request.method, response.status_code, timings, over_budget)
+        if getattr(settings, 'SERVER_TIMING_HEADER', True):
+            response['Server-Timing'] = timings.server_timing()
+        response.request_timings = timings
+        response.request_view = view
+
+        log = logger.warning if over_budget else logger.info
+        log(
+            'view=%s method=%s status=%s duration_ms=%.1f queries=%d db_ms=%.1f serializer_ms=%.1f',
+            view, request.method, response.status_code, timings.duration * 1000, timings.queries,
+            timings.db_time * 1000, timings.serializer_time * 1000,
+            extra={
+                'view': view, 'method': request.method, 'status': response.status_code, 'duration': timings.duration,
+                'queries': timings.queries, 'db_time': timings.db_time, 'serializer_time': timings.serializer_time,
+                'query_budget': budget,
+            },
+        )
+        return response
+
+
+def metrics_view(request):
+    """ Metrics of this process in Prometheus text format, for addresses of METRICS_ALLOWED_IPS, None allows any"""
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', None)
+    if allowed_ips is not None and request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
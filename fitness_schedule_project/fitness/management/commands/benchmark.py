@@ -0,0 +1,224 @@
+import json
+import logging
+import math
+import random
+import time
+from datetime import time as day_time
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from ...authentication import FitnessTokenObtainPairSerializer
+from ...models import WEEKDAYS
+from .populate_db import Command as PopulateCommand
+
+User = get_user_model()
+
+SCENARIOS = ('token_obtain', 'schedule_list', 'create_schedule', 'add_this_schedule', 'get_own_bookings')
+
+# the benchmark must not read or leave responses and token times of rolled back users in the shared caches
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fitness-benchmark'},
+    'tokens': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fitness-benchmark-tokens', 'TIMEOUT': None},
+}
+
+
+def percentile(sorted_values, percent):
+    """ Nearest-rank percentile"""
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize(latencies, queries, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_queries': sum(queries) / len(queries),
+        'max_queries': max(queries),
+        'requests_per_second': len(latencies) / sum(latencies) if sum(latencies) else 0,
+    }
+
+
+class Benchmark:
+    """ Seeds a dataset and drives the real URL routes in-process with one client at a time
+
+    Every scenario is a function that prepares a request (not measured) and returns method, path, data and
+    the user whose token is sent.
+    """
+
+    def __init__(self, iterations, warmup, gyms, trainers, clients, capacity, seed):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.rnd = random.Random(seed)
+        self.api_client = APIClient(SERVER_NAME='localhost')
+        self.tokens = {}
+
+        populate = PopulateCommand(stdout=StringIO())
+        populate.rnd = self.rnd
+        populate.batch_size = 5000
+        password = make_password('password')
+        self.gyms = populate.create_gyms(gyms)
+        trainer_ids = populate.create_users('trainer', trainers, password)
+        self.client_ids = populate.create_users('client', clients, password)
+        self.schedules = populate.create_schedules(trainer_ids, self.gyms, 5, capacity)
+        populate.create_bookings(self.client_ids, self.schedules, 3)
+
+        # users without schedules and bookings, one per request, so creation and booking never conflict
+        requests = iterations + warmup
+        self.new_trainer_ids = iter(populate.create_users('trainer', requests, password))
+        self.new_client_ids = iter(populate.create_users('client', requests, password))
+        self.emails = dict(User.objects.filter(pk__in=self.client_ids).values_list('pk', 'email'))
+
+    def token(self, user_id):
+        if user_id not in self.tokens:
+            user = User(pk=user_id, role=User.objects.values_list('role', flat=True).get(pk=user_id))
+            self.tokens[user_id] = str(FitnessTokenObtainPairSerializer.get_token(user).access_token)
+        return self.tokens[user_id]
+
+    def token_obtain(self):
+        email = self.emails[self.rnd.choice(self.client_ids)]
+        return 'post', '/api/token/', {'email': email, 'password': 'password'}, None
+
+    def schedule_list(self):
+        # every request reads the database, not the response cache
+        cache.clear()
+        params = {'gym': self.rnd.choice(self.gyms).pk, 'day_of_week': self.rnd.choice(WEEKDAYS), 'expand': 'trainer,gym'}
+        return 'get', '/api/schedules/', params, self.rnd.choice(self.client_ids)
+
+    def create_schedule(self):
+        data = {'gym': self.rnd.choice(self.gyms).pk, 'day_of_week': self.rnd.choice(WEEKDAYS), 'start_time': '08:00', 'end_time': '12:00'}
+        return 'post', '/api/schedules/create_schedule/', data, next(self.new_trainer_ids)
+
+    def add_this_schedule(self):
+        schedule = self.rnd.choice(self.schedules)
+        hour = self.rnd.randrange(schedule.start_time.hour, schedule.end_time.hour)
+        data = {'start_time': day_time(hour).isoformat(), 'end_time': day_time(hour + 1).isoformat()}
+        return 'post', f'/api/schedules/{schedule.pk}/add_this_schedule/', data, next(self.new_client_ids)
+
+    def get_own_bookings(self):
+        return 'get', '/api/bookings/get_own_bookings/', {}, self.rnd.choice(self.client_ids)
+
+    def request(self, prepare):
+        method, path, data, user_id = prepare()
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {self.token(user_id)}'} if user_id else {}
+        started = time.perf_counter()
+        if method == 'get':
+            response = self.api_client.get(path, data, **headers)
+        else:
+            response = self.api_client.post(path, data, format='json', **headers)
+        return time.perf_counter() - started, response
+
+    def run(self, scenario):
+        prepare = getattr(self, scenario)
+        for _ in range(self.warmup):
+            self.request(prepare)
+
+        latencies, queries, errors = [], [], 0
+        for _ in range(self.iterations):
+            latency, response = self.request(prepare)
+            latencies.append(latency)
+            queries.append(response.request_timings.queries)
+            if response.status_code >= 400:
+                errors += 1
+        return summarize(latencies, queries, errors)
+
+
+def run_benchmark(scenarios=SCENARIOS, iterations=50, warmup=5, gyms=3, trainers=20, clients=200, capacity=10, seed=0, keep_data=False):
+    """ Runs scenarios on a seeded dataset and returns their reports by name, the dataset is rolled back unless keep_data"""
+    # rejected requests are counted as errors, they are not logged one by one
+    request_logger = logging.getLogger('django.request')
+    log_level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+    try:
+        # every request comes from one address and would soon be throttled, the middleware still runs without limits
+        with override_settings(CACHES=BENCHMARK_CACHES, THROTTLE_RATES={}), transaction.atomic():
+            benchmark = Benchmark(iterations, warmup, gyms, trainers, clients, capacity, seed)
+            report = {scenario: benchmark.run(scenario) for scenario in scenarios}
+            transaction.set_rollback(not keep_data)
+    finally:
+        request_logger.setLevel(log_level)
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """ Returns descriptions of regressions: errors, p95 slower than the baseline by more than tolerance or more queries"""
+    regressions = []
+    for scenario, result in report.items():
+        if result['errors']:
+            regressions.append(f"{scenario}: {result['errors']} failed requests")
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {result['p95_ms']:.1f} ms, baseline {base['p95_ms']:.1f} ms")
+        if result['max_queries'] > base['max_queries']:
+            regressions.append(f"{scenario}: {result['max_queries']} queries per request, baseline {base['max_queries']}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = 'Benchmark main API endpoints on a seeded dataset (rolled back afterwards) and compare results with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenario to run, all by default, can be repeated')
+        parser.add_argument('--iterations', type=int, default=50, help='Measured requests of every scenario')
+        parser.add_argument('--warmup', type=int, default=5, help='Requests of every scenario made before measuring')
+        parser.add_argument('--gyms', type=int, default=3, help='Number of seeded gyms')
+        parser.add_argument('--trainers', type=int, default=20, help='Number of seeded trainers')
+        parser.add_argument('--clients', type=int, default=200, help='Number of seeded clients')
+        parser.add_argument('--capacity', type=int, default=10, help='Capacity of seeded schedules')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--baseline', default=None, help='Path of the baseline JSON to compare with')
+        parser.add_argument('--save-baseline', action='store_true', help='Write results to the baseline file instead of comparing')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed p95 slowdown against the baseline, 0.25 is 25%%')
+        parser.add_argument('--output', default=None, help='Path of a JSON file to write results to')
+        parser.add_argument('--keep-data', action='store_true', help='Commit the seeded dataset instead of rolling it back')
+
+    def handle(self, *args, **options):
+        if options['save_baseline'] and not options['baseline']:
+            raise CommandError('--save-baseline needs --baseline')
+
+        report = run_benchmark(
+            scenarios=options['scenario'] or SCENARIOS,
+            iterations=options['iterations'],
+            warmup=options['warmup'],
+            gyms=options['gyms'],
+            trainers=options['trainers'],
+            clients=options['clients'],
+            capacity=options['capacity'],
+            seed=options['seed'],
+            keep_data=options['keep_data'],
+        )
+
+        self.stdout.write(f"{'scenario':<20}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'req/s':>9}{'errors':>8}")
+        for scenario, result in report.items():
+            self.stdout.write(f"{scenario:<20}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+                              f"{result['mean_queries']:>9.1f}{result['requests_per_second']:>9.1f}{result['errors']:>8}")
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(report, baseline_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {options['baseline']}"))
+            return
+
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions' if baseline else 'Done, no baseline to compare with'))
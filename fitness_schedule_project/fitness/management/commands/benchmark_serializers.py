@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from ...fast_serializers import ScheduleValuesSerializer, BookingValuesSerializer
+from ...renderers import FastJSONRenderer
+from ...views import ExpandMixin, ScheduleViewSet, BookingViewSet
+
+CASES = (
+    # values serializer, viewset of the queryset, expand
+    (ScheduleValuesSerializer, ScheduleViewSet, set()),
+    (ScheduleValuesSerializer, ScheduleViewSet, {'trainer', 'gym'}),
+    (BookingValuesSerializer, BookingViewSet, set()),
+    (BookingValuesSerializer, BookingViewSet, {'client', 'schedule', 'trainer', 'gym'}),
+)
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+class Command(BaseCommand):
+    help = 'Compare serialization and rendering cost of model serializers and values serializers on rows of the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Number of rows serialized at once')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs of every case, the best one is reported')
+
+    def handle(self, *args, **options):
+        rows_count, repeat = options['rows'], options['repeat']
+        for values_serializer_class, viewset, expand in CASES:
+            serializer_class = values_serializer_class.serializer_class
+            context = {'expand': expand}
+            queryset = viewset.queryset.all()
+            # rows are loaded once, only serialization and rendering are measured
+            instances = list(ExpandMixin.select_expanded(queryset, expand, viewset.expand_related)[:rows_count])
+            rows = list(values_serializer_class.values(queryset, expand)[:rows_count])
+            if not rows:
+                raise CommandError(f'No {queryset.model.__name__} rows, run populate_db first')
+
+            def model_path():
+                return JSONRenderer().render(serializer_class(instances, many=True, context=context).data)
+
+            def values_path():
+                return FastJSONRenderer().render(values_serializer_class(rows, many=True, context=context).data)
+
+            if model_path() != values_path():
+                raise CommandError(f'{serializer_class.__name__} and {values_serializer_class.__name__} render different bytes')
+
+            label = f"expand={','.join(sorted(expand)) or '-'}"
+            model_time = best_time(model_path, repeat) / len(rows) * 1000
+            values_time = best_time(values_path, repeat) / len(rows) * 1000
+            self.stdout.write(f'{serializer_class.__name__} + JSONRenderer, {label}: {model_time * 1e6:.0f} us per 1000 rows')
+            self.stdout.write(f'{values_serializer_class.__name__} + FastJSONRenderer, {label}: {values_time * 1e6:.0f} us per 1000 rows '
+                              f'({model_time / values_time:.1f}x faster)')
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from config.schema import write_schema
+
+
+class Command(BaseCommand):
+    help = 'Generate OpenAPI schema of the API and write it to the file served by the swagger views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='Path of the schema file, by default OPENAPI_SCHEMA_PATH')
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.OPENAPI_SCHEMA_PATH
+        content = write_schema(path)
+        self.stdout.write(self.style.SUCCESS(f'Schema written to {path} ({len(content)} bytes)'))
@@ -0,0 +1,39 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...user_import import FORMATS, import_users, parse_rows
+
+
+class Command(BaseCommand):
+    help = 'Create trainers and clients from a CSV (with a header line) or JSON file, rows with errors are skipped and reported'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSON file with email, password, full_name, gender, date_of_birth and role of users')
+        parser.add_argument('--format', choices=FORMATS, default=None, help='Format of the file, by its extension by default')
+        parser.add_argument('--workers', type=int, default=None, help='Processes hashing passwords, number of cores by default')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of users inserted by one query')
+        parser.add_argument('--dry-run', action='store_true', help='Only validate rows')
+
+    def handle(self, *args, **options):
+        import_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if import_format not in FORMATS:
+            raise CommandError(f'Format should be one of: {", ".join(FORMATS)}')
+
+        started = time.perf_counter()
+        with open(options['path'], 'rb') as import_file:
+            try:
+                rows = parse_rows(import_file.read(), import_format)
+            except ValueError as error:
+                raise CommandError(f'Can not read {options["path"]}: {error}')
+
+        result = import_users(rows, workers=options['workers'], batch_size=options['batch_size'], dry_run=options['dry_run'])
+        for error in result['errors']:
+            self.stderr.write(f"Row {error['row']}: {error['errors']}")
+
+        elapsed = time.perf_counter() - started
+        verb = 'would be created' if options['dry_run'] else 'created'
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['created']} of {len(rows)} users {verb} in {elapsed:.1f}s, {len(result['errors'])} rows with errors"
+        ))
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import Schedule, ScheduleOccurrence, occurrence_horizon
+
+
+class Command(BaseCommand):
+    help = 'Create dated occurrences of schedules for the rolling horizon, only missing dates are created. Run it daily'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.OCCURRENCE_HORIZON_DAYS, help='Number of days from today')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of schedules handled at once')
+
+    def handle(self, *args, **options):
+        date_from, date_to = occurrence_horizon(timezone.localdate(), options['days'])
+        schedules = Schedule.objects.order_by('pk').only('pk', 'trainer_id', 'gym_id', 'weekday', 'start_time', 'end_time')
+
+        created = 0
+        batch = []
+        for schedule in schedules.iterator(chunk_size=options['batch_size']):
+            batch.append(schedule)
+            if len(batch) == options['batch_size']:
+                created += ScheduleOccurrence.materialize(batch, date_from, options['days'])
+                batch = []
+        if batch:
+            created += ScheduleOccurrence.materialize(batch, date_from, options['days'])
+
+        self.stdout.write(self.style.SUCCESS(f'Occurrences from {date_from} to {date_to}: {created} created'))
@@ -1,43 +1,167 @@
 import random
-from django.core.management.base import BaseCommand
-from django.utils import timezone
+import string
+import time
+import uuid
+from datetime import time as day_time
+
 from django.contrib.auth import get_user_model
-from ...models import Gym, Schedule, Booking
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from ...availability import availability_index
+from ...models import Gym, Schedule, ScheduleHourSummary, TrainerGym, Booking, WEEKDAYS
 
 User = get_user_model()
 
+
+class Progress:
+    """ Writes how many rows of a kind are created and how fast, at most once a second"""
+
+    def __init__(self, stdout, label, total):
+        self.stdout = stdout
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = self.reported = time.perf_counter()
+
+    def add(self, count):
+        self.done += count
+        now = time.perf_counter()
+        if now - self.reported >= 1:
+            self.reported = now
+            self.stdout.write(f'  {self.label}: {self.done}/{self.total} ({self.rate(now):.0f} rows/s)')
+
+    def rate(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.started
+        return self.done / elapsed if elapsed else 0
+
+    def finish(self):
+        self.stdout.write(f'{self.label}: {self.done} rows in {time.perf_counter() - self.started:.1f}s ({self.rate():.0f} rows/s)')
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class Command(BaseCommand):
-    help = 'Populate the database with sample data'
-
-    def handle(self, *args, **kwargs):
-        # Create sample gyms
-        gyms = ['Gym A', 'Gym B', 'Gym C']
-        for gym_name in gyms:
-            Gym.objects.create(name=gym_name)
-
-        # Create sample users
-        clients = []
-        trainers = []
-        for i in range(5):
-            client = User.objects.create_user(email=f'client{i+1}@example.com', password='password', full_name=f'Client {i+1}')
-            trainer = User.objects.create_user(email=f'trainer{i+1}@example.com', password='password', full_name=f'Trainer {i+1}', role='trainer')
-            clients.append(client)
-            trainers.append(trainer)
-
-        # Create sample schedules
-        days_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
-        for trainer in trainers:
-            for day in days_of_week:
-                start_time = timezone.now().replace(hour=random.randint(8, 12), minute=0, second=0, microsecond=0)
-                end_time = (start_time + timezone.timedelta(hours=4)).replace(microsecond=0)
-                Schedule.objects.create(trainer=trainer, gym=Gym.objects.first(), day_of_week=day, start_time=start_time.time(), end_time=end_time.time())
-
-        # Create sample bookings
-        for client in clients:
-            for _ in range(3):
-                schedule = Schedule.objects.order_by('?').first()
-                start_time = schedule.start_time
-                end_time = schedule.end_time
-                Booking.objects.create(client=client, schedule=schedule, start_time=start_time, end_time=end_time)
-
-        self.stdout.write(self.style.SUCCESS('Sample data has been successfully populated'))
+    help = 'Populate the database with sample data, use scale options to generate a dataset for load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gyms', type=int, default=3, help='Number of gyms')
+        parser.add_argument('--trainers', type=int, default=5, help='Number of trainers')
+        parser.add_argument('--clients', type=int, default=5, help='Number of clients')
+        parser.add_argument('--bookings-per-client', type=int, default=3, help='Number of one hour bookings of every client')
+        parser.add_argument('--days-per-trainer', type=int, default=5, choices=range(1, 8), help='Number of week days every trainer works')
+        parser.add_argument('--capacity', type=int, default=1, help='How many clients a trainer can train at the same time')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of rows inserted by one query')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed')
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        started = time.perf_counter()
+
+        gyms = self.create_gyms(options['gyms'])
+        # hashing is slow on purpose, so all sample users share one hash of 'password'
+        password = make_password('password')
+        trainer_ids = self.create_users('trainer', options['trainers'], password)
+        client_ids = self.create_users('client', options['clients'], password)
+        schedules = self.create_schedules(trainer_ids, gyms, options['days_per_trainer'], options['capacity'])
+        bookings_count = self.create_bookings(client_ids, schedules, options['bookings_per_client'])
+        # running servers load free time of the new schedules and bookings
+        availability_index.invalidate()
+
+        rows = len(gyms) + len(trainer_ids) + len(client_ids) + len(schedules) + bookings_count
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Sample data has been successfully populated: {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)'
+        ))
+
+    def create_gyms(self, count):
+        first = Gym.objects.count()
+        names = [string.ascii_uppercase[i] if i < len(string.ascii_uppercase) else str(i + 1) for i in range(first, first + count)]
+        gyms = Gym.objects.bulk_create([Gym(name=f'Gym {name}') for name in names], batch_size=self.batch_size)
+        self.stdout.write(f'Gyms: {len(gyms)}')
+        return gyms
+
+    def create_users(self, role, count, password):
+        """ Creates users with emails like client1@example.com numbered after existing users of the role, returns their ids"""
+        first = User.objects.filter(role=role).count() + 1
+        progress = Progress(self.stdout, f'{role.capitalize()}s', count)
+        ids = []
+        for numbers in batched(range(first, first + count), self.batch_size):
+            users = [
+                User(id=uuid.uuid4(), email=f'{role}{i}@example.com', password=password, full_name=f'{role.capitalize()} {i}',
+                     role=role, gender=self.rnd.choice(('male', 'female')))
+                for i in numbers
+            ]
+            for user in users:
+                user.sync_search_name()
+            User.objects.bulk_create(users)
+            ids.extend(user.id for user in users)
+            progress.add(len(users))
+        progress.finish()
+        return ids
+
+    def create_schedules(self, trainer_ids, gyms, days_per_trainer, capacity):
+        """ Every trainer works at one gym on some days of the week, one shift a day, so schedules do not overlap"""
+        progress = Progress(self.stdout, 'Schedules', len(trainer_ids) * days_per_trainer)
+        schedules = []
+        for trainer_ids_batch in batched(trainer_ids, max(self.batch_size // days_per_trainer, 1)):
+            batch = []
+            for trainer_id in trainer_ids_batch:
+                gym = self.rnd.choice(gyms)
+                for day in sorted(self.rnd.sample(WEEKDAYS, days_per_trainer), key=WEEKDAYS.index):
+                    start_hour = self.rnd.randint(7, 14)
+                    schedule = Schedule(trainer_id=trainer_id, gym=gym, day_of_week=day, capacity=capacity,
+                                        start_time=day_time(start_hour), end_time=day_time(start_hour + self.rnd.randint(3, 6)))
+                    schedule.sync_minutes()
+                    batch.append(schedule)
+            schedules.extend(Schedule.objects.bulk_create(batch))
+            # bulk_create() sends no signals, denormalized rows are added here
+            TrainerGym.add_for(batch)
+            ScheduleHourSummary.create_for(batch)
+            progress.add(len(batch))
+        progress.finish()
+        return schedules
+
+    def create_bookings(self, client_ids, schedules, bookings_per_client):
+        """ Books random one hour slots, a slot is booked by at most capacity clients and a client books only one slot at a time"""
+        # every free place of an hour is a separate item, taken items are swapped with the last one and dropped
+        places = [(schedule, hour) for schedule in schedules for hour in range(schedule.start_time.hour, schedule.end_time.hour)
+                  for _ in range(schedule.capacity)]
+        progress = Progress(self.stdout, 'Bookings', len(client_ids) * bookings_per_client)
+
+        def bookings():
+            for client_id in client_ids:
+                booked_hours = set()
+                for _ in range(bookings_per_client):
+                    # a few tries to find a place at an hour the client is free
+                    for _attempt in range(10):
+                        if not places:
+                            return
+                        index = self.rnd.randrange(len(places))
+                        schedule, hour = places[index]
+                        if (schedule.weekday, hour) not in booked_hours:
+                            break
+                    else:
+                        continue
+                    places[index] = places[-1]
+                    places.pop()
+                    booked_hours.add((schedule.weekday, hour))
+                    booking = Booking(client_id=client_id, schedule=schedule, start_time=day_time(hour), end_time=day_time(hour + 1))
+                    booking.sync_minutes(schedule)
+                    yield booking
+
+        for batch in batched(bookings(), self.batch_size):
+            Booking.objects.bulk_create(batch)
+            ScheduleHourSummary.add_bookings(batch)
+            progress.add(len(batch))
+        progress.finish()
+        return progress.done
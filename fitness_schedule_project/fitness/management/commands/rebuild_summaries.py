@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...availability import availability_index
+from ...models import ScheduleHourSummary, TrainerGym
+
+
+class Command(BaseCommand):
+    help = 'Recompute analytics summaries of all schedules from bookings and gyms of trainers from schedules, for data created by bulk inserts or after manual changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of rows inserted at once')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        # dashboards see old summaries until the new ones are committed
+        with transaction.atomic():
+            rows = ScheduleHourSummary.rebuild(batch_size=options['batch_size'])
+            memberships = TrainerGym.rebuild(batch_size=options['batch_size'])
+        # data changed in the database directly is not in free time of running servers either
+        availability_index.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'{rows} summaries and {memberships} trainer gyms rebuilt in {time.perf_counter() - started:.1f}s'))
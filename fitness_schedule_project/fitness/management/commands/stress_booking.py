@@ -0,0 +1,170 @@
+import json
+import logging
+import random
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import time as day_time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from ...authentication import FitnessTokenObtainPairSerializer
+from ...models import Gym, Schedule, Booking, max_overlapping
+
+User = get_user_model()
+
+
+def http_post(url, data, token):
+    """ Returns status code and parsed body of a JSON POST request"""
+    request = urllib.request.Request(url, data=json.dumps(data).encode(), method='POST', headers={
+        'Content-Type': 'application/json', 'Authorization': f'Bearer {token}',
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as error:
+        try:
+            return error.code, json.loads(error.read() or b'{}')
+        except ValueError:
+            return error.code, {}
+
+
+def run_booking_stress(requests=2000, workers=32, clients=200, capacity=5, seed=None, url=None):
+    """ Books one schedule from many threads at once and returns a report of what was created
+
+    Every request takes a random client and a random one hour slot of the schedule, so most of them race for the same rows.
+    Requests go to the views in this process, or over HTTP to a server at url using the same database and SECRET_KEY
+    (like uvicorn with THROTTLE_ENABLED=0, so the requests from one address are not throttled).
+    """
+    rnd = random.Random(seed)
+    run_id = uuid.uuid4().hex[:8]
+
+    gym = Gym.objects.create(name=f'Stress gym {run_id}')
+    trainer = User.objects.create_user(email=f'stress-trainer-{run_id}@example.com', full_name='Stress Trainer', role='trainer')
+    schedule = Schedule.objects.create(trainer=trainer, gym=gym, day_of_week='Monday', start_time=day_time(8, 0), end_time=day_time(20, 0), capacity=capacity)
+
+    password = make_password(None)
+    client_users = User.objects.bulk_create([
+        User(email=f'stress-client-{run_id}-{i}@example.com', full_name=f'Stress Client {i}', password=password)
+        for i in range(clients)
+    ])
+
+    hours = range(schedule.start_time.hour, schedule.end_time.hour)
+    tasks = [(rnd.choice(client_users), rnd.choice(hours)) for _ in range(requests)]
+    tokens = {client.pk: str(FitnessTokenObtainPairSerializer.get_token(client).access_token) for client in client_users} if url else {}
+
+    def book_over_http(task):
+        client, hour = task
+        try:
+            status_code, data = http_post(
+                f"{url.rstrip('/')}/api/schedules/{schedule.pk}/add_this_schedule/",
+                {'start_time': f'{hour:02d}:00', 'end_time': f'{hour + 1:02d}:00'},
+                tokens[client.pk],
+            )
+            return status_code, data.get('error') if status_code != 201 else None
+        except Exception as e:
+            return 'exception', repr(e)
+
+    def book(task):
+        client, hour = task
+        api_client = APIClient(SERVER_NAME='localhost')
+        api_client.force_authenticate(user=client)
+        try:
+            response = api_client.post(
+                f'/api/schedules/{schedule.pk}/add_this_schedule/',
+                {'start_time': f'{hour:02d}:00', 'end_time': f'{hour + 1:02d}:00'},
+                format='json',
+            )
+            return response.status_code, getattr(response, 'data', {}).get('error') if response.status_code != 201 else None
+        except Exception as e:
+            return 'exception', repr(e)
+        finally:
+            # like at the end of a real request, the connection is kept for CONN_MAX_AGE
+            close_old_connections()
+
+    # rejected bookings are expected here, so they are not logged one by one
+    request_logger = logging.getLogger('django.request')
+    log_level = request_logger.level
+    request_logger.setLevel(logging.ERROR)
+    try:
+        started = time.perf_counter()
+        # all requests come from one address and race on purpose, they must reach the lock instead of being throttled
+        with override_settings(THROTTLE_RATES={}, LOAD_SHEDDING_MAX_IN_FLIGHT=None), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(book_over_http if url else book, tasks))
+        elapsed = time.perf_counter() - started
+    finally:
+        request_logger.setLevel(log_level)
+
+    booked_times = list(Booking.objects.filter(schedule=schedule).values_list('client_id', 'start_time', 'end_time'))
+    times_by_client = {}
+    for client_id, start_time, end_time in booked_times:
+        times_by_client.setdefault(client_id, []).append((start_time, end_time))
+
+    report = {
+        'requests': requests,
+        'workers': workers,
+        'url': url,
+        'capacity': capacity,
+        'created': sum(1 for status_code, _error in results if status_code == 201),
+        'bookings_in_db': len(booked_times),
+        'max_booked_at_once': max_overlapping((start_time, end_time) for _client_id, start_time, end_time in booked_times),
+        'double_booked_clients': sum(1 for times in times_by_client.values() if max_overlapping(times) > 1),
+        'responses': Counter(status_code for status_code, _error in results),
+        'errors': Counter(error for _status_code, error in results if error),
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed if elapsed else 0,
+    }
+    report['overbooked'] = report['max_booked_at_once'] > capacity or report['double_booked_clients'] > 0
+
+    trainer.delete()
+    gym.delete()
+    User.objects.filter(pk__in=[client.pk for client in client_users]).delete()
+
+    return report
+
+
+class Command(BaseCommand):
+    help = 'Fire parallel booking requests at one schedule and check that it was not overbooked'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Number of booking requests')
+        parser.add_argument('--workers', type=int, default=32, help='Number of parallel threads')
+        parser.add_argument('--clients', type=int, default=200, help='Number of clients making requests')
+        parser.add_argument('--capacity', type=int, default=5, help='Capacity of the booked schedule')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed')
+        parser.add_argument('--min-rps', type=float, default=0, help='Fail if throughput is lower than this number of requests per second')
+        parser.add_argument('--url', default=None, help='Send requests to a running server, like http://127.0.0.1:8000, instead of calling views in this process')
+
+    def handle(self, *args, **options):
+        report = run_booking_stress(
+            requests=options['requests'],
+            workers=options['workers'],
+            clients=options['clients'],
+            capacity=options['capacity'],
+            seed=options['seed'],
+            url=options['url'],
+        )
+
+        self.stdout.write(f"{report['requests']} requests with {report['workers']} workers{' to ' + report['url'] if report['url'] else ''} in {report['seconds']:.2f}s "
+                          f"({report['requests_per_second']:.1f} req/s)")
+        self.stdout.write(f"Responses: {dict(report['responses'])}")
+        for error, count in report['errors'].most_common():
+            self.stdout.write(f"  {count} x {error}")
+        self.stdout.write(f"Created bookings: {report['created']}, in database: {report['bookings_in_db']}, "
+                          f"max booked at once: {report['max_booked_at_once']} of {report['capacity']}, "
+                          f"double booked clients: {report['double_booked_clients']}")
+
+        if report['overbooked'] or report['created'] != report['bookings_in_db']:
+            raise CommandError('Schedule was overbooked')
+        if report['requests_per_second'] < options['min_rps']:
+            raise CommandError(f"Throughput {report['requests_per_second']:.1f} req/s is lower than {options['min_rps']} req/s")
+
+        self.stdout.write(self.style.SUCCESS('No overbooking detected'))
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.4 on 2026-10-17 18:30
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitness', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['client', 'start_time', 'end_time'], name='booking_client_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['schedule', 'start_time', 'end_time'], name='booking_schedule_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['trainer', 'day_of_week', 'start_time', 'end_time'], name='schedule_trainer_day_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['gym', 'day_of_week', 'start_time'], name='schedule_gym_day_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['day_of_week', 'start_time'], name='schedule_day_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='booking',
+            constraint=models.CheckConstraint(check=models.Q(('start_time__isnull', True), ('end_time__isnull', True), ('start_time__lt', models.F('end_time')), ('end_time', datetime.time(0, 0)), _connector='OR'), name='booking_start_before_end'),
+        ),
+        migrations.AddConstraint(
+            model_name='schedule',
+            constraint=models.CheckConstraint(check=models.Q(('start_time__lt', models.F('end_time')), ('end_time', datetime.time(0, 0)), _connector='OR'), name='schedule_start_before_end'),
+        ),
+        migrations.AddConstraint(
+            model_name='schedule',
+            constraint=models.CheckConstraint(check=models.Q(('start_time__gte', datetime.time(6, 0))), name='schedule_not_in_closed_hours'),
+        ),
+    ]
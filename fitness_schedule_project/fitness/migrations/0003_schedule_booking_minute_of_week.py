@@ -0,0 +1,116 @@
+import datetime
+
+from django.db import migrations, models
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+MINUTES_IN_DAY = 24 * 60
+
+
+def minute_of_week(day_of_week, time_value):
+    return WEEKDAYS.index(day_of_week) * MINUTES_IN_DAY + time_value.hour * 60 + time_value.minute
+
+
+def end_minute_of_week(day_of_week, time_value):
+    # midnight as the end of an interval is the end of the day
+    return minute_of_week(day_of_week, time_value) + (MINUTES_IN_DAY if time_value == datetime.time(0, 0) else 0)
+
+
+def fill_minutes(apps, schema_editor):
+    Schedule = apps.get_model('fitness', 'Schedule')
+    Booking = apps.get_model('fitness', 'Booking')
+
+    schedules = list(Schedule.objects.all())
+    for schedule in schedules:
+        schedule.weekday = WEEKDAYS.index(schedule.day_of_week)
+        schedule.start_minute = minute_of_week(schedule.day_of_week, schedule.start_time)
+        schedule.end_minute = end_minute_of_week(schedule.day_of_week, schedule.end_time)
+    Schedule.objects.bulk_update(schedules, ['weekday', 'start_minute', 'end_minute'], batch_size=1000)
+
+    bookings = list(Booking.objects.select_related('schedule'))
+    for booking in bookings:
+        schedule = booking.schedule
+        booking.start_minute = minute_of_week(schedule.day_of_week, booking.start_time or schedule.start_time)
+        booking.end_minute = end_minute_of_week(schedule.day_of_week, booking.end_time or schedule.end_time)
+    Booking.objects.bulk_update(bookings, ['start_minute', 'end_minute'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitness', '0002_schedule_booking_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='weekday',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='start_minute',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='end_minute',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='start_minute',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='end_minute',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_minutes, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_client_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_schedule_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='schedule',
+            name='schedule_trainer_day_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='schedule',
+            name='schedule_gym_day_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='schedule',
+            name='schedule_day_time_idx',
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['client', 'start_minute', 'end_minute'], name='booking_client_minute_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['schedule', 'start_minute', 'end_minute'], name='booking_schedule_minute_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['trainer', 'start_minute', 'end_minute'], name='schedule_trainer_minute_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['gym', 'start_minute'], name='schedule_gym_minute_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['start_minute'], name='schedule_minute_idx'),
+        ),
+    ]
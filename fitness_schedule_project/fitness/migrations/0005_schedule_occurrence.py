@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-17 19:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitness', '0004_customuser_tokens_valid_after'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleOccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('gym', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='fitness.gym')),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='fitness.schedule')),
+                ('trainer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Schedule occurrence',
+                'verbose_name_plural': 'Schedule occurrences',
+            },
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='occurrence',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='bookings', to='fitness.scheduleoccurrence'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleoccurrence',
+            index=models.Index(fields=['gym', 'date', 'start_time'], name='occurrence_gym_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleoccurrence',
+            index=models.Index(fields=['trainer', 'date', 'start_time'], name='occurrence_trainer_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleoccurrence',
+            index=models.Index(fields=['date', 'start_time'], name='occurrence_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='scheduleoccurrence',
+            constraint=models.UniqueConstraint(fields=('schedule', 'date'), name='occurrence_schedule_date_unique'),
+        ),
+    ]
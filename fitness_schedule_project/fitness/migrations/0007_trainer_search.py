@@ -0,0 +1,95 @@
+import unicodedata
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def normalize_name(name):
+    letters = unicodedata.normalize('NFKD', name or '')
+    return ' '.join(''.join(char for char in letters if not unicodedata.combining(char)).casefold().split())
+
+
+def fill_search_names(apps, schema_editor):
+    CustomUser = apps.get_model('fitness', 'CustomUser')
+
+    # one prepared UPDATE executed for every user, bulk_update() builds a CASE of every batch which is much slower
+    names = CustomUser.objects.exclude(full_name=None).exclude(full_name='').values_list('full_name', 'pk')
+    table = schema_editor.quote_name(CustomUser._meta.db_table)
+    prepare_pk = CustomUser._meta.pk.get_db_prep_value
+    connection = schema_editor.connection
+    rows = [(normalize_name(full_name), prepare_pk(pk, connection)) for full_name, pk in names.iterator(chunk_size=2000)]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'UPDATE {table} SET search_name = %s WHERE id = %s', rows)
+
+
+def fill_trainer_gyms(apps, schema_editor):
+    Schedule = apps.get_model('fitness', 'Schedule')
+    TrainerGym = apps.get_model('fitness', 'TrainerGym')
+
+    pairs = Schedule.objects.order_by().values_list('trainer_id', 'gym_id').distinct()
+    TrainerGym.objects.bulk_create([TrainerGym(trainer_id=trainer_id, gym_id=gym_id) for trainer_id, gym_id in pairs], batch_size=1000)
+
+
+def create_trigram_index(apps, schema_editor):
+    # prefix, word and similarity searches of names on PostgreSQL, other databases use user_role_search_name_idx
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    CustomUser = apps.get_model('fitness', 'CustomUser')
+    table = schema_editor.quote_name(CustomUser._meta.db_table)
+    column = schema_editor.quote_name(CustomUser._meta.get_field('search_name').column)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(f'CREATE INDEX user_search_name_trgm_idx ON {table} USING gin ({column} gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS user_search_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('fitness', '0006_schedule_hour_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='search_name',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.CreateModel(
+            name='TrainerGym',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gym', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trainer_memberships', to='fitness.gym')),
+                ('trainer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gym_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Trainer gym',
+                'verbose_name_plural': 'Trainer gyms',
+            },
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='gyms',
+            field=models.ManyToManyField(blank=True, related_name='trainers', through='fitness.TrainerGym', to='fitness.gym'),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['role', 'search_name'], name='user_role_search_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trainergym',
+            index=models.Index(fields=['gym', 'trainer'], name='trainer_gym_gym_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='trainergym',
+            constraint=models.UniqueConstraint(fields=('trainer', 'gym'), name='trainer_gym_unique'),
+        ),
+        migrations.RunPython(fill_search_names, migrations.RunPython.noop),
+        migrations.RunPython(fill_trainer_gyms, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
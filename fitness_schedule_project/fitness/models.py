@@ -1,8 +1,17 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+import unicodedata
 import uuid
+from datetime import time, timedelta
+
+def normalize_name(name) -> str:
+    """ Lower case name without accents and extra spaces, names are searched in this form"""
+    letters = unicodedata.normalize('NFKD', name or '')
+    return ' '.join(''.join(char for char in letters if not unicodedata.combining(char)).casefold().split())
 
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -49,15 +58,56 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     date_of_birth = models.DateField(null=True, blank=True)
     full_name = models.CharField(max_length=100, null=True, blank=True)
     gender = models.CharField(max_length=10, choices=GENDER_OPTION, null=False, blank=False, default="male")
+    # tokens issued before are not accepted, set on save when TOKEN_FIELDS are changed, see fitness.authentication
+    tokens_valid_after = models.DateTimeField(null=True, blank=True, editable=False)
+    # normalize_name() of full_name, kept in sync on save (not by queryset.update() or bulk_create())
+    search_name = models.CharField(max_length=100, default='', editable=False)
+
+    # gyms where the trainer has schedules, kept by TrainerGym
+    gyms = models.ManyToManyField('Gym', through='TrainerGym', related_name='trainers', blank=True)
 
     objects = CustomUserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
+    # changes of these fields make issued JWT tokens invalid, see fitness.authentication
+    TOKEN_FIELDS = ('role', 'is_active', 'password')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_token_fields = {name: value for name, value in zip(field_names, values) if name in cls.TOKEN_FIELDS}
+        return user
+
+    def token_fields_changed(self) -> bool:
+        loaded = getattr(self, '_loaded_token_fields', {})
+        changed = any(getattr(self, name) != value for name, value in loaded.items())
+        self._loaded_token_fields = {name: getattr(self, name) for name in loaded}
+        return changed
+
+    def sync_search_name(self):
+        self.search_name = normalize_name(self.full_name)
+
+    def save(self, *args, **kwargs):
+        self.sync_search_name()
+        synced_fields = {'search_name'} if kwargs.get('update_fields') is not None and 'full_name' in kwargs['update_fields'] else set()
+        # signals tell the caches of authentication (see signals.py)
+        self.tokens_revoked = not self._state.adding and self.token_fields_changed()
+        if self.tokens_revoked:
+            self.tokens_valid_after = timezone.now()
+            synced_fields.add('tokens_valid_after')
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], *synced_fields}
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = _('User')
         verbose_name_plural = _('Users')
+        indexes = [
+            # prefix search of the trainer directory, on PostgreSQL names are searched by a trigram index (migration 0007)
+            models.Index(fields=['role', 'search_name'], name='user_role_search_name_idx'),
+        ]
 
 class Gym(models.Model):
     name = models.CharField(max_length=100)
@@ -80,6 +130,48 @@ DAYS_OF_WEEK = [
         ('Sunday', 'Sunday'),
     ]
 
+WEEKDAYS = [day for day, _label in DAYS_OF_WEEK]
+
+MINUTES_IN_DAY = 24 * 60
+
+CLOSED_UNTIL = time(6, 0) # the fitness center is closed between 00:00 and 06:00
+
+MIDNIGHT = time(0, 0) # as an end time it is the end of the day, like in 22:00-00:00
+
+def minute_of_day(time_value) -> int:
+    return time_value.hour * 60 + time_value.minute
+
+def end_minute_of_day(time_value) -> int:
+    """ Same as minute_of_day() for the end of an interval, midnight is the end of the day"""
+    return MINUTES_IN_DAY if time_value == MIDNIGHT else minute_of_day(time_value)
+
+def minute_of_week(day_of_week, time_value) -> int:
+    """ Encodes day name and time as number of minutes since Monday 00:00, so intervals of the week can be compared as integers"""
+    return WEEKDAYS.index(day_of_week) * MINUTES_IN_DAY + minute_of_day(time_value)
+
+def end_minute_of_week(day_of_week, time_value) -> int:
+    return WEEKDAYS.index(day_of_week) * MINUTES_IN_DAY + end_minute_of_day(time_value)
+
+def day_minutes_range(day_of_week) -> tuple:
+    """ Returns [start, end) minutes of the week that belong to the day"""
+    day_start = WEEKDAYS.index(day_of_week) * MINUTES_IN_DAY
+    return day_start, day_start + MINUTES_IN_DAY
+
+def max_overlapping(intervals) -> int:
+    """ Returns the biggest number of (start, end) intervals that are going at the same moment"""
+    events = []
+    for start, end in intervals:
+        events.append((start, 1))
+        events.append((end, -1))
+    # at the same moment finished interval is counted before started one, so 08:00-09:00 and 09:00-10:00 do not overlap
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    overlapping = max_overlapping = 0
+    for _moment, delta in events:
+        overlapping += delta
+        max_overlapping = max(max_overlapping, overlapping)
+    return max_overlapping
+
 class Schedule(models.Model):
     """
     Each trainer person can decide in which day of the week he will work and and how much time. 
@@ -92,13 +184,167 @@ class Schedule(models.Model):
     day_of_week = models.CharField(max_length=20, choices=DAYS_OF_WEEK, default="Monday")
     start_time = models.TimeField()# a time when trainer will be available to help with gym activity
     end_time = models.TimeField()
+    capacity = models.PositiveSmallIntegerField(default=1) # how many clients trainer can train at the same time
+
+    # compact copy of day_of_week, start_time and end_time, kept in sync on save (not by queryset.update() or bulk_create())
+    weekday = models.PositiveSmallIntegerField(editable=False) # 0 is Monday
+    start_minute = models.PositiveSmallIntegerField(editable=False) # minutes since Monday 00:00
+    end_minute = models.PositiveSmallIntegerField(editable=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        schedule = super().from_db(db, field_names, values)
+        # cached lists and event streams of the gym, the trainer and the day the schedule was loaded with are notified when they are changed
+        schedule._loaded_owners = {name: value for name, value in zip(field_names, values) if name in ('gym_id', 'trainer_id', 'weekday')}
+        return schedule
 
     def __str__(self) -> str:
-        return self.trainer.full_name + " - " + self.gym.name  + " - " + self.day_of_week  + " - " + self.start_time.__str__() + " - " + self.end_time.__str__()
+        return (self.trainer.full_name or self.trainer.email) + " - " + self.gym.name  + " - " + self.day_of_week  + " - " + self.start_time.__str__() + " - " + self.end_time.__str__()
+
+    def sync_minutes(self):
+        self.weekday = WEEKDAYS.index(self.day_of_week)
+        self.start_minute = minute_of_week(self.day_of_week, self.start_time)
+        self.end_minute = end_minute_of_week(self.day_of_week, self.end_time)
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.sync_minutes()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'weekday', 'start_minute', 'end_minute'}
+        super().save(*args, **kwargs)
+        # signals have seen the loaded values, the next save is compared with these
+        loaded, self._loaded_owners = getattr(self, '_loaded_owners', {}), {'gym_id': self.gym_id, 'trainer_id': self.trainer_id, 'weekday': self.weekday}
+
+        if adding:
+            ScheduleOccurrence.materialize([self], check_existing=False)
+            ScheduleHourSummary.create_for([self])
+            TrainerGym.add_for([self])
+            return
+        loaded_owners = (loaded.get('trainer_id'), loaded.get('gym_id'))
+        if loaded_owners != (self.trainer_id, self.gym_id):
+            TrainerGym.sync([loaded_owners, (self.trainer_id, self.gym_id)])
+        self.cancelled_bookings = self.sync_occurrences()
+        # bookings keep minutes of the schedule's day, so they are moved if the day was changed
+        day_start = self.weekday * MINUTES_IN_DAY
+        self.booking_set.exclude(start_minute__gte=day_start, start_minute__lt=day_start + MINUTES_IN_DAY).update(
+            start_minute=models.F('start_minute') % MINUTES_IN_DAY + day_start,
+            # a booking may end at midnight of the day, so its length is kept
+            end_minute=models.F('start_minute') % MINUTES_IN_DAY + day_start + models.F('end_minute') - models.F('start_minute'),
+        )
+        # bookings without their own times take the whole session, which may be changed
+        self.booking_set.filter(start_time=None).exclude(start_minute=self.start_minute).update(start_minute=self.start_minute)
+        self.booking_set.filter(end_time=None).exclude(end_minute=self.end_minute).update(end_minute=self.end_minute)
+        ScheduleHourSummary.rebuild([self.pk])
+
+    def sync_occurrences(self) -> list:
+        """ Moves future occurrences to the current time, removes ones of another week day and creates missing ones
+
+        Returns dated bookings cancelled with removed occurrences, these sessions won't happen. They are deleted before
+        their occurrences, so signals tell their clients (booking.deleted events) and subtract them from summaries.
+        """
+        future = self.occurrences.filter(date__gte=timezone.localdate())
+        # iso_week_day is 1 for Monday
+        removed = future.exclude(date__iso_week_day=self.weekday + 1)
+        cancelled = list(Booking.objects.filter(occurrence__in=removed))
+        if cancelled:
+            Booking.objects.filter(pk__in=[booking.pk for booking in cancelled]).delete()
+        removed.delete()
+        future.update(gym_id=self.gym_id, trainer_id=self.trainer_id, start_time=self.start_time, end_time=self.end_time)
+        ScheduleOccurrence.materialize([self])
+        return cancelled
+
+    def clean(self):
+        # forms (like the admin) refuse to cancel dated bookings, see sync_occurrences()
+        loaded_weekday = getattr(self, '_loaded_owners', {}).get('weekday')
+        if loaded_weekday is None or self.day_of_week not in WEEKDAYS or WEEKDAYS.index(self.day_of_week) == loaded_weekday:
+            return
+        if Booking.objects.filter(occurrence__schedule_id=self.pk, occurrence__date__gte=timezone.localdate()).exists():
+            raise ValidationError({'day_of_week': _('Clients have booked dates of this schedule, cancel their bookings before moving it to another day')})
+
+    def has_free_place(self, start_time, end_time, occurrence=None) -> bool:
+        """ Checks that during the whole given time less clients than capacity have booked this schedule
+
+        Weekly bookings take a place at every occurrence. For a booking of one occurrence only bookings of that date
+        are counted besides them, for a weekly booking dated ones of all dates are counted, which may be too strict but is safe.
+        """
+        start_minute = minute_of_week(self.day_of_week, start_time)
+        end_minute = end_minute_of_week(self.day_of_week, end_time)
+        bookings = self.booking_set.filter(start_minute__lt=end_minute, end_minute__gt=start_minute)
+        if occurrence is not None:
+            bookings = bookings.filter(models.Q(occurrence__isnull=True) | models.Q(occurrence=occurrence))
+        return max_overlapping(bookings.values_list('start_minute', 'end_minute')) < self.capacity
 
     class Meta:
         verbose_name = _('Schedule')
         verbose_name_plural = _('Schedules')
+        indexes = [
+            # intersection check of trainer's schedules
+            models.Index(fields=['trainer', 'start_minute', 'end_minute'], name='schedule_trainer_minute_idx'),
+            # list filters by gym and day (as a range of minutes) and ordering in week order
+            models.Index(fields=['gym', 'start_minute'], name='schedule_gym_minute_idx'),
+            models.Index(fields=['start_minute'], name='schedule_minute_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(check=models.Q(start_time__lt=models.F('end_time')) | models.Q(end_time=MIDNIGHT), name='schedule_start_before_end'),
+            models.CheckConstraint(check=models.Q(start_time__gte=CLOSED_UNTIL), name='schedule_not_in_closed_hours'),
+        ]
+
+def occurrence_horizon(date_from=None, days=None):
+    """ Returns first and last dates of the rolling horizon for which occurrences are materialized"""
+    date_from = date_from or timezone.localdate()
+    days = days or settings.OCCURRENCE_HORIZON_DAYS
+    return date_from, date_from + timedelta(days=days - 1)
+
+class ScheduleOccurrence(models.Model):
+    """
+    A dated session of a weekly schedule, so bookings and capacity can be checked for a concrete date and calendars are
+    queried by ranges of dates. Created for a rolling horizon by the materialize_occurrences command and on schedule save.
+    """
+
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='occurrences')
+    # copies of the schedule's fields, so calendars of a gym or a trainer are read without joins
+    trainer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='occurrences')
+    gym = models.ForeignKey(Gym, on_delete=models.CASCADE, related_name='occurrences')
+    date = models.DateField()
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+
+    def __str__(self) -> str:
+        return f'{self.schedule_id} - {self.date} - {self.start_time} - {self.end_time}'
+
+    @classmethod
+    def materialize(cls, schedules, date_from=None, days=None, check_existing=True) -> int:
+        """ Creates occurrences of schedules on their week days of the horizon that do not exist yet, returns their number"""
+        schedules = list(schedules)
+        date_from, date_to = occurrence_horizon(date_from, days)
+        existing = set()
+        if check_existing:
+            existing = set(cls.objects.filter(schedule__in=schedules, date__range=(date_from, date_to)).values_list('schedule_id', 'date'))
+
+        occurrences = []
+        for schedule in schedules:
+            date = date_from + timedelta(days=(schedule.weekday - date_from.weekday()) % 7)
+            while date <= date_to:
+                if (schedule.pk, date) not in existing:
+                    occurrences.append(cls(schedule_id=schedule.pk, trainer_id=schedule.trainer_id, gym_id=schedule.gym_id,
+                                           date=date, start_time=schedule.start_time, end_time=schedule.end_time))
+                date += timedelta(days=7)
+        # a concurrent run may have created some of them, they are skipped by the unique constraint
+        cls.objects.bulk_create(occurrences, ignore_conflicts=True)
+        return len(occurrences)
+
+    class Meta:
+        verbose_name = _('Schedule occurrence')
+        verbose_name_plural = _('Schedule occurrences')
+        indexes = [
+            # calendars of a gym, a trainer and the whole center for a range of dates
+            models.Index(fields=['gym', 'date', 'start_time'], name='occurrence_gym_date_idx'),
+            models.Index(fields=['trainer', 'date', 'start_time'], name='occurrence_trainer_date_idx'),
+            models.Index(fields=['date', 'start_time'], name='occurrence_date_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'date'], name='occurrence_schedule_date_unique'),
+        ]
 
 class Booking(models.Model):
     """
@@ -111,21 +357,261 @@ class Booking(models.Model):
     
     client = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='client_bookings')
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
+    # a booking of one date, weekly booking (every occurrence of the schedule) if not set
+    occurrence = models.ForeignKey(ScheduleOccurrence, on_delete=models.CASCADE, null=True, blank=True, related_name='bookings')
     start_time = models.TimeField(null=True, blank=True) # a time when client will start gym activity
     end_time = models.TimeField(null=True, blank=True)
 
-    def intersects_with_schedule(self, schedule):
-        
+    # booked time as minutes since Monday 00:00 (whole schedule if times are not set), kept in sync on save
+    start_minute = models.PositiveSmallIntegerField(editable=False)
+    end_minute = models.PositiveSmallIntegerField(editable=False)
+
+    def sync_minutes(self, schedule=None):
+        schedule = schedule or self.schedule
+        self.start_minute = minute_of_week(schedule.day_of_week, self.start_time or schedule.start_time)
+        self.end_minute = end_minute_of_week(schedule.day_of_week, self.end_time or schedule.end_time)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        booking = super().from_db(db, field_names, values)
+        booking._loaded_schedule_id = dict(zip(field_names, values)).get('schedule_id')
+        return booking
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.sync_minutes()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'start_minute', 'end_minute'}
+        super().save(*args, **kwargs)
+
+        if adding:
+            ScheduleHourSummary.add_bookings([self])
+        else:
+            # booked time or the schedule may be changed (by admin), summaries of both schedules are recomputed
+            ScheduleHourSummary.rebuild({self.schedule_id, getattr(self, '_loaded_schedule_id', None) or self.schedule_id})
+
+    def intersects_with_schedule(self, schedule, start_time=None, end_time=None):
+        """ Compares booked time of the client with given time on the schedule's day (whole schedule by default)"""
+
         if self.schedule.day_of_week != schedule.day_of_week:
             return False
 
-        if (self.schedule.start_time < schedule.end_time) and (self.schedule.end_time > schedule.start_time):
+        start_time = start_time or schedule.start_time
+        end_time = end_time or schedule.end_time
+
+        booked_start_time = self.start_time or self.schedule.start_time
+        booked_end_time = self.end_time or self.schedule.end_time
+
+        if (booked_start_time < end_time) and (booked_end_time > start_time):
             return True
-        
 
         return False
     
     class Meta:
         verbose_name = _('Booking')
         verbose_name_plural = _('Bookings')
+        indexes = [
+            # intersection check of client's bookings
+            models.Index(fields=['client', 'start_minute', 'end_minute'], name='booking_client_minute_idx'),
+            # free places check of the schedule
+            models.Index(fields=['schedule', 'start_minute', 'end_minute'], name='booking_schedule_minute_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(start_time__isnull=True) | models.Q(end_time__isnull=True) | models.Q(start_time__lt=models.F('end_time')) | models.Q(end_time=MIDNIGHT),
+                name='booking_start_before_end',
+            ),
+        ]
+
+
+class TrainerGym(models.Model):
+    """
+    Gym where a trainer works, there is a row for every gym the trainer has schedules at.
+
+    Rows are added with schedules and checked against schedules when a schedule is moved to another trainer or gym
+    or deleted, so gyms of trainers are read without scanning schedules. The rebuild_summaries command recomputes them.
+    """
+
+    trainer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='gym_memberships')
+    gym = models.ForeignKey(Gym, on_delete=models.CASCADE, related_name='trainer_memberships')
+
+    def __str__(self) -> str:
+        return f'{self.trainer_id} - {self.gym_id}'
+
+    @classmethod
+    def add_for(cls, schedules):
+        """ Adds gyms of new schedules to their trainers by one INSERT"""
+        pairs = {(schedule.trainer_id, schedule.gym_id) for schedule in schedules}
+        cls.objects.bulk_create([cls(trainer_id=trainer_id, gym_id=gym_id) for trainer_id, gym_id in pairs], ignore_conflicts=True)
+
+    @classmethod
+    def sync(cls, pairs):
+        """ Adds or removes rows of (trainer id, gym id) pairs by whether the trainer has schedules at the gym"""
+        pairs = {(trainer_id, gym_id) for trainer_id, gym_id in pairs if trainer_id is not None and gym_id is not None}
+        if not pairs:
+            return
+        rows = models.Q()
+        for trainer_id, gym_id in pairs:
+            rows |= models.Q(trainer_id=trainer_id, gym_id=gym_id)
+        working = set(Schedule.objects.filter(rows).order_by().values_list('trainer_id', 'gym_id').distinct())
+        if working:
+            cls.objects.bulk_create([cls(trainer_id=trainer_id, gym_id=gym_id) for trainer_id, gym_id in working], ignore_conflicts=True)
+        removed = models.Q()
+        for trainer_id, gym_id in pairs - working:
+            removed |= models.Q(trainer_id=trainer_id, gym_id=gym_id)
+        if removed:
+            cls.objects.filter(removed).delete()
+
+    @classmethod
+    def rebuild(cls, batch_size=2000) -> int:
+        """ Recreates all rows from schedules, returns number of rows"""
+        cls.objects.all().delete()
+        pairs = Schedule.objects.order_by().values_list('trainer_id', 'gym_id').distinct()
+        created = 0
+        rows = []
+        for trainer_id, gym_id in pairs.iterator(chunk_size=batch_size):
+            rows.append(cls(trainer_id=trainer_id, gym_id=gym_id))
+            if len(rows) >= batch_size:
+                created += len(cls.objects.bulk_create(rows))
+                rows = []
+        created += len(cls.objects.bulk_create(rows))
+        return created
+
+    class Meta:
+        verbose_name = _('Trainer gym')
+        verbose_name_plural = _('Trainer gyms')
+        indexes = [
+            # trainers of a gym, the unique constraint serves gyms of a trainer
+            models.Index(fields=['gym', 'trainer'], name='trainer_gym_gym_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['trainer', 'gym'], name='trainer_gym_unique'),
+        ]
+
 
+def hour_overlaps(start_minute, end_minute) -> dict:
+    """ Splits [start, end) minutes of the week by hours, returns minutes in every hour by minute of week when it starts"""
+    overlaps = {}
+    hour_start = start_minute - start_minute % 60
+    while hour_start < end_minute:
+        overlaps[hour_start] = min(end_minute, hour_start + 60) - max(start_minute, hour_start)
+        hour_start += 60
+    return overlaps
+
+
+def booked_by_hour(bookings) -> dict:
+    """ Booked minutes and number of the bookings by (schedule id, minute of the week when the hour starts)
+
+    Bookings are read by one query grouped by schedule and time, so bookings of the same slot are a single row.
+    Used by migrations too, so bookings may be a queryset of a historical model.
+    """
+    booked = {}
+    grouped = bookings.order_by().values_list('schedule_id', 'start_minute', 'end_minute').annotate(count=models.Count('pk'))
+    for schedule_id, start_minute, end_minute, count in grouped.iterator(chunk_size=5000):
+        for hour_start, minutes in hour_overlaps(start_minute, end_minute).items():
+            totals = booked.setdefault((schedule_id, hour_start), [0, 0])
+            totals[0] += minutes * count
+            totals[1] += count
+    return booked
+
+
+class ScheduleHourSummary(models.Model):
+    """
+    Offered and booked minutes of a schedule in one hour of the week, the table analytics are read from.
+
+    Rows are created with the schedule and changed by one UPDATE when bookings are created or deleted, so dashboards
+    aggregate a few rows per schedule whatever the number of bookings is. A dated booking is counted like a weekly one,
+    the numbers describe a usual week. The rebuild_summaries command recomputes the table from bookings.
+    """
+
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='hour_summaries')
+    # copies of the schedule's fields, so summaries are grouped without joins
+    trainer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='hour_summaries')
+    gym = models.ForeignKey(Gym, on_delete=models.CASCADE, related_name='hour_summaries')
+    weekday = models.PositiveSmallIntegerField() # 0 is Monday
+    hour = models.PositiveSmallIntegerField() # hour of the day
+    start_minute = models.PositiveSmallIntegerField() # minutes since Monday 00:00 when the hour starts
+    capacity_minutes = models.PositiveIntegerField(default=0) # capacity multiplied by minutes of the schedule in the hour
+    booked_minutes = models.PositiveIntegerField(default=0)
+    bookings = models.PositiveIntegerField(default=0) # bookings with time in the hour
+
+    def __str__(self) -> str:
+        return f'{self.schedule_id} - {WEEKDAYS[self.weekday]} - {self.hour}:00'
+
+    @classmethod
+    def rows_for(cls, schedule) -> list:
+        return [
+            cls(schedule_id=schedule.pk, trainer_id=schedule.trainer_id, gym_id=schedule.gym_id,
+                weekday=hour_start // MINUTES_IN_DAY, hour=hour_start % MINUTES_IN_DAY // 60, start_minute=hour_start,
+                capacity_minutes=schedule.capacity * minutes)
+            for hour_start, minutes in hour_overlaps(schedule.start_minute, schedule.end_minute).items()
+        ]
+
+    @classmethod
+    def create_for(cls, schedules):
+        """ Creates empty rows of new schedules"""
+        cls.objects.bulk_create([row for schedule in schedules for row in cls.rows_for(schedule)])
+
+    @classmethod
+    def add_bookings(cls, bookings, sign=1, batch_size=200):
+        """ Adds booked time of bookings to their rows (subtracts with sign=-1) by one UPDATE per batch_size rows
+
+        Bookings inserted by bulk_create() must be added too (or summaries rebuilt), deleting them subtracts their time.
+        """
+        deltas = {}
+        for booking in bookings:
+            for hour_start, minutes in hour_overlaps(booking.start_minute, booking.end_minute).items():
+                booked, count = deltas.get((booking.schedule_id, hour_start), (0, 0))
+                deltas[booking.schedule_id, hour_start] = (booked + sign * minutes, count + sign)
+
+        deltas = list(deltas.items())
+        for batch_start in range(0, len(deltas), batch_size):
+            rows = models.Q()
+            booked_minutes, bookings_count = [], []
+            for (schedule_id, hour_start), (booked, count) in deltas[batch_start:batch_start + batch_size]:
+                row = models.Q(schedule_id=schedule_id, start_minute=hour_start)
+                rows |= row
+                booked_minutes.append(models.When(row, then=booked))
+                bookings_count.append(models.When(row, then=count))
+            cls.objects.filter(rows).update(
+                booked_minutes=models.F('booked_minutes') + models.Case(*booked_minutes, default=0),
+                bookings=models.F('bookings') + models.Case(*bookings_count, default=0),
+            )
+
+    @classmethod
+    def rebuild(cls, schedule_ids=None, batch_size=2000) -> int:
+        """ Recreates rows of schedules (all by default) with booked time of booked_by_hour(), returns number of rows"""
+        schedules = Schedule.objects.order_by('pk').only('pk', 'trainer_id', 'gym_id', 'capacity', 'start_minute', 'end_minute')
+        summaries = cls.objects.all()
+        bookings = Booking.objects.all()
+        if schedule_ids is not None:
+            schedules = schedules.filter(pk__in=schedule_ids)
+            summaries = summaries.filter(schedule_id__in=schedule_ids)
+            bookings = bookings.filter(schedule_id__in=schedule_ids)
+
+        booked = booked_by_hour(bookings)
+        summaries.delete()
+        rows = []
+        created = 0
+        for schedule in schedules.iterator(chunk_size=batch_size):
+            for row in cls.rows_for(schedule):
+                row.booked_minutes, row.bookings = booked.get((row.schedule_id, row.start_minute), (0, 0))
+                rows.append(row)
+            if len(rows) >= batch_size:
+                created += len(cls.objects.bulk_create(rows))
+                rows = []
+        created += len(cls.objects.bulk_create(rows))
+        return created
+
+    class Meta:
+        verbose_name = _('Schedule hour summary')
+        verbose_name_plural = _('Schedule hour summaries')
+        # covering indexes of analytics groupings, totals are read from the index without visiting rows
+        indexes = [
+            models.Index(fields=['trainer', 'booked_minutes', 'capacity_minutes', 'bookings'], name='summary_trainer_idx'),
+            models.Index(fields=['gym', 'weekday', 'booked_minutes', 'capacity_minutes', 'bookings'], name='summary_gym_weekday_idx'),
+            models.Index(fields=['weekday', 'hour', 'booked_minutes', 'capacity_minutes', 'bookings'], name='summary_weekday_hour_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'start_minute'], name='summary_schedule_hour_unique'),
+        ]
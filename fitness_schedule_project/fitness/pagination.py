@@ -0,0 +1,120 @@
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
+
+
+class CursorOrPageNumberPagination(CursorPagination):
+    """ Keyset pagination over an indexed ordering, so a page costs one query without COUNT(*) and OFFSET
+
+    The cursor keeps values of all ordering fields of the last (or first, going back) row of the page and the next
+    page is filtered by them, so rows with equal first fields (like schedules starting at the same minute) are
+    neither repeated nor skipped. Fields of the ordering are ascending. Page number pagination (with count of rows)
+    is still used if ?page= is given.
+    """
+    page_number_pagination_class = PageNumberPagination
+
+    def __init__(self):
+        self.page_number_pagination = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_number_pagination = self.page_number_pagination_class()
+        if page_number_pagination.page_query_param in request.query_params:
+            self.page_number_pagination = page_number_pagination
+            return page_number_pagination.paginate_queryset(queryset.order_by(*self.ordering), request, view)
+
+        queryset = self.keyset_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self.set_page(list(queryset[:self.page_size + 1]))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """ Same as paginate_queryset() for async views, the page is fetched with async ORM. ?page= is not supported"""
+        queryset = self.keyset_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self.set_page([item async for item in queryset[:self.page_size + 1]])
+
+    def keyset_queryset(self, queryset, request, view):
+        """ Orders the queryset in the direction of the cursor and filters rows after its position"""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+
+        reverse = self.cursor is not None and self.cursor.reverse
+        queryset = queryset.order_by(*(f'-{field}' for field in self.ordering) if reverse else self.ordering)
+        if self.cursor is not None and self.cursor.position is not None:
+            queryset = queryset.filter(self.after_position(self.cursor.position, reverse))
+        return queryset
+
+    def after_position(self, position, reverse) -> Q:
+        """ (a, b) > (x, y) as a > x or a = x and b > y, with a >= x first, so the index of a is scanned from x"""
+        lookup = 'lt' if reverse else 'gt'
+        after = Q()
+        for index, field in enumerate(self.ordering):
+            after |= Q(**dict(zip(self.ordering[:index], position)), **{f'{field}__{lookup}': position[index]})
+        if len(self.ordering) == 1:
+            return after
+        return Q(**{f'{self.ordering[0]}__{lookup}e': position[0]}) & after
+
+    def set_page(self, results):
+        """ Keeps the page of rows fetched by keyset_queryset() (one more than the page size) and whether there are more"""
+        self.page = results[:self.page_size]
+        has_following_position = len(results) > len(self.page)
+        has_position = self.cursor is not None and self.cursor.position is not None
+        if self.cursor is not None and self.cursor.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = has_position, has_following_position
+        else:
+            self.has_next, self.has_previous = has_following_position, has_position
+        return self.page
+
+    def position_of(self, item) -> list:
+        return [item[field] if isinstance(item, dict) else getattr(item, field) for field in self.ordering]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.position_of(self.page[-1]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=json.dumps(position, default=str)))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.position_of(self.page[0]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=json.dumps(position, default=str)))
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is None or cursor.position is None:
+            return cursor
+        try:
+            position = json.loads(cursor.position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(offset=0, reverse=cursor.reverse, position=position)
+
+    def get_paginated_response(self, data):
+        if self.page_number_pagination is not None:
+            return self.page_number_pagination.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_html_context(self):
+        if self.page_number_pagination is not None:
+            return self.page_number_pagination.get_html_context()
+        return super().get_html_context()
+
+
+class ScheduleCursorPagination(CursorOrPageNumberPagination):
+    ordering = ('start_minute', 'id') # week order
+
+
+class BookingCursorPagination(CursorOrPageNumberPagination):
+    ordering = ('id',)
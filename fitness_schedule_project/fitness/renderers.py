@@ -0,0 +1,26 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+
+class FastJSONRenderer(JSONRenderer):
+    """ JSONRenderer writing JSON by orjson, the output is the same as of JSONRenderer with default settings
+
+    UUID, date, time and datetime are written by orjson, other types which orjson does not know go to DRF's encoder.
+    Indented output (Accept: application/json; indent=4) and data orjson can't write (like too big integers) are
+    rendered by JSONRenderer. Floats in exponent form differ (1e16 instead of 1e+16), NaN is written as null.
+    """
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context) or not (self.ensure_ascii is False and self.compact):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # like JSONRenderer, escape line separators which are not valid in JavaScript strings
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,122 @@
+"""
+Read-through cache of schedule list and retrieve responses.
+
+Cache keys are made of normalized query parameters and version counters of what the response depends on:
+a gym or a trainer (when the list is filtered by them), all schedules (otherwise) or one schedule (retrieve),
+and users and gyms shown in expanded objects. Model signals (see signals.py) bump the counters, so old entries
+are not found anymore and expire by timeout, nothing has to be scanned. Counters are kept in the default cache,
+which is shared by processes (files or Redis, see config/caches.py), so a change made by one worker is seen by
+all of them. With CACHE_PROFILE=local each process would serve its own stale entries.
+"""
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+KEY_PREFIX = 'fitness:schedules'
+
+ALL_SCHEDULES = 'all'
+RELATED = 'related' # users and gyms shown in expanded objects
+
+
+def gym_scope(gym_id):
+    return f'gym:{gym_id}'
+
+
+def trainer_scope(trainer_id):
+    return f'trainer:{trainer_id}'
+
+
+def schedule_scope(schedule_id):
+    return f'schedule:{schedule_id}'
+
+
+def version_key(scope):
+    return f'{KEY_PREFIX}:version:{scope}'
+
+
+def get_versions(scopes):
+    """ Returns current version of every scope, a missing version starts from current time, so it does not repeat an old one"""
+    keys = {version_key(scope): scope for scope in scopes}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, time.time_ns(), timeout=None)
+        versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(scopes):
+    for scope in scopes:
+        try:
+            cache.incr(version_key(scope))
+        except ValueError: # the version is not in the cache
+            cache.set(version_key(scope), time.time_ns(), timeout=None)
+
+
+class CacheStats:
+    """ Hit and miss counters of this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def add(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0}
+
+    def reset(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
+
+stats = CacheStats()
+
+
+def list_scopes(query_params):
+    """ Scopes of a list: filtered gym and trainer, or all schedules"""
+    scopes = []
+    try:
+        if query_params.get('gym'):
+            scopes.append(gym_scope(int(query_params['gym'])))
+        if query_params.get('trainer'):
+            scopes.append(trainer_scope(uuid.UUID(query_params['trainer'])))
+    except ValueError: # the filter will answer with an error, which is not cached
+        return [ALL_SCHEDULES]
+    return scopes or [ALL_SCHEDULES]
+
+
+def response_key(request, name, scopes):
+    """ Key of a response: endpoint, host (links are absolute), sorted non-empty query parameters and versions of scopes"""
+    params = sorted((key, value) for key, values in request.query_params.lists() for value in values if value != '')
+    versions = get_versions([RELATED, *scopes])
+    raw_key = repr((name, request.get_host(), request.is_secure(), params, scopes, versions))
+    return f'{KEY_PREFIX}:response:{hashlib.md5(raw_key.encode()).hexdigest()}'
+
+
+def cached_response(request, name, scopes, get_response):
+    """ Returns response with cached data or gets a new one and puts its data in the cache if it is successful"""
+    key = response_key(request, name, scopes)
+    data = cache.get(key)
+    if data is not None:
+        stats.add(hit=True)
+        response = Response(data)
+        response['X-Cache'] = 'HIT'
+        return response
+
+    stats.add(hit=False)
+    response = get_response()
+    if response.status_code == 200:
+        cache.set(key, response.data, timeout=getattr(settings, 'SCHEDULE_CACHE_TIMEOUT', 300))
+    response['X-Cache'] = 'MISS'
+    return response
@@ -1,47 +1,170 @@
 from rest_framework import serializers
-from .models import CustomUser, Schedule, Booking
+from .instrumentation import TimedRepresentationMixin
+from .models import CustomUser, Gym, Schedule, ScheduleOccurrence, Booking, DAYS_OF_WEEK, minute_of_day, end_minute_of_day
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         # fields = '__all__'
         exclude = ("password", "is_superuser", "is_staff", "groups", "user_permissions")
 
-class UserRegisterSerializer(serializers.ModelSerializer):
+class HashedPasswordMixin:
+    """ Hashes the password before the user is inserted, so registration is one INSERT instead of INSERT and UPDATE"""
+
+    def create(self, validated_data):
+        password = validated_data.pop('password')
+        user = CustomUser(**validated_data)
+        user.set_password(password)
+        user.save()
+        return user
+
+class UserRegisterSerializer(HashedPasswordMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ('id', 'email', 'full_name', 'password', 'role')
         extra_kwargs = {'password': {'write_only': True}, 'role': {'read_only': True}}
 
-class UserTrainerRegisterSerializer(serializers.ModelSerializer):
+class UserTrainerRegisterSerializer(HashedPasswordMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ('id', 'email', 'full_name', 'gender', 'password', 'date_of_birth')
         extra_kwargs = {'password': {'write_only': True}}
 
+class UserImportSerializer(serializers.ModelSerializer):
+    """ A row of bulk import, emails of all rows are checked for uniqueness together (see user_import.py)"""
+    IMPORTED_ROLES = (('client', 'Client'), ('trainer', 'Trainer'))
+
+    password = serializers.CharField(required=False, allow_blank=True, write_only=True) # unusable password if not given
+    role = serializers.ChoiceField(choices=IMPORTED_ROLES, default='client')
+
+    class Meta:
+        model = CustomUser
+        fields = ('email', 'password', 'full_name', 'gender', 'date_of_birth', 'role')
+        # the unique validator would make a query for every row
+        extra_kwargs = {'email': {'validators': []}}
+
 class UserAdditionalInfoSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ('id', 'full_name', 'date_of_birth', 'gender')
         extra_kwargs = {'id': {'read_only': True}}
 
-class ScheduleSerializer(serializers.ModelSerializer):
+class UserShortSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomUser
+        fields = ('id', 'full_name', 'gender')
+
+class GymSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Gym
+        fields = ('id', 'name')
+
+class TrainerDirectorySerializer(TimedRepresentationMixin, serializers.ModelSerializer):
+    """ Trainer with gyms where they work, gyms should be prefetched"""
+    gyms = GymSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = CustomUser
+        fields = ('id', 'full_name', 'gender', 'gyms')
+
+class TrainerSearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(required=False, max_length=100) # beginning of the name or of any word of it
+    gym = serializers.IntegerField(required=False)
+    gender = serializers.ChoiceField(choices=CustomUser.GENDER_OPTION, required=False)
+    limit = serializers.IntegerField(required=False, default=20, min_value=1, max_value=100)
+
+class ExpandableFieldsMixin:
+    """ Replaces id of related object with the object itself if field name is in ?expand= (context['expand'])
+
+    Related objects should be joined in the queryset, see ExpandMixin of views
+    """
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        expand = self.context.get('expand', ())
+        for name, serializer_class in self.expandable_fields.items():
+            if name in expand and name in fields:
+                fields[name] = serializer_class(read_only=True)
+        return fields
+
+class ScheduleSerializer(TimedRepresentationMixin, ExpandableFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'trainer': UserShortSerializer, 'gym': GymSerializer}
+
     class Meta:
         model = Schedule
-        fields = '__all__'
+        exclude = ('weekday', 'start_minute', 'end_minute')
 
 class ScheduleCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Schedule
-        exclude = ('trainer',)
+        exclude = ('trainer', 'weekday', 'start_minute', 'end_minute')
+
+class ScheduleBulkCreateSerializer(ScheduleCreateSerializer):
+    """ Item of weekly schedule, gyms of all items are checked by the view with one query"""
+    gym = serializers.IntegerField(source='gym_id')
+
+    class Meta(ScheduleCreateSerializer.Meta):
+        pass
 
 class ScheduleBookingSerializer(serializers.ModelSerializer):
+    # books one occurrence of the schedule instead of every week
+    date = serializers.DateField(required=False)
+
     class Meta:
         model = Booking
-        fields = ('start_time','end_time',)
+        fields = ('start_time','end_time','date',)
         extra_kwargs = {'start_time': {'required': True}, 'end_time': {'required': True}} 
 
-class BookingSerializer(serializers.ModelSerializer):
+class BatchBookingSerializer(serializers.Serializer):
+    """ One slot of a batch booking, schedules of all slots are loaded by the view with one query"""
+    schedule = serializers.IntegerField()
+    start_time = serializers.TimeField()
+    end_time = serializers.TimeField()
+
+class AvailabilityQuerySerializer(serializers.Serializer):
+    gym = serializers.IntegerField()
+    day_of_week = serializers.ChoiceField(choices=DAYS_OF_WEEK)
+    start_time = serializers.TimeField()
+    end_time = serializers.TimeField()
+
+    def validate(self, data):
+        if minute_of_day(data['start_time']) >= end_minute_of_day(data['end_time']):
+            raise serializers.ValidationError('Start time should be earlier than end time')
+        return data
+
+class CalendarQuerySerializer(serializers.Serializer):
+    MAX_DAYS = 62
+
+    date_from = serializers.DateField()
+    date_to = serializers.DateField()
+    gym = serializers.IntegerField(required=False)
+    trainer = serializers.UUIDField(required=False)
+
+    def validate(self, data):
+        if data['date_from'] > data['date_to']:
+            raise serializers.ValidationError('date_from should not be later than date_to')
+        if (data['date_to'] - data['date_from']).days >= self.MAX_DAYS:
+            raise serializers.ValidationError(f'At most {self.MAX_DAYS} days can be requested at once')
+        return data
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    gym = serializers.IntegerField(required=False)
+    peak_hours = serializers.IntegerField(required=False, default=10, min_value=1, max_value=7 * 24)
+
+class EventStreamQuerySerializer(serializers.Serializer):
+    gym = serializers.IntegerField(required=False)
+    trainer = serializers.UUIDField(required=False)
+    day_of_week = serializers.ChoiceField(choices=DAYS_OF_WEEK, required=False)
+
+class ScheduleOccurrenceSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ScheduleOccurrence
+        fields = ('id', 'schedule', 'trainer', 'gym', 'date', 'start_time', 'end_time')
+
+class BookingSerializer(TimedRepresentationMixin, ExpandableFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'client': UserShortSerializer, 'schedule': ScheduleSerializer}
+
     class Meta:
         model = Booking
-        fields = '__all__'
+        exclude = ('start_minute', 'end_minute')
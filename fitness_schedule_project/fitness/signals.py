@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import events, instrumentation, schedule_cache
+from .authentication import revoke_tokens
+from .availability import availability_index
+from .models import CustomUser, Gym, Schedule, ScheduleHourSummary, TrainerGym, Booking, MINUTES_IN_DAY
+
+
+def on_change_and_commit(callback):
+    """ Runs callback now and once more after commit, in case other request has read old data before the commit"""
+    callback()
+    transaction.on_commit(callback)
+
+
+def event_type(signal_kwargs) -> str:
+    if signal_kwargs['signal'] is post_delete:
+        return 'deleted'
+    return 'created' if signal_kwargs.get('created') else 'changed'
+
+
+def deleted_with_schedule(origin) -> bool:
+    """ Checks origin of a deletion (an instance or a queryset), bookings of deleted schedules and gyms are deleted by cascade"""
+    return getattr(origin, 'model', type(origin)) in (Schedule, Gym)
+
+
+def publish_on_commit(event):
+    # only committed changes are streamed, the event is made now while the instance has its values
+    transaction.on_commit(lambda: events.publish(event))
+
+
+@receiver([post_save, post_delete], sender=Schedule)
+def schedule_changed(sender, instance, **kwargs):
+    schedule_id, gym_id, weekday = instance.pk, instance.gym_id, instance.weekday
+    loaded = getattr(instance, '_loaded_owners', {})
+    cache_scopes = {
+        schedule_cache.ALL_SCHEDULES,
+        schedule_cache.schedule_scope(schedule_id),
+        schedule_cache.gym_scope(gym_id),
+        schedule_cache.gym_scope(loaded.get('gym_id', gym_id)),
+        schedule_cache.trainer_scope(instance.trainer_id),
+        schedule_cache.trainer_scope(loaded.get('trainer_id', instance.trainer_id)),
+    }
+
+    # the schedule may be moved from another gym or day
+    availability_days = {(gym_id, weekday), (loaded.get('gym_id', gym_id), loaded.get('weekday', weekday))}
+
+    def changed():
+        availability_index.schedule_changed(schedule_id, availability_days)
+        schedule_cache.bump_versions(cache_scopes)
+
+    on_change_and_commit(changed)
+    publish_on_commit(events.schedule_event(event_type(kwargs), instance))
+
+
+@receiver(post_delete, sender=Schedule)
+def schedule_deleted(sender, instance, origin=None, **kwargs):
+    # trainer gyms of deleted gyms and trainers are deleted with them
+    if getattr(origin, 'model', type(origin)) not in (Gym, CustomUser):
+        TrainerGym.sync([(instance.trainer_id, instance.gym_id)])
+
+
+@receiver([post_save, post_delete], sender=Booking)
+def booking_changed(sender, instance, **kwargs):
+    schedule_id = instance.schedule_id
+    availability_days = set()
+    # bookings deleted with their schedule are told by the signal of the schedule
+    if not deleted_with_schedule(kwargs.get('origin')):
+        if Booking.schedule.is_cached(instance):
+            gym_id = instance.schedule.gym_id
+        else:
+            gym_id = Schedule.objects.filter(pk=schedule_id).values_list('gym_id', flat=True).first()
+        if gym_id is not None:
+            availability_days.add((gym_id, instance.start_minute // MINUTES_IN_DAY))
+
+    def changed():
+        availability_index.schedule_changed(schedule_id, availability_days)
+        schedule_cache.bump_versions([schedule_cache.schedule_scope(schedule_id)])
+
+    on_change_and_commit(changed)
+    # bookings deleted with their schedule are told by the event of the schedule
+    if not deleted_with_schedule(kwargs.get('origin')):
+        publish_on_commit(events.booking_event(event_type(kwargs), instance))
+
+
+@receiver(post_delete, sender=Booking)
+def booking_deleted(sender, instance, origin=None, **kwargs):
+    # summaries of deleted schedules are deleted with them
+    if not deleted_with_schedule(origin):
+        ScheduleHourSummary.add_bookings([instance], sign=-1)
+
+
+@receiver([post_save, post_delete], sender=Gym)
+def gym_changed(sender, instance, **kwargs):
+    on_change_and_commit(lambda: schedule_cache.bump_versions([schedule_cache.RELATED]))
+
+
+@receiver(post_save, sender=CustomUser)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    if not created and instance.tokens_revoked:
+        # a request of another connection may copy the old time before the commit
+        on_change_and_commit(lambda: revoke_tokens(instance.pk))
+    # name and gender of trainers are shown in expanded schedules
+    if not created and (update_fields is None or {'full_name', 'gender'} & set(update_fields)):
+        on_change_and_commit(lambda: schedule_cache.bump_versions([schedule_cache.RELATED]))
+
+
+@receiver(post_delete, sender=CustomUser)
+def user_deleted(sender, instance, **kwargs):
+    user_id = instance.pk
+    on_change_and_commit(lambda: revoke_tokens(user_id))
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    # wrappers stay on the connection object when it reconnects
+    if instrumentation.query_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrumentation.query_timer)
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
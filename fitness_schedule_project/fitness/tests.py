@@ -1,3 +1,1720 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import uuid
+from datetime import time, timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, is_password_usable
+from django.core.cache import cache, caches
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Sum
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config import database, schema
+
+from . import authentication, events, export, hashing, instrumentation, schedule_cache, throttling, user_import
+from .authentication import FitnessTokenObtainPairSerializer
+from .management.commands.stress_booking import run_booking_stress
+from .availability import availability_index, AvailabilityIndex, DayAvailability, FreeSlot, free_intervals
+from .fast_serializers import ScheduleValuesSerializer, BookingValuesSerializer
+from .filters import ScheduleFilter, BookingFilter
+from .models import CustomUser, Gym, Schedule, ScheduleOccurrence, ScheduleHourSummary, TrainerGym, Booking, MINUTES_IN_DAY, hour_overlaps, max_overlapping, minute_of_week, normalize_name
+from .renderers import FastJSONRenderer
+from .views import ScheduleViewSet, UserViewSet
+
+
+def setUpModule():
+    # file caches are kept between runs, while the test database is created again
+    for alias in caches:
+        caches[alias].clear()
+
+
+class FitnessTestMixin:
+    """ Shared fixtures: one gym, one trainer with schedules on every week day and one client"""
+
+    days_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.gym = Gym.objects.create(name='Gym A')
+        cls.trainer = CustomUser.objects.create_user(email='trainer@example.com', password='password', full_name='Trainer', role='trainer')
+        cls.client_user = CustomUser.objects.create_user(email='client@example.com', password='password', full_name='Client')
+        cls.schedules = {
+            day: Schedule.objects.create(trainer=cls.trainer, gym=cls.gym, day_of_week=day, start_time=time(8, 0), end_time=time(20, 0))
+            for day in cls.days_of_week
+        }
+
+    def api_client(self, user):
+        api_client = APIClient()
+        api_client.force_authenticate(user=user)
+        return api_client
+
+    def book(self, user, schedule, start_time, end_time):
+        return self.api_client(user).post(
+            f'/api/schedules/{schedule.pk}/add_this_schedule/',
+            {'start_time': start_time, 'end_time': end_time},
+            format='json',
+        )
+
+
+class BookingConflictTests(FitnessTestMixin, TestCase):
+
+    def test_booking_on_free_time(self):
+        response = self.book(self.client_user, self.schedules['Monday'], '08:00', '09:00')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Booking.objects.filter(client=self.client_user).count(), 1)
+
+    def test_overlapping_booking_is_rejected(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+
+        response = self.book(self.client_user, self.schedules['Monday'], '11:00', '13:00')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Selected schedule intersects with existing booking')
+
+    def test_booking_times_are_compared_instead_of_schedule_window(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+
+        self.assertEqual(self.book(self.client_user, self.schedules['Monday'], '12:00', '13:00').status_code, 201)
+        self.assertEqual(self.book(self.client_user, self.schedules['Monday'], '08:00', '10:00').status_code, 201)
+
+    def test_other_days_do_not_conflict(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+
+        response = self.book(self.client_user, self.schedules['Tuesday'], '10:00', '12:00')
+
+        self.assertEqual(response.status_code, 201)
+
+    def test_booking_is_rejected_when_schedule_is_full(self):
+        other_client = CustomUser.objects.create_user(email='other@example.com', password='password', full_name='Other')
+        Booking.objects.create(client=other_client, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+
+        response = self.book(self.client_user, self.schedules['Monday'], '11:00', '12:00')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'There are no free places in the schedule at selected time')
+        self.assertEqual(self.book(self.client_user, self.schedules['Monday'], '12:00', '13:00').status_code, 201)
+
+    def test_locked_database_is_reported_as_busy(self):
+        with mock.patch.object(ScheduleViewSet, 'lock_schedule_for_booking', side_effect=OperationalError('database is locked')):
+            response = self.book(self.client_user, self.schedules['Monday'], '08:00', '09:00')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Booking.objects.exists())
+
+    def test_query_count_does_not_grow_with_booking_history(self):
+        """ Regression benchmark for the N+1 conflict check: queries per booking must stay constant"""
+
+        def queries_for_booking(history_size):
+            Booking.objects.filter(client=self.client_user).delete()
+            bookings = [
+                Booking(client=self.client_user, schedule=self.schedules[self.days_of_week[i % 6]], start_time=time(8, 0), end_time=time(9, 0))
+                for i in range(history_size)
+            ]
+            for booking in bookings:
+                booking.sync_minutes()
+            Booking.objects.bulk_create(bookings)
+            ScheduleHourSummary.add_bookings(bookings)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.book(self.client_user, self.schedules['Sunday'], '10:00', '11:00')
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        self.assertEqual(queries_for_booking(5), queries_for_booking(500))
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+
+    def test_parallel_bookings_do_not_overbook_schedule(self):
+        report = run_booking_stress(requests=300, workers=8, clients=40, capacity=3, seed=1)
+
+        self.assertFalse(report['overbooked'])
+        self.assertEqual(report['created'], report['bookings_in_db'])
+        self.assertEqual(report['max_booked_at_once'], 3)
+
+
+class IndexUsageTests(FitnessTestMixin, TestCase):
+    """ Hot queries should be answered by an index, not by a full scan of the table"""
+
+    def assertNoFullScan(self, queryset):
+        if connection.vendor == 'sqlite':
+            plan = queryset.explain()
+            full_scans = [line for line in plan.splitlines() if ' SCAN ' in f' {line} ' and ' USING ' not in line]
+        elif connection.vendor == 'postgresql':
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset.explain()
+            full_scans = [line for line in plan.splitlines() if 'Seq Scan' in line]
+        else:
+            self.skipTest(f'EXPLAIN output of {connection.vendor} is not checked')
+        self.assertEqual(full_scans, [], plan)
+
+    def test_schedule_intersection_check(self):
+        self.assertNoFullScan(Schedule.objects.filter(trainer=self.trainer, start_minute__lt=600, end_minute__gt=540))
+
+    def test_booking_intersection_check(self):
+        self.assertNoFullScan(Booking.objects.filter(client=self.client_user, start_minute__lt=600, end_minute__gt=540))
+
+    def test_schedule_free_place_check(self):
+        self.assertNoFullScan(self.schedules['Monday'].booking_set.filter(start_minute__lt=600, end_minute__gt=540))
+
+    def test_schedule_list_filters(self):
+        self.assertNoFullScan(ScheduleFilter({'gym': self.gym.pk, 'day_of_week': 'Monday'}, queryset=Schedule.objects.all()).qs)
+        self.assertNoFullScan(ScheduleFilter({'day_of_week': 'Monday', 'start_time': '08:00'}, queryset=Schedule.objects.all()).qs)
+
+    def test_booking_list_filters(self):
+        self.assertNoFullScan(BookingFilter({'client': self.client_user.pk}, queryset=Booking.objects.all()).qs)
+        self.assertNoFullScan(BookingFilter({'schedule': self.schedules['Monday'].pk}, queryset=Booking.objects.all()).qs)
+
+
+class ScheduleConstraintTests(FitnessTestMixin, TestCase):
+
+    def test_schedule_should_end_after_start(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Schedule.objects.create(trainer=self.trainer, gym=self.gym, day_of_week='Monday', start_time=time(12, 0), end_time=time(10, 0))
+
+    def test_schedule_can_not_start_in_closed_hours(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Schedule.objects.create(trainer=self.trainer, gym=self.gym, day_of_week='Monday', start_time=time(5, 0), end_time=time(10, 0))
+
+    def test_booking_should_end_after_start(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(12, 0), end_time=time(10, 0))
+
+    def test_schedule_may_end_at_midnight(self):
+        response = self.api_client(self.trainer).post(
+            '/api/schedules/create_schedule/',
+            {'gym': self.gym.pk, 'day_of_week': 'Sunday', 'start_time': '22:00', 'end_time': '00:00'},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        schedule = Schedule.objects.get(pk=response.data['id'])
+        self.assertEqual((schedule.start_minute, schedule.end_minute), (6 * 1440 + 22 * 60, 7 * 1440))
+
+        self.assertEqual(self.book(self.client_user, schedule, '23:00', '00:00').status_code, 201)
+        self.assertEqual(self.book(self.client_user, schedule, '22:00', '23:30').data['error'], 'Selected schedule intersects with existing booking')
+
+        schedule.day_of_week = 'Monday'
+        schedule.save()
+        self.assertEqual(list(schedule.booking_set.values_list('start_minute', 'end_minute')), [(23 * 60, 1440)])
+
+    def test_create_schedule_rejects_closed_hours(self):
+        response = self.api_client(self.trainer).post(
+            '/api/schedules/create_schedule/',
+            {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '00:00', 'end_time': '08:00'},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'The fitness center is closed between 00:00 and 06:00')
+
+
+class MinuteOfWeekTests(FitnessTestMixin, TestCase):
+
+    def test_minutes_are_synced_on_save(self):
+        schedule = self.schedules['Tuesday']
+        booking = Booking.objects.create(client=self.client_user, schedule=schedule, start_time=time(9, 30), end_time=time(11, 0))
+
+        self.assertEqual((schedule.weekday, schedule.start_minute, schedule.end_minute), (1, 1440 + 480, 1440 + 1200))
+        self.assertEqual((booking.start_minute, booking.end_minute), (1440 + 570, 1440 + 660))
+
+        schedule.day_of_week = 'Wednesday'
+        schedule.save()
+        booking.refresh_from_db()
+
+        self.assertEqual((booking.start_minute, booking.end_minute), (2880 + 570, 2880 + 660))
+
+    def test_schedules_are_listed_in_week_order(self):
+        response = self.api_client(self.client_user).get('/api/schedules/')
+
+        self.assertEqual([schedule['day_of_week'] for schedule in response.data['results']], self.days_of_week)
+
+    def test_api_keeps_day_names(self):
+        response = self.api_client(self.client_user).get('/api/schedules/', {'day_of_week': 'Friday'})
+
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(
+            set(response.data['results'][0]),
+            {'id', 'trainer', 'gym', 'day_of_week', 'start_time', 'end_time', 'capacity'},
+        )
+        self.assertEqual(response.data['results'][0]['day_of_week'], 'Friday')
+
+        response = self.api_client(self.trainer).post(
+            '/api/schedules/create_schedule/',
+            {'gym': self.gym.pk, 'day_of_week': 'Sunday', 'start_time': '21:00', 'end_time': '23:00'},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['day_of_week'], 'Sunday')
+        self.assertEqual(Schedule.objects.get(pk=response.data['id']).start_minute, 6 * 1440 + 21 * 60)
+
+    def test_bookings_are_filtered_by_day_name(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(9, 0), end_time=time(10, 0))
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Friday'], start_time=time(9, 0), end_time=time(10, 0))
+
+        response = self.api_client(self.client_user).get('/api/bookings/', {'schedule__day_of_week': 'Friday'})
+
+        self.assertEqual([booking['schedule'] for booking in response.data['results']], [self.schedules['Friday'].pk])
+
+    def test_schedule_change_moves_whole_session_bookings(self):
+        schedule = self.schedules['Monday']
+        whole = Booking.objects.create(client=self.client_user, schedule=schedule)
+        until_noon = Booking.objects.create(client=self.trainer, schedule=schedule, end_time=time(12, 0))
+
+        schedule.day_of_week = 'Tuesday'
+        schedule.start_time, schedule.end_time = time(9, 0), time(18, 0)
+        schedule.save()
+
+        tuesday = minute_of_week('Tuesday', time(0, 0))
+        whole.refresh_from_db()
+        until_noon.refresh_from_db()
+        self.assertEqual((whole.start_minute, whole.end_minute), (tuesday + 9 * 60, tuesday + 18 * 60))
+        self.assertEqual((until_noon.start_minute, until_noon.end_minute), (tuesday + 9 * 60, tuesday + 12 * 60))
+        self.assertEqual(ScheduleHourSummary.objects.filter(schedule=schedule, hour=17).get().bookings, 1)
+
+
+class AvailabilityTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        availability_index.clear()
+
+    def availability(self, start_time, end_time, day_of_week='Monday'):
+        response = self.api_client(self.client_user).get('/api/schedules/availability/', {
+            'gym': self.gym.pk, 'day_of_week': day_of_week, 'start_time': start_time, 'end_time': end_time,
+        })
+        self.assertEqual(response.status_code, 200)
+        return [(slot['schedule_id'], slot['free_from'].isoformat('minutes'), slot['free_to'].isoformat('minutes')) for slot in response.data]
+
+    def test_booked_time_is_not_free(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+        monday = self.schedules['Monday'].pk
+
+        self.assertEqual(self.availability('09:00', '10:00'), [(monday, '08:00', '10:00')])
+        self.assertEqual(self.availability('11:00', '13:00'), [])
+        self.assertEqual(self.availability('18:00', '19:30'), [(monday, '12:00', '20:00')])
+
+    def test_index_is_updated_by_bookings_and_schedules(self):
+        monday = self.schedules['Monday'].pk
+        self.assertEqual(self.availability('18:00', '19:30'), [(monday, '08:00', '20:00')])
+
+        self.book(self.client_user, self.schedules['Monday'], '18:00', '19:00')
+        self.assertEqual(self.availability('18:00', '19:30'), [])
+
+        other_trainer = CustomUser.objects.create_user(email='other-trainer@example.com', password='password', full_name='Other Trainer', role='trainer')
+        evening = Schedule.objects.create(trainer=other_trainer, gym=self.gym, day_of_week='Monday', start_time=time(17, 0), end_time=time(21, 0))
+        self.assertEqual(self.availability('18:00', '19:30'), [(evening.pk, '17:00', '21:00')])
+
+        evening.day_of_week = 'Tuesday'
+        evening.save()
+        self.assertEqual(self.availability('18:00', '19:30'), [])
+        self.assertEqual(self.availability('18:00', '19:30', 'Tuesday'), [(self.schedules['Tuesday'].pk, '08:00', '20:00'), (evening.pk, '17:00', '21:00')])
+
+        Booking.objects.filter(client=self.client_user).delete()
+        self.assertEqual(self.availability('18:00', '19:30'), [(monday, '08:00', '20:00')])
+
+    def test_index_does_not_query_database_for_unchanged_day(self):
+        self.availability('09:00', '10:00')
+
+        with self.assertNumQueries(0):
+            availability_index.free_slots(self.gym.pk, 'Monday', time(9, 0), time(10, 0))
+
+    def test_changes_made_by_other_processes_are_seen(self):
+        other_process = AvailabilityIndex() # signals of this process do not reach its index
+        monday = self.schedules['Monday'].pk
+        free_slots = lambda: [(slot.schedule_id, slot.start_minute % MINUTES_IN_DAY) for slot in other_process.free_slots(self.gym.pk, 'Monday', time(18, 0), time(19, 30))]
+        self.assertEqual(free_slots(), [(monday, 8 * 60)])
+
+        self.book(self.client_user, self.schedules['Monday'], '18:00', '19:00')
+        self.assertEqual(free_slots(), [])
+
+        Booking.objects.filter(client=self.client_user).delete()
+        self.assertEqual(free_slots(), [(monday, 8 * 60)])
+        with self.assertNumQueries(0):
+            free_slots()
+
+        # bulk inserts send no signals
+        booking = Booking(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(18, 0), end_time=time(19, 0))
+        booking.sync_minutes()
+        Booking.objects.bulk_create([booking])
+        availability_index.invalidate()
+        self.assertEqual(free_slots(), [])
+
+    async def test_event_loop_does_not_wait_for_lock_of_index(self):
+        await sync_to_async(self.availability)('09:00', '10:00')
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock(): # like a thread loading another day from the database
+            with availability_index.lock:
+                locked.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait(5)
+        query = asyncio.ensure_future(availability_index.afree_slots(self.gym.pk, 'Monday', time(9, 0), time(10, 0)))
+        await asyncio.sleep(0.05) # the loop runs other tasks meanwhile
+        self.assertFalse(query.done())
+        release.set()
+        self.assertEqual([slot.schedule_id for slot in await query], [self.schedules['Monday'].pk])
+        holder.join()
+
+
+class FreeTimeTests(SimpleTestCase):
+
+    def test_free_intervals_respect_capacity(self):
+        self.assertEqual(free_intervals(0, 100, 1, [(10, 20), (20, 30), (50, 60)]), [(0, 10), (30, 50), (60, 100)])
+        self.assertEqual(free_intervals(0, 100, 2, [(10, 40), (20, 30), (25, 60)]), [(0, 20), (40, 100)])
+        self.assertEqual(free_intervals(0, 100, 1, [(0, 100)]), [])
+
+    def tree_depth(self, node):
+        return 1 + max(self.tree_depth(node.left) if node.left else 0, self.tree_depth(node.right) if node.right else 0)
+
+    def test_availability_index_of_10k_trainers(self):
+        """ 10k trainers working every day of the week in one of 20 gyms, a free slot query walks one path of the
+        tree, so it visits a logarithmic number of nodes and finds the same slots as a full scan"""
+        rnd = random.Random(5)
+        slots = {}
+        schedule_id = 0
+        for trainer_id in range(10000):
+            for weekday in range(7):
+                schedule_id += 1
+                gym_id = rnd.randrange(20)
+                start = weekday * 1440 + rnd.randrange(6 * 60, 18 * 60, 30)
+                end = start + rnd.randrange(120, 360, 30)
+                booked_start = rnd.randrange(start, end - 60, 30)
+                for free_start, free_end in free_intervals(start, end, 1, [(booked_start, booked_start + 60)]):
+                    slots.setdefault((gym_id, weekday), []).append(FreeSlot(schedule_id, trainer_id, free_start, free_end))
+        days = {key: DayAvailability(day_slots) for key, day_slots in slots.items()}
+
+        for key, day in days.items():
+            self.assertLessEqual(self.tree_depth(day.tree), 2 * math.ceil(math.log2(len(slots[key]))))
+
+        found = 0
+        for _ in range(2000):
+            key = rnd.randrange(20), rnd.randrange(7)
+            start = key[1] * 1440 + rnd.randrange(6 * 60, 22 * 60, 30)
+            expected = sorted(
+                (slot for slot in slots[key] if slot.start_minute <= start and slot.end_minute >= start + 90),
+                key=lambda slot: (slot.start_minute, slot.schedule_id),
+            )
+            self.assertEqual(days[key].free_slots(start, start + 90), expected)
+            found += len(expected)
+        self.assertGreater(found, 0)
+
+
+class ListQueryCountTests(FitnessTestMixin, TestCase):
+    """ List endpoints should issue the same number of queries for any number of rows and expanded relations"""
+
+    def add_rows(self, count):
+        for i in range(count):
+            trainer = CustomUser.objects.create_user(email=f'trainer-{uuid.uuid4().hex}@example.com', password=None, full_name=f'Trainer {i}', role='trainer')
+            schedule = Schedule.objects.create(trainer=trainer, gym=self.gym, day_of_week='Saturday', start_time=time(8, 0), end_time=time(10, 0))
+            Booking.objects.create(client=self.client_user, schedule=schedule, start_time=time(8, 0), end_time=time(9, 0))
+
+    def assertConstantQueries(self, url, params=None):
+        api_client = self.api_client(self.client_user)
+        self.add_rows(1)
+
+        with CaptureQueriesContext(connection) as few_rows:
+            self.assertEqual(api_client.get(url, params).status_code, 200)
+        self.add_rows(10)
+        with CaptureQueriesContext(connection) as many_rows:
+            self.assertEqual(api_client.get(url, params).status_code, 200)
+
+        self.assertEqual(len(few_rows), len(many_rows))
+        self.assertEqual(len(many_rows), 1) # cursor pagination does not count rows
+
+    def test_schedule_list(self):
+        self.assertConstantQueries('/api/schedules/')
+
+    def test_expanded_schedule_list(self):
+        self.assertConstantQueries('/api/schedules/', {'expand': 'trainer,gym'})
+
+    def test_booking_list(self):
+        self.assertConstantQueries('/api/bookings/')
+
+    def test_expanded_booking_list(self):
+        self.assertConstantQueries('/api/bookings/', {'expand': 'client,schedule,trainer,gym'})
+
+    def test_own_bookings(self):
+        api_client = self.api_client(self.client_user)
+        self.add_rows(10)
+
+        with self.assertNumQueries(1):
+            response = api_client.get('/api/bookings/get_own_bookings/', {'expand': 'schedule,trainer,gym'})
+
+        self.assertEqual(response.data[0]['schedule']['trainer']['full_name'], 'Trainer 0')
+        self.assertEqual(response.data[0]['schedule']['gym'], {'id': self.gym.pk, 'name': 'Gym A'})
+
+    def test_expanded_representation(self):
+        response = self.api_client(self.client_user).get('/api/schedules/', {'expand': 'trainer,gym', 'day_of_week': 'Monday'})
+        schedule = response.json()['results'][0]
+
+        self.assertEqual(schedule['trainer'], {'id': str(self.trainer.pk), 'full_name': 'Trainer', 'gender': 'male'})
+        self.assertEqual(schedule['gym'], {'id': self.gym.pk, 'name': 'Gym A'})
+
+        response = self.api_client(self.client_user).get('/api/schedules/', {'day_of_week': 'Monday'})
+
+        self.assertEqual(response.data['results'][0]['trainer'], self.trainer.pk)
+
+    def test_admin_changelists(self):
+        admin = CustomUser.objects.create_superuser(email='admin@example.com', password='password')
+        self.client.force_login(admin)
+
+        for url in ('/admin/fitness/schedule/', '/admin/fitness/booking/'):
+            with CaptureQueriesContext(connection) as few_rows:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.add_rows(10)
+            with CaptureQueriesContext(connection) as many_rows:
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+            self.assertEqual(len(few_rows), len(many_rows), url)
+
+
+class PaginationTests(FitnessTestMixin, TestCase):
+
+    def test_schedules_are_paginated_by_cursor_in_week_order(self):
+        for i in range(15):
+            trainer = CustomUser.objects.create_user(email=f'trainer-{i}@example.com', password=None, full_name=f'Trainer {i}', role='trainer')
+            Schedule.objects.create(trainer=trainer, gym=self.gym, day_of_week='Monday', start_time=time(9, 0), end_time=time(10, 0))
+        api_client = self.api_client(self.client_user)
+
+        schedules = []
+        url = '/api/schedules/'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.get(url)
+            self.assertNotIn('count', response.data)
+            self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+            schedules += response.data['results']
+            url = response.data['next']
+
+        self.assertEqual(len(schedules), Schedule.objects.count())
+        self.assertEqual(
+            [schedule['id'] for schedule in schedules],
+            list(Schedule.objects.order_by('start_minute', 'id').values_list('id', flat=True)),
+        )
+
+    def test_cursor_keeps_order_of_schedules_starting_at_same_minute(self):
+        for i in range(25):
+            trainer = CustomUser.objects.create_user(email=f'trainer-{i}@example.com', password=None, full_name=f'Trainer {i}', role='trainer')
+            Schedule.objects.create(trainer=trainer, gym=self.gym, day_of_week='Monday', start_time=time(8, 0), end_time=time(9, 0))
+        api_client = self.api_client(self.client_user)
+        expected = list(Schedule.objects.order_by('start_minute', 'id').values_list('id', flat=True))
+
+        pages = []
+        url = '/api/schedules/'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.get(url)
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries))
+            pages.append([schedule['id'] for schedule in response.data['results']])
+            last_previous, url = response.data['previous'], response.data['next']
+        self.assertEqual([pk for page in pages for pk in page], expected)
+
+        # and back from the last page
+        backwards = [pages[-1]]
+        url = last_previous
+        while url:
+            response = api_client.get(url)
+            backwards.insert(0, [schedule['id'] for schedule in response.data['results']])
+            url = response.data['previous']
+        self.assertEqual(backwards, pages)
+
+    def test_page_number_pagination_is_opt_in(self):
+        response = self.api_client(self.client_user).get('/api/schedules/', {'page': 1})
+
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual([schedule['day_of_week'] for schedule in response.data['results']], self.days_of_week)
+
+        for day in self.days_of_week:
+            Booking.objects.create(client=self.client_user, schedule=self.schedules[day], start_time=time(8, 0), end_time=time(9, 0))
+        response = self.api_client(self.client_user).get('/api/bookings/', {'page': 1})
+
+        self.assertEqual(response.data['count'], 7)
+        self.assertIsNone(response.data['next'])
+
+
+class StatelessAuthenticationTests(FitnessTestMixin, TestCase):
+
+    def token_client(self, email, password='password'):
+        response = APIClient().post('/api/token/', {'email': email, 'password': password}, format='json')
+        self.assertEqual(response.status_code, 200)
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        return api_client, response.data
+
+    def test_token_carries_role_and_needs_no_user_query(self):
+        api_client, tokens = self.token_client('client@example.com')
+
+        self.assertEqual(AccessToken(tokens['access'])['role'], 'client')
+        with self.assertNumQueries(1): # bookings only
+            response = api_client.get('/api/bookings/get_own_bookings/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_refreshed_token_keeps_claims(self):
+        _api_client, tokens = self.token_client('trainer@example.com')
+
+        response = APIClient().post('/api/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+
+        self.assertEqual(AccessToken(response.data['access'])['role'], 'trainer')
+
+    def test_role_change_revokes_tokens(self):
+        api_client, _tokens = self.token_client('client@example.com')
+
+        user = CustomUser.objects.get(pk=self.client_user.pk)
+        user.full_name = 'New Name'
+        user.save()
+        self.assertEqual(api_client.get('/api/bookings/get_own_bookings/').status_code, 200)
+
+        user.role = 'trainer'
+        user.save()
+        self.assertEqual(api_client.get('/api/bookings/get_own_bookings/').status_code, 401)
+
+        api_client, _tokens = self.token_client('client@example.com')
+        self.assertEqual(api_client.get('/api/schedules/get_own_schedule/').status_code, 200)
+
+    def test_deactivation_revokes_tokens(self):
+        api_client, _tokens = self.token_client('client@example.com')
+
+        user = CustomUser.objects.get(pk=self.client_user.pk)
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+
+        self.assertEqual(api_client.get('/api/bookings/get_own_bookings/').status_code, 401)
+
+    def test_revocation_is_kept_in_database(self):
+        api_client, _tokens = self.token_client('client@example.com')
+        user = CustomUser.objects.get(pk=self.client_user.pk)
+        user.role = 'trainer'
+        user.save()
+
+        # culled or evicted copies are read from the database again
+        for alias in caches:
+            caches[alias].clear()
+        authentication.valid_after_times.clear()
+
+        with self.assertNumQueries(1): # tokens_valid_after
+            self.assertEqual(api_client.get('/api/bookings/get_own_bookings/').status_code, 401)
+        self.assertEqual(caches[authentication.TOKENS_CACHE].get(authentication.VALID_AFTER_CACHE_KEY.format(user.pk)), user.tokens_valid_after.timestamp())
+
+    def test_token_without_role_is_checked_in_database(self):
+        token = AccessToken.for_user(self.client_user)
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        with self.assertNumQueries(2): # user and bookings
+            response = api_client.get('/api/bookings/get_own_bookings/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_writing_endpoints_work_with_token_user(self):
+        api_client, _tokens = self.token_client('trainer@example.com')
+
+        response = api_client.post('/api/schedules/create_schedule/', {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '21:00', 'end_time': '22:00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Schedule.objects.get(pk=response.data['id']).trainer, self.trainer)
+
+        response = api_client.post('/api/users/update_additional_info/', {'full_name': 'Renamed Trainer', 'gender': 'female'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CustomUser.objects.get(pk=self.trainer.pk).full_name, 'Renamed Trainer')
+
+        api_client, _tokens = self.token_client('client@example.com')
+        response = api_client.post(f"/api/schedules/{self.schedules['Monday'].pk}/add_this_schedule/", {'start_time': '08:00', 'end_time': '09:00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Booking.objects.get(pk=response.data['booking_id']).client, self.client_user)
+
+
+class SchemaTests(SimpleTestCase):
+
+    def setUp(self):
+        schema.reset_schema_document()
+        self.addCleanup(schema.reset_schema_document)
+        self.api_client = APIClient()
+
+    def test_schema_is_generated_once_and_served_with_etag(self):
+        with override_settings(OPENAPI_SCHEMA_PATH=os.path.join(tempfile.mkdtemp(), 'missing.json')), \
+                mock.patch.object(schema, 'generate_schema', wraps=schema.generate_schema) as generate_schema:
+            response = self.api_client.get('/swagger.json/')
+            self.api_client.get('/swagger/?format=openapi')
+            self.api_client.get('/swagger.yaml/')
+            self.assertEqual(generate_schema.call_count, 1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/schedules/', response.json()['paths'])
+        self.assertTrue(response['ETag'])
+
+        response = self.api_client.get('/swagger.json/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_schema_is_read_from_generated_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'openapi.json')
+        with override_settings(OPENAPI_SCHEMA_PATH=path):
+            schema.write_schema()
+            with mock.patch.object(schema, 'generate_schema') as generate_schema:
+                response = self.api_client.get('/swagger.json/')
+                generate_schema.assert_not_called()
+
+        with open(path, 'rb') as schema_file:
+            self.assertEqual(response.content, schema_file.read())
+
+    def test_assets_are_served_from_static_root(self):
+        static_root = tempfile.mkdtemp()
+        with override_settings(STATIC_ROOT=static_root):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            response = self.client.get('/static/admin/css/base.css')
+            missing = self.client.get('/static/missing.css')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(missing.status_code, 404)
+
+
+class PopulateDbTests(TestCase):
+
+    def test_generated_bookings_respect_capacity_and_clients_time(self):
+        call_command('populate_db', gyms=2, trainers=20, clients=200, bookings_per_client=3, capacity=2, batch_size=50, seed=1, stdout=StringIO())
+
+        self.assertEqual(Gym.objects.count(), 2)
+        self.assertEqual(CustomUser.objects.filter(role='trainer').count(), 20)
+        self.assertEqual(Schedule.objects.count(), 100)
+        self.assertEqual(Booking.objects.count(), 600)
+
+        for schedule in Schedule.objects.prefetch_related('booking_set'):
+            self.assertLessEqual(max_overlapping((booking.start_minute, booking.end_minute) for booking in schedule.booking_set.all()), 2)
+        for client in CustomUser.objects.filter(role='client').prefetch_related('client_bookings'):
+            self.assertLessEqual(max_overlapping((booking.start_minute, booking.end_minute) for booking in client.client_bookings.all()), 1)
+        for trainer in CustomUser.objects.filter(role='trainer').prefetch_related('schedule_set'):
+            self.assertLessEqual(max_overlapping((schedule.start_minute, schedule.end_minute) for schedule in trainer.schedule_set.all()), 1)
+
+        # summaries of bulk inserted rows are kept like of saved ones
+        summary_fields = ('schedule_id', 'start_minute', 'capacity_minutes', 'booked_minutes', 'bookings')
+        summaries = list(ScheduleHourSummary.objects.order_by('schedule_id', 'start_minute').values_list(*summary_fields))
+        self.assertEqual(sum(row[-1] for row in summaries), 600)
+        ScheduleHourSummary.rebuild()
+        self.assertEqual(list(ScheduleHourSummary.objects.order_by('schedule_id', 'start_minute').values_list(*summary_fields)), summaries)
+
+
+class AsyncReadEndpointsTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        availability_index.clear()
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(10, 0), end_time=time(12, 0))
+
+    def token_client(self, user):
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {FitnessTokenObtainPairSerializer.get_token(user).access_token}')
+        return api_client
+
+    def assertSameResponse(self, user, path, params=None):
+        api_client = self.token_client(user)
+        sync_response = api_client.get(f'/api/{path}', params)
+        async_response = api_client.get(f'/api/async/{path}', params)
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        # links of paginated lists point to the async endpoint
+        self.assertEqual(async_response.content.replace(b'/api/async/', b'/api/'), sync_response.content)
+        return async_response
+
+    def test_responses_are_the_same_as_of_sync_endpoints(self):
+        for hour in range(6, 18):
+            Schedule.objects.create(trainer=self.trainer, gym=self.gym, day_of_week='Sunday', start_time=time(hour, 0), end_time=time(hour, 30))
+
+        response = self.assertSameResponse(self.client_user, 'schedules/', {'expand': 'trainer,gym'})
+        response = self.assertSameResponse(self.client_user, response.json()['next'].split('/api/async/')[1])
+        self.assertSameResponse(self.client_user, response.json()['previous'].split('/api/async/')[1])
+        self.assertSameResponse(self.client_user, 'schedules/', {'day_of_week': 'Monday', 'gym': self.gym.pk})
+        self.assertSameResponse(self.client_user, 'schedules/', {'gym': 0})
+        self.assertSameResponse(self.client_user, f"schedules/{self.schedules['Monday'].pk}/", {'expand': 'trainer'})
+        self.assertSameResponse(self.client_user, 'schedules/0/')
+        self.assertSameResponse(self.trainer, 'schedules/get_own_schedule/')
+        self.assertSameResponse(self.client_user, 'schedules/get_own_schedule/')
+        self.assertSameResponse(self.client_user, 'bookings/get_own_bookings/', {'expand': 'schedule,trainer'})
+        self.assertSameResponse(self.trainer, 'bookings/get_own_bookings/')
+        self.assertSameResponse(self.client_user, 'schedules/availability/', {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '12:00', 'end_time': '13:00'})
+        self.assertSameResponse(self.client_user, 'schedules/availability/', {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '13:00', 'end_time': '12:00'})
+
+    def test_authentication_is_required(self):
+        response = APIClient().get('/api/async/schedules/')
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response['WWW-Authenticate'].startswith('Bearer'))
+
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION='Bearer invalid')
+        self.assertEqual(api_client.get('/api/async/schedules/').status_code, 401)
+
+        self.assertEqual(self.token_client(self.client_user).post('/api/async/schedules/').status_code, 405)
+
+    async def test_served_by_async_client(self):
+        token = FitnessTokenObtainPairSerializer.get_token(self.client_user).access_token
+        response = await AsyncClient().get('/api/async/bookings/get_own_bookings/', headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([booking['start_time'] for booking in response.json()], ['10:00:00'])
+
+
+class ScheduleCacheTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schedule_cache.stats.reset()
+        self.other_gym = Gym.objects.create(name='Gym B')
+
+    def get(self, url, params=None):
+        response = self.api_client(self.client_user).get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertCached(self, url, params=None):
+        with self.assertNumQueries(0):
+            response = self.get(url, params)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        return response
+
+    def assertNotCached(self, url, params=None):
+        response = self.get(url, params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        return response
+
+    def test_list_is_cached_by_normalized_parameters(self):
+        response = self.assertNotCached('/api/schedules/', {'gym': self.gym.pk, 'day_of_week': 'Monday'})
+        cached = self.assertCached('/api/schedules/', {'day_of_week': 'Monday', 'gym': self.gym.pk, 'trainer': ''})
+
+        self.assertEqual(cached.data, response.data)
+        self.assertNotCached('/api/schedules/', {'gym': self.gym.pk, 'day_of_week': 'Tuesday'})
+        self.assertEqual(schedule_cache.stats.as_dict(), {'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3})
+
+    def test_schedule_changes_invalidate_only_their_gym(self):
+        self.assertNotCached('/api/schedules/', {'gym': self.gym.pk})
+        self.assertNotCached('/api/schedules/', {'gym': self.other_gym.pk})
+        self.assertNotCached('/api/schedules/')
+
+        schedule = Schedule.objects.create(trainer=self.trainer, gym=self.other_gym, day_of_week='Monday', start_time=time(21, 0), end_time=time(22, 0))
+
+        self.assertCached('/api/schedules/', {'gym': self.gym.pk})
+        self.assertEqual(self.assertNotCached('/api/schedules/', {'gym': self.other_gym.pk}).data['results'][0]['id'], schedule.pk)
+        self.assertNotCached('/api/schedules/')
+
+        # the schedule is moved, so lists of both gyms are changed
+        schedule = Schedule.objects.get(pk=schedule.pk)
+        schedule.gym = self.gym
+        schedule.save()
+
+        self.assertIn(schedule.pk, [item['id'] for item in self.assertNotCached('/api/schedules/', {'gym': self.gym.pk, 'day_of_week': 'Monday'}).data['results']])
+        self.assertEqual(self.assertNotCached('/api/schedules/', {'gym': self.other_gym.pk}).data['results'], [])
+
+    def test_retrieve_is_invalidated_by_schedule_and_booking_changes(self):
+        schedule = self.schedules['Monday']
+        url = f'/api/schedules/{schedule.pk}/'
+        self.assertNotCached(url)
+        self.assertCached(url)
+
+        Booking.objects.create(client=self.client_user, schedule=schedule, start_time=time(10, 0), end_time=time(11, 0))
+        self.assertNotCached(url)
+
+        schedule.capacity = 3
+        schedule.save()
+        self.assertEqual(self.assertNotCached(url).data['capacity'], 3)
+
+    def test_trainer_changes_invalidate_expanded_lists(self):
+        params = {'gym': self.gym.pk, 'expand': 'trainer'}
+        self.assertNotCached('/api/schedules/', params)
+
+        self.trainer.full_name = 'Renamed Trainer'
+        self.trainer.save(update_fields=['full_name'])
+
+        self.assertEqual(self.assertNotCached('/api/schedules/', params).data['results'][0]['trainer']['full_name'], 'Renamed Trainer')
+
+    def test_cache_stats_are_only_for_admins(self):
+        self.assertEqual(self.api_client(self.client_user).get('/api/schedules/cache_stats/').status_code, 403)
+
+        admin = CustomUser.objects.create_superuser(email='admin@example.com', password='password')
+        response = self.api_client(admin).get('/api/schedules/cache_stats/')
+        self.assertEqual(response.data, {'hits': 0, 'misses': 0, 'hit_ratio': 0})
+
+
+class BulkScheduleCreationTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        self.other_gym = Gym.objects.create(name='Gym B')
+        self.other_trainer = CustomUser.objects.create_user(email='other-trainer@example.com', password='password', full_name='Other Trainer', role='trainer')
+
+    def create_schedules(self, items, user=None):
+        return self.api_client(user or self.other_trainer).post('/api/schedules/create_schedules/', items, format='json')
+
+    def test_week_is_created_in_several_gyms_with_constant_queries(self):
+        items = [
+            {'gym': self.gym.pk if i % 2 else self.other_gym.pk, 'day_of_week': day, 'start_time': '08:00', 'end_time': '12:00'}
+            for i, day in enumerate(self.days_of_week)
+        ] + [{'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '14:00', 'end_time': '18:00', 'capacity': 4}]
+        availability_index.free_slots(self.gym.pk, 'Monday', time(15, 0), time(16, 0))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.create_schedules(items)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 8)
+        self.assertEqual(self.other_trainer.schedule_set.count(), 8)
+        self.assertEqual(self.other_trainer.schedule_set.get(start_time=time(14, 0)).capacity, 4)
+        self.assertLessEqual(len(queries), 9) # savepoint, lock, gyms, schedules, insert, occurrences, summaries, trainer gyms, release
+        self.assertIn(self.other_trainer.schedule_set.get(start_time=time(14, 0)).pk,
+                      [slot.schedule_id for slot in availability_index.free_slots(self.gym.pk, 'Monday', time(15, 0), time(16, 0))])
+
+    def test_invalid_items_are_reported_and_nothing_is_created(self):
+        Schedule.objects.create(trainer=self.other_trainer, gym=self.gym, day_of_week='Friday', start_time=time(10, 0), end_time=time(12, 0))
+
+        response = self.create_schedules([
+            {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '08:00', 'end_time': '12:00'},
+            {'gym': self.other_gym.pk, 'day_of_week': 'Monday', 'start_time': '11:00', 'end_time': '13:00'},
+            {'gym': self.gym.pk, 'day_of_week': 'Tuesday', 'start_time': '05:00', 'end_time': '07:00'},
+            {'gym': self.gym.pk, 'day_of_week': 'Wednesday', 'start_time': '09:00', 'end_time': '08:00'},
+            {'gym': self.gym.pk, 'day_of_week': 'Friday', 'start_time': '11:00', 'end_time': '13:00'},
+            {'gym': 0, 'day_of_week': 'Saturday', 'start_time': '08:00', 'end_time': '12:00'},
+            {'gym': self.gym.pk, 'day_of_week': 'Sunday', 'start_time': '08:00', 'end_time': '12:00'},
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, [
+            {'error': 'The schedule intersects with schedule 1 of the request'},
+            {'error': 'The schedule intersects with schedule 0 of the request'},
+            {'error': 'The fitness center is closed between 00:00 and 06:00'},
+            {'error': 'Start time of the schedule should be earlier than end time'},
+            {'error': 'The schedule intersects with another schedule of the same trainer'},
+            {'gym': ['Invalid pk "0" - object does not exist.']},
+            {},
+        ])
+        self.assertEqual(self.other_trainer.schedule_set.count(), 1)
+
+    def test_field_errors_and_permissions(self):
+        response = self.create_schedules([{'gym': self.gym.pk, 'day_of_week': 'Someday', 'start_time': '08:00', 'end_time': '12:00'}, {}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data[0]), {'day_of_week'})
+        self.assertEqual(set(response.data[1]), {'gym', 'start_time', 'end_time'})
+
+        self.assertEqual(self.create_schedules([]).status_code, 400)
+        self.assertEqual(self.create_schedules([{'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '08:00', 'end_time': '12:00'}], user=self.client_user).status_code, 403)
+
+
+class BatchBookingTests(FitnessTestMixin, TestCase):
+
+    def add_schedules(self, slots, user=None):
+        return self.api_client(user or self.client_user).post('/api/schedules/add_schedules/', slots, format='json')
+
+    def slot(self, day, start_time, end_time):
+        return {'schedule': self.schedules[day].pk, 'start_time': start_time, 'end_time': end_time}
+
+    def test_number_of_queries_does_not_depend_on_number_of_slots(self):
+        with CaptureQueriesContext(connection) as few_slots:
+            response = self.add_schedules([self.slot('Monday', '08:00', '09:00')])
+        self.assertEqual(response.status_code, 201)
+
+        with CaptureQueriesContext(connection) as many_slots:
+            response = self.add_schedules([self.slot(day, '10:00', '11:30') for day in self.days_of_week])
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(len(few_slots), len(many_slots))
+        self.assertEqual(Booking.objects.filter(client=self.client_user).count(), 8)
+        details = response.data['bookings'][0]['booking_details']
+        self.assertEqual((details['week_day'], details['start_time'], details['trainer_full_name']), ('Monday', time(10, 0), 'Trainer'))
+
+    def test_invalid_slots_are_reported_and_nothing_is_booked(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Friday'], start_time=time(10, 0), end_time=time(12, 0))
+        other_client = CustomUser.objects.create_user(email='other-client@example.com', password='password', full_name='Other Client')
+        Booking.objects.create(client=other_client, schedule=self.schedules['Saturday'], start_time=time(8, 0), end_time=time(10, 0))
+
+        response = self.add_schedules([
+            self.slot('Monday', '08:00', '10:00'),
+            self.slot('Monday', '09:00', '11:00'),
+            self.slot('Tuesday', '08:00', '08:30'),
+            self.slot('Wednesday', '07:00', '09:00'),
+            {'schedule': 0, 'start_time': '08:00', 'end_time': '09:00'},
+            self.slot('Friday', '11:00', '13:00'),
+            self.slot('Saturday', '09:00', '10:00'),
+            self.slot('Sunday', '08:00', '09:00'),
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, [
+            {},
+            {'error': 'Selected schedule intersects with slot 0 of the request'},
+            {'error': 'Selected booking gym time is not at least 1 hour'},
+            {'error': "Selected booking gym time is not within the schedule's time range. Please select time between 08:00:00 and 20:00:00"},
+            {'error': 'Schedule does not exist'},
+            {'error': 'Selected schedule intersects with existing booking'},
+            {'error': 'There are no free places in the schedule at selected time'},
+            {},
+        ])
+        self.assertEqual(Booking.objects.filter(client=self.client_user).count(), 1)
+
+    def test_capacity_counts_slots_of_the_same_request(self):
+        schedule = self.schedules['Monday']
+        schedule.capacity = 2
+        schedule.save()
+        other_client = CustomUser.objects.create_user(email='other-client@example.com', password='password', full_name='Other Client')
+        Booking.objects.create(client=other_client, schedule=schedule, start_time=time(8, 0), end_time=time(10, 0))
+
+        self.assertEqual(self.add_schedules([self.slot('Monday', '08:00', '09:00')]).status_code, 201)
+        self.assertEqual(self.add_schedules([self.slot('Monday', '09:00', '10:00')], user=self.trainer).status_code, 403)
+
+        third_client = CustomUser.objects.create_user(email='third-client@example.com', password='password', full_name='Third Client')
+        response = self.add_schedules([self.slot('Monday', '08:00', '09:00'), self.slot('Monday', '09:00', '10:00')], user=third_client)
+        self.assertEqual(response.data, [{'error': 'There are no free places in the schedule at selected time'}, {}])
+
+    def test_locked_database_is_reported_as_busy(self):
+        with mock.patch.object(ScheduleViewSet, 'lock_schedules_for_booking', side_effect=OperationalError('database is locked')):
+            response = self.add_schedules([self.slot('Monday', '08:00', '09:00')])
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class ScheduleOccurrenceTests(FitnessTestMixin, TestCase):
+
+    def next_date(self, day, weeks=0):
+        today = timezone.localdate()
+        return today + timedelta(days=(self.days_of_week.index(day) - today.weekday()) % 7 + 7 * weeks)
+
+    def book_date(self, user, schedule, date, start_time, end_time):
+        return self.api_client(user).post(
+            f'/api/schedules/{schedule.pk}/add_this_schedule/',
+            {'start_time': start_time, 'end_time': end_time, 'date': date.isoformat()},
+            format='json',
+        )
+
+    def test_command_materializes_only_missing_dates(self):
+        self.assertEqual(ScheduleOccurrence.objects.count(), 7 * 4) # created on save for 28 days
+        self.schedules['Monday'].occurrences.filter(date=self.next_date('Monday', weeks=1)).delete()
+
+        out = StringIO()
+        call_command('materialize_occurrences', stdout=out)
+        self.assertIn('1 created', out.getvalue())
+
+        call_command('materialize_occurrences', '--days', '35', stdout=out)
+        self.assertIn('7 created', out.getvalue())
+        self.assertEqual(self.schedules['Monday'].occurrences.count(), 5)
+
+    def test_schedule_change_moves_future_occurrences(self):
+        schedule = self.schedules['Monday']
+        client_booking = Booking.objects.create(client=self.client_user, schedule=schedule,
+                                                occurrence=schedule.occurrences.get(date=self.next_date('Monday')))
+
+        schedule.day_of_week = 'Tuesday'
+        schedule.start_time = time(9, 0)
+        schedule.save()
+
+        dates = list(schedule.occurrences.values_list('date', flat=True))
+        self.assertEqual(len(dates), 4)
+        self.assertTrue(all(date.weekday() == 1 for date in dates))
+        self.assertFalse(schedule.occurrences.exclude(start_time=time(9, 0)).exists())
+        self.assertFalse(Booking.objects.filter(pk=client_booking.pk).exists())
+
+    def test_moving_schedule_cancels_dated_bookings_loudly(self):
+        schedule = self.schedules['Monday']
+        self.assertEqual(self.book_date(self.client_user, schedule, self.next_date('Monday'), '10:00', '11:00').status_code, 201)
+        client_booking = Booking.objects.get(client=self.client_user)
+
+        schedule = Schedule.objects.get(pk=schedule.pk)
+        schedule.day_of_week = 'Tuesday'
+        with self.assertRaises(ValidationError) as error:
+            schedule.full_clean()
+        self.assertIn('day_of_week', error.exception.message_dict)
+
+        with mock.patch.object(events.broker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule.save()
+        self.assertEqual([booking.pk for booking in schedule.cancelled_bookings], [client_booking.pk])
+        deleted = [call.args[0] for call in publish.call_args_list if call.args[0].type == 'booking.deleted']
+        self.assertEqual([event.data['booking'] for event in deleted], [client_booking.pk])
+        self.assertEqual(ScheduleHourSummary.objects.filter(schedule=schedule).aggregate(total=Sum('bookings'))['total'], 0)
+
+        schedule.day_of_week = 'Wednesday'
+        schedule.full_clean() # nothing is booked anymore
+
+    def test_capacity_and_conflicts_are_checked_per_date(self):
+        other_client = CustomUser.objects.create_user(email='other-client@example.com', password='password', full_name='Other Client')
+        schedule = self.schedules['Monday']
+        first, second = self.next_date('Monday'), self.next_date('Monday', weeks=1)
+
+        response = self.book_date(self.client_user, schedule, first, '10:00', '11:00')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['booking_details']['date'], first)
+        self.assertEqual(self.book_date(self.client_user, schedule, second, '10:00', '11:00').status_code, 201)
+
+        response = self.book_date(other_client, schedule, first, '10:00', '11:00')
+        self.assertEqual(response.data['error'], 'There are no free places in the schedule at selected time')
+        # a weekly booking needs a free place at every date
+        self.assertEqual(self.book(other_client, schedule, '10:00', '11:00').status_code, 400)
+
+        response = self.book_date(other_client, schedule, self.next_date('Tuesday'), '10:00', '11:00')
+        self.assertEqual(response.data['error'], 'The schedule has no session on selected date')
+        # missing dates within the horizon are created on booking, later ones are not booked
+        schedule.occurrences.filter(date=self.next_date('Monday', weeks=3)).delete()
+        self.assertEqual(self.book_date(other_client, schedule, self.next_date('Monday', weeks=3), '10:00', '11:00').status_code, 201)
+        with self.assertNumQueries(0):
+            response = self.book_date(other_client, schedule, self.next_date('Monday', weeks=10), '10:00', '11:00')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Sessions can be booked at most 28 days ahead')
+        self.assertFalse(schedule.occurrences.filter(date=self.next_date('Monday', weeks=10)).exists())
+
+    def test_calendars_are_queried_by_date_range(self):
+        date_from = self.next_date('Monday')
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Tuesday'], start_time=time(8, 0), end_time=time(9, 0))
+        self.book_date(self.client_user, self.schedules['Monday'], date_from + timedelta(days=7), '10:00', '11:00')
+
+        response = self.api_client(self.client_user).get('/api/schedules/calendar/', {
+            'date_from': date_from.isoformat(), 'date_to': (date_from + timedelta(days=6)).isoformat(), 'gym': self.gym.pk,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['schedule'] for item in response.data], [self.schedules[day].pk for day in self.days_of_week])
+
+        with self.assertNumQueries(2): # dated and weekly bookings
+            response = self.api_client(self.client_user).get('/api/bookings/calendar/', {
+                'date_from': date_from.isoformat(), 'date_to': (date_from + timedelta(days=13)).isoformat(),
+            })
+        self.assertEqual([item['date'] for item in response.data],
+                         [date_from + timedelta(days=1), date_from + timedelta(days=7), date_from + timedelta(days=8)])
+
+        response = self.api_client(self.client_user).get('/api/schedules/calendar/', {'date_from': '2026-01-01', 'date_to': '2026-12-31'})
+        self.assertEqual(response.status_code, 400)
+
+
+
+class ExportTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user(email='admin@example.com', password='password', role='admin')
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(8, 0), end_time=time(9, 0))
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Friday'])
+
+    def export(self, path, user=None, **params):
+        response = self.api_client(user or self.admin).get(path, params)
+        if not response.streaming:
+            return response, None
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_bookings_are_streamed_as_csv_with_one_query(self):
+        with self.assertNumQueries(1):
+            response, content = self.export('/api/bookings/export/')
+
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('filename="bookings.csv"', response['Content-Disposition'])
+        header, monday, friday = content.splitlines()
+        self.assertEqual(header, 'id,client_id,schedule_id,occurrence_id,start_time,end_time')
+        self.assertTrue(monday.endswith(f'{self.schedules["Monday"].pk},,08:00:00,09:00:00'))
+        self.assertTrue(friday.endswith(f'{self.schedules["Friday"].pk},,,'))
+
+    def test_schedules_are_filtered_and_streamed_as_ndjson(self):
+        response, content = self.export('/api/schedules/export/', export_format='ndjson', gym=self.gym.pk, day_of_week='Tuesday')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(rows, [{
+            'id': self.schedules['Tuesday'].pk, 'trainer_id': str(self.trainer.pk), 'gym_id': self.gym.pk, 'day_of_week': 'Tuesday',
+            'start_time': '08:00:00', 'end_time': '20:00:00', 'capacity': 1,
+        }])
+
+        _response, content = self.export('/api/schedules/export/', export_format='ndjson')
+        self.assertEqual(len(content.splitlines()), 7)
+
+    async def test_chunks_are_sent_one_by_one_under_asgi(self):
+        token = FitnessTokenObtainPairSerializer.get_token(self.admin).access_token
+        response = await AsyncClient().get('/api/bookings/export/', headers={'Authorization': f'Bearer {token}'})
+
+        self.assertTrue(response.is_async) # a sync iterator would be read to the end before sending
+        content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(len(content.splitlines()), 3)
+
+    def test_rows_are_written_in_chunks(self):
+        rows = ({'id': i} for i in range(5))
+        self.assertEqual(list(export.csv_chunks(rows, ('id',), chunk_size=2)), ['id\r\n0\r\n1\r\n', '2\r\n3\r\n', '4\r\n'])
+
+    def test_errors(self):
+        self.assertEqual(self.export('/api/bookings/export/', user=self.client_user)[0].status_code, 403)
+        self.assertEqual(APIClient().get('/api/bookings/export/').status_code, 401)
+        self.assertEqual(self.export('/api/bookings/export/', export_format='xml')[0].status_code, 400)
+
+
+class InstrumentationTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        instrumentation.metrics.reset()
+
+    def test_endpoints_stay_within_query_budgets(self):
+        trainer, client_user = self.api_client(self.trainer), self.api_client(self.client_user)
+        monday = self.schedules['Monday']
+        responses = [
+            client_user.get('/api/schedules/', {'expand': 'trainer,gym', 'gym': self.gym.pk}),
+            client_user.get(f'/api/schedules/{monday.pk}/'),
+            trainer.get('/api/schedules/get_own_schedule/'),
+            client_user.get('/api/schedules/availability/', {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '08:00', 'end_time': '09:00'}),
+            client_user.get('/api/schedules/calendar/', {'date_from': '2026-11-02', 'date_to': '2026-11-08'}),
+            client_user.post(f'/api/schedules/{monday.pk}/add_this_schedule/', {'start_time': '08:00', 'end_time': '09:00'}, format='json'),
+            client_user.post('/api/schedules/add_schedules/', [{'schedule': monday.pk, 'start_time': '10:00', 'end_time': '11:00'}], format='json'),
+            trainer.post('/api/schedules/create_schedule/', {'gym': self.gym.pk, 'day_of_week': 'Monday', 'start_time': '21:00', 'end_time': '22:00'}, format='json'),
+            trainer.post('/api/schedules/create_schedules/', [{'gym': self.gym.pk, 'day_of_week': 'Tuesday', 'start_time': '21:00', 'end_time': '22:00'}], format='json'),
+            client_user.get('/api/bookings/', {'expand': 'schedule'}),
+            client_user.get('/api/bookings/get_own_bookings/'),
+            client_user.get('/api/bookings/calendar/', {'date_from': '2026-11-02', 'date_to': '2026-11-08'}),
+            APIClient().post('/api/users/register/', {'email': 'new@example.com', 'password': 'password'}, format='json'),
+        ]
+        for response in responses:
+            self.assertLess(response.status_code, 300, response.request_view)
+            instrumentation.assert_query_budget(response)
+
+    def test_timings_are_sent_and_aggregated(self):
+        response = self.api_client(self.trainer).get('/api/schedules/get_own_schedule/')
+
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries", serializer;dur=[\d.]+, app;dur=[\d.]+$')
+        self.assertGreater(response.request_timings.serializer_time, 0)
+
+        content = self.client.get('/metrics').content.decode()
+        self.assertIn('fitness_http_requests_total{view="schedule-get-own-schedule",method="GET",status="200"} 1', content)
+        self.assertIn('fitness_http_request_queries_bucket{view="schedule-get-own-schedule",le="1"} 1', content)
+        self.assertIn('fitness_http_request_duration_seconds_count{view="schedule-get-own-schedule"} 1', content)
+        self.assertIn('fitness_schedule_cache_requests_total{result="hit"}', content)
+
+    @override_settings(QUERY_BUDGETS={'schedule-get-own-schedule': 0})
+    def test_exceeded_budget_is_logged_and_counted(self):
+        with self.assertLogs('fitness.requests', 'WARNING') as logs:
+            response = self.api_client(self.trainer).get('/api/schedules/get_own_schedule/')
+
+        self.assertIn('view=schedule-get-own-schedule method=GET status=200', logs.output[0])
+        with self.assertRaisesMessage(AssertionError, 'made 1 queries, its budget is 0'):
+            instrumentation.assert_query_budget(response)
+        self.assertEqual(instrumentation.metrics.budget_exceeded['schedule-get-own-schedule'], 1)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.1'])
+    def test_metrics_are_limited_to_allowed_addresses(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    def test_metrics_are_local_by_default(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200) # the test client comes from 127.0.0.1
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5').status_code, 403)
+
+    async def test_async_views_are_measured(self):
+        token = FitnessTokenObtainPairSerializer.get_token(self.trainer).access_token
+        response = await AsyncClient().get('/api/async/schedules/get_own_schedule/', headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.request_timings.queries, 1) # the query is made in a thread of sync_to_async
+        instrumentation.assert_query_budget(response)
+
+
+class BenchmarkTests(TestCase):
+
+    def run_benchmark(self, *args):
+        out = StringIO()
+        call_command('benchmark', '--iterations', '3', '--warmup', '1', '--trainers', '3', '--clients', '10',
+                     '--scenario', 'schedule_list', '--scenario', 'add_this_schedule', *args, stdout=out)
+        return out.getvalue()
+
+    def test_results_are_compared_with_baseline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline_path = os.path.join(directory, 'baseline.json')
+            self.assertIn('Baseline written', self.run_benchmark('--baseline', baseline_path, '--save-baseline'))
+
+            with open(baseline_path) as baseline_file:
+                baseline = json.load(baseline_file)
+            self.assertEqual(set(baseline), {'schedule_list', 'add_this_schedule'})
+            self.assertEqual(baseline['add_this_schedule']['errors'], 0)
+            self.assertLessEqual(baseline['schedule_list']['p50_ms'], baseline['schedule_list']['p99_ms'])
+
+            self.assertIn('No regressions', self.run_benchmark('--baseline', baseline_path, '--tolerance', '100'))
+
+            baseline['add_this_schedule']['max_queries'] -= 1
+            with open(baseline_path, 'w') as baseline_file:
+                json.dump(baseline, baseline_file)
+            with self.assertRaisesMessage(CommandError, 'add_this_schedule: '):
+                self.run_benchmark('--baseline', baseline_path, '--tolerance', '100')
+
+        # the seeded dataset is rolled back
+        self.assertFalse(Gym.objects.exists())
+
+
+class FastSerializationTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], start_time=time(8, 0, 0, 500), end_time=time(9, 0))
+        monday = self.schedules['Monday'].occurrences.first()
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Monday'], occurrence=monday)
+        CustomUser.objects.filter(pk=self.client_user.pk).update(full_name='Клиент   "quoted"')
+
+    def assertSameBody(self, values_serializer_class, queryset, expand):
+        context = {'expand': expand}
+        expected = JSONRenderer().render(values_serializer_class.serializer_class(queryset.select_related(), many=True, context=context).data)
+        rows = values_serializer_class.values(queryset, expand)
+        self.assertEqual(FastJSONRenderer().render(values_serializer_class(rows, many=True, context=context).data), expected)
+
+    def test_values_serializers_render_the_same_bytes_as_model_serializers(self):
+        for expand in [set(), {'trainer'}, {'gym'}, {'trainer', 'gym'}]:
+            with self.subTest(expand=expand):
+                self.assertSameBody(ScheduleValuesSerializer, Schedule.objects.order_by('id'), expand)
+
+        for expand in [set(), {'client'}, {'schedule'}, {'client', 'schedule', 'trainer', 'gym'}]:
+            with self.subTest(expand=expand):
+                self.assertSameBody(BookingValuesSerializer, Booking.objects.order_by('id'), expand)
+
+    def test_renderer_writes_the_same_bytes_as_drf(self):
+        data = {
+            'uuid': uuid.uuid4(), 'time': time(8, 0, 0, 120), 'date': timezone.localdate(), 'aware': timezone.now(),
+            'local': timezone.localtime(), 'decimal': Decimal('1.50'), 'text': 'Кириллица    "q" \\ \n \x01',
+            'lazy': gettext_lazy('Schedule'), 'numbers': [0, -1, 0.5, 1 / 3, 2 ** 70, True, None], 'nested': {1: ('a', {'b'})},
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'), JSONRenderer().render(data, 'application/json; indent=2'))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_microbenchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_serializers', '--rows', '20', '--repeat', '2', stdout=out)
+        self.assertIn('ScheduleSerializer + JSONRenderer', out.getvalue())
+        self.assertIn('us per 1000 rows', out.getvalue())
+
+
+class AnalyticsTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user(email='admin@example.com', password='password', role='admin')
+
+    def summaries(self):
+        return list(ScheduleHourSummary.objects.order_by('schedule_id', 'start_minute').values(
+            'schedule_id', 'trainer_id', 'gym_id', 'weekday', 'hour', 'start_minute', 'capacity_minutes', 'booked_minutes', 'bookings'))
+
+    def test_time_is_split_by_hours(self):
+        self.assertEqual(hour_overlaps(630, 765), {600: 30, 660: 60, 720: 45})
+        self.assertEqual(hour_overlaps(480, 540), {480: 60})
+
+    def test_incremental_summaries_match_rebuild(self):
+        monday, tuesday, wednesday = self.schedules['Monday'], self.schedules['Tuesday'], self.schedules['Wednesday']
+        self.assertEqual(self.book(self.client_user, monday, '10:30', '12:00').status_code, 201)
+        response = self.api_client(self.client_user).post('/api/schedules/add_schedules/', [
+            {'schedule': tuesday.pk, 'start_time': '08:00', 'end_time': '09:00'},
+            {'schedule': wednesday.pk, 'start_time': '09:15', 'end_time': '10:45'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        Booking.objects.create(client=self.client_user, schedule=self.schedules['Friday'])
+        Booking.objects.filter(schedule=tuesday).delete()
+        wednesday.day_of_week, wednesday.capacity = 'Sunday', 3
+        wednesday.save()
+
+        monday_hours = {row.hour: row for row in monday.hour_summaries.all()}
+        self.assertEqual(len(monday_hours), 12)
+        self.assertEqual((monday_hours[10].booked_minutes, monday_hours[11].booked_minutes, monday_hours[12].booked_minutes), (30, 60, 0))
+        self.assertEqual(monday_hours[10].capacity_minutes, 60)
+        self.assertFalse(tuesday.hour_summaries.exclude(booked_minutes=0, bookings=0).exists())
+        self.assertEqual(wednesday.hour_summaries.get(hour=9).weekday, 6)
+
+        incremental = self.summaries()
+        out = StringIO()
+        call_command('rebuild_summaries', stdout=out)
+        self.assertIn(f'{7 * 12} summaries and 1 trainer gyms rebuilt', out.getvalue())
+        self.assertEqual(self.summaries(), incremental)
+
+        monday.delete()
+        self.assertEqual(ScheduleHourSummary.objects.count(), 6 * 12)
+
+    def test_analytics_are_read_from_summaries(self):
+        self.book(self.client_user, self.schedules['Monday'], '10:00', '12:00')
+        other_client = CustomUser.objects.create_user(email='other-client@example.com', password='password')
+        self.book(other_client, self.schedules['Tuesday'], '10:30', '11:30')
+
+        response = self.api_client(self.admin).get('/api/schedules/analytics/', {'gym': self.gym.pk, 'peak_hours': 2})
+        self.assertEqual(response.status_code, 200)
+        instrumentation.assert_query_budget(response)
+
+        trainer, = response.data['trainers']
+        self.assertEqual(trainer, {'trainer': self.trainer.pk, 'full_name': 'Trainer', 'booked_hours': 3.0, 'capacity_hours': 84.0, 'occupancy': 0.0357})
+        gyms = response.data['gyms']
+        self.assertEqual([row['day_of_week'] for row in gyms], self.days_of_week)
+        self.assertEqual((gyms[0]['booked_hours'], gyms[0]['occupancy']), (2.0, 0.1667))
+        self.assertEqual(response.data['peak_hours'], [
+            {'day_of_week': 'Monday', 'hour': time(10), 'bookings': 1, 'booked_hours': 1.0, 'capacity_hours': 1.0, 'occupancy': 1.0},
+            {'day_of_week': 'Monday', 'hour': time(11), 'bookings': 1, 'booked_hours': 1.0, 'capacity_hours': 1.0, 'occupancy': 1.0},
+        ])
+
+        self.assertEqual(self.api_client(self.client_user).get('/api/schedules/analytics/').status_code, 403)
+        self.assertEqual(self.api_client(self.admin).get('/api/schedules/analytics/', {'peak_hours': 0}).status_code, 400)
+
+
+class EventStreamTests(FitnessTestMixin, TestCase):
+
+    def event(self, event_type, gym_ids=(1,), trainer_ids=(), weekdays=(0,)):
+        return events.make_event(event_type, {'type': event_type}, gym_ids, trainer_ids, weekdays)
+
+    def test_committed_changes_are_published(self):
+        other_gym = Gym.objects.create(name='Gym B')
+        monday = self.schedules['Monday']
+        with mock.patch.object(events.broker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.book(self.client_user, monday, '10:00', '11:00').status_code, 201)
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule = Schedule.objects.get(pk=monday.pk)
+                schedule.gym, schedule.day_of_week = other_gym, 'Tuesday'
+                schedule.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.schedules['Friday'].delete()
+
+        published = [call.args[0] for call in publish.call_args_list]
+        self.assertEqual([event.type for event in published], ['booking.created', 'schedule.changed', 'schedule.deleted'])
+        booking, changed, _deleted = published
+        self.assertEqual(booking.data['start_time'], time(10, 0))
+        self.assertNotIn('client', booking.data)
+        # streams of the old gym and day are told that the schedule has left them
+        self.assertEqual(changed.gym_ids, {self.gym.pk, other_gym.pk})
+        self.assertEqual(changed.weekdays, {0, 1})
+
+    async def test_stream_sends_matching_events(self):
+        token = FitnessTokenObtainPairSerializer.get_token(self.client_user).access_token
+        response = await AsyncClient().get('/api/async/events/', {'gym': 1, 'day_of_week': 'Monday'}, headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response.request_timings.queries, 0)
+
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+        self.assertEqual(events.broker.stats()['streams'], 1)
+        events.publish(self.event('booking.deleted', gym_ids=(2,)))
+        events.publish(self.event('booking.deleted', weekdays=(1,)))
+        event = self.event('booking.created')
+        events.publish(event)
+        chunk = await asyncio.wait_for(anext(chunks), 1)
+        self.assertEqual(chunk, f'id: {event.id}\nevent: booking.created\ndata: {{"type":"booking.created"}}\n\n'.encode())
+
+        # on disconnect the ASGI handler cancels the task reading the stream
+        reading = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0)
+        reading.cancel()
+        await asyncio.gather(reading, return_exceptions=True)
+        self.assertEqual(events.broker.stats()['streams'], 0)
+
+    @override_settings(EVENT_STREAM_HEARTBEAT=0.01)
+    async def test_idle_stream_sends_keepalive(self):
+        chunks = events.stream()
+        await anext(chunks)
+        self.assertEqual(await anext(chunks), b': keepalive\n\n')
+        await chunks.aclose()
+
+    async def test_slow_client_gets_resync(self):
+        subscription = events.broker.subscribe(max_queued=2)
+        try:
+            for _ in range(5):
+                events.publish(self.event('schedule.changed'))
+            queued, lost = await subscription.get(1)
+        finally:
+            events.broker.unsubscribe(subscription)
+        self.assertEqual((len(queued), lost), (1, 4))
+        self.assertIn(b'event: resync\ndata: {"lost":4}', events.format_event(events.RESYNC, {'lost': lost}))
+
+    def test_errors(self):
+        self.assertEqual(APIClient().get('/api/async/events/').status_code, 401)
+        api_client = APIClient()
+        api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {FitnessTokenObtainPairSerializer.get_token(self.client_user).access_token}')
+        self.assertEqual(api_client.get('/api/async/events/', {'day_of_week': 'Someday'}).status_code, 400)
+        with override_settings(EVENT_STREAM_MAX_CONNECTIONS=0):
+            self.assertEqual(api_client.get('/api/async/events/').status_code, 503)
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    databases = {'default'}
+
+    def test_sqlite_pragmas_are_applied_on_connect(self):
+        with connection.cursor() as cursor:
+            values = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0] for name in ('journal_mode', 'busy_timeout', 'synchronous')}
+        self.assertEqual(values, {'journal_mode': 'wal', 'busy_timeout': 5000, 'synchronous': 1}) # 1 is NORMAL
+
+    def test_profiles_are_read_from_environment(self):
+        base_dir = Path('/app')
+        sqlite = database.database_settings({}, base_dir)
+        self.assertEqual((sqlite['ENGINE'], sqlite['NAME'], sqlite['CONN_MAX_AGE']), ('django.db.backends.sqlite3', base_dir / 'db.sqlite3', 60))
+
+        postgresql = database.database_settings({
+            'DATABASE_PROFILE': 'postgresql', 'POSTGRES_HOST': 'db', 'POSTGRES_PASSWORD': 'secret', 'DB_CONN_MAX_AGE': 'none', 'DB_PGBOUNCER': '1',
+        }, base_dir)
+        self.assertEqual(postgresql['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual((postgresql['HOST'], postgresql['PORT'], postgresql['PASSWORD']), ('db', '5432', 'secret'))
+        self.assertIsNone(postgresql['CONN_MAX_AGE'])
+        self.assertTrue(postgresql['CONN_HEALTH_CHECKS'])
+        self.assertTrue(postgresql['DISABLE_SERVER_SIDE_CURSORS'])
+
+        with self.assertRaises(ValueError):
+            database.database_settings({'DATABASE_PROFILE': 'mysql'}, base_dir)
+        with self.assertRaises(ValueError):
+            database.sqlite_pragmas({'SQLITE_JOURNAL_MODE': 'wal; DROP TABLE fitness_booking'})
+
+
+class UserImportTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user(email='admin@example.com', password='password', role='admin')
+
+    def test_register_inserts_user_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().post('/api/users/register/', {'email': 'new@example.com', 'password': 'secret-password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in queries.captured_queries), 1)
+        self.assertTrue(CustomUser.objects.get(email='new@example.com').check_password('secret-password'))
+
+    def test_import_reports_errors_by_rows(self):
+        rows = [
+            {'email': 'Trainer1@Example.com', 'password': 'secret-1', 'full_name': 'Trainer One', 'role': 'trainer'},
+            {'email': 'client1@example.com', 'full_name': 'Client One'},
+            {'email': 'Trainer1@EXAMPLE.com', 'full_name': 'Repeated'},
+            {'email': 'client@example.com', 'full_name': 'Existing'},
+            {'email': 'not-an-email'},
+            {'email': 'boss@example.com', 'role': 'admin'},
+        ]
+        response = self.api_client(self.admin).post('/api/users/import_users/', rows, format='json')
+        self.assertEqual(response.status_code, 201)
+        instrumentation.assert_query_budget(response)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([(error['row'], list(error['errors'])) for error in response.data['errors']], [
+            (3, ['email']), (4, ['email']), (5, ['email']), (6, ['role']),
+        ])
+        self.assertEqual(response.data['errors'][1]['errors']['email'], [user_import.EMAIL_EXISTS])
+
+        trainer = CustomUser.objects.get(email='Trainer1@example.com')
+        self.assertEqual(trainer.role, 'trainer')
+        self.assertTrue(trainer.check_password('secret-1'))
+        # users imported without a password set it by themselves later
+        self.assertFalse(CustomUser.objects.get(email='client1@example.com').has_usable_password())
+
+    def test_import_csv_file(self):
+        upload = StringIO('email,password,full_name,gender,role\nanna@example.com,secret,Anna,female,trainer\nbob@example.com,,Bob,,\n')
+        upload.name = 'users.csv'
+        response = self.api_client(self.admin).post('/api/users/import_users/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data, {'created': 2, 'errors': []})
+        self.assertEqual(dict(CustomUser.objects.filter(email__in=['anna@example.com', 'bob@example.com']).values_list('email', 'role')),
+                         {'anna@example.com': 'trainer', 'bob@example.com': 'client'})
+
+    def test_emails_are_checked_by_batches(self):
+        rows = [{'email': f'user{number}@example.com'} for number in range(25)]
+        with self.assertNumQueries(3):
+            result = user_import.import_users(rows, batch_size=10, dry_run=True)
+        self.assertEqual(result, {'created': 25, 'errors': []})
+        self.assertFalse(CustomUser.objects.filter(email='user0@example.com').exists())
+
+    def test_passwords_are_hashed_in_pool(self):
+        with mock.patch.object(hashing, 'MIN_POOL_PASSWORDS', 2):
+            hashes = hashing.hash_passwords(['first', 'second', None], workers=2)
+        self.assertTrue(check_password('first', hashes[0]))
+        self.assertTrue(check_password('second', hashes[1]))
+        self.assertFalse(is_password_usable(hashes[2]))
+
+    def test_import_request_hashes_in_its_process(self):
+        rows = [{'email': f'pooled{number}@example.com', 'password': 'secret'} for number in range(hashing.MIN_POOL_PASSWORDS)]
+        with mock.patch.object(hashing.os, 'cpu_count', return_value=8), \
+                mock.patch.object(hashing, 'ProcessPoolExecutor', side_effect=AssertionError('pool started by a request')):
+            response = self.api_client(self.admin).post('/api/users/import_users/', rows, format='json')
+        self.assertEqual(response.data, {'created': len(rows), 'errors': []})
+
+        rows = [{'email': f'many{number}@example.com'} for number in range(UserViewSet.MAX_IMPORT_USERS + 1)]
+        response = self.api_client(self.admin).post('/api/users/import_users/', rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CustomUser.objects.filter(email='many0@example.com').exists())
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as import_file:
+            json.dump([{'email': 'command@example.com', 'role': 'trainer'}, {'email': 'client@example.com'}], import_file)
+        self.addCleanup(os.unlink, import_file.name)
+        out, err = StringIO(), StringIO()
+        call_command('import_users', import_file.name, workers=1, stdout=out, stderr=err)
+        self.assertIn('1 of 2 users created', out.getvalue())
+        self.assertIn('Row 2:', err.getvalue())
+        self.assertTrue(CustomUser.objects.filter(email='command@example.com', role='trainer').exists())
+        with self.assertRaises(CommandError):
+            call_command('import_users', 'users.xml')
+
+    def test_import_is_only_for_admins(self):
+        response = self.api_client(self.trainer).post('/api/users/import_users/', [{'email': 'new@example.com'}], format='json')
+        self.assertEqual(response.status_code, 403)
+        response = self.api_client(self.admin).post('/api/users/import_users/', {'email': 'new@example.com'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ThrottlingTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        throttling.limiter.reset()
+        self.addCleanup(throttling.limiter.reset)
+
+    def test_token_bucket_refills(self):
+        capacity, refill_rate = throttling.parse_rate('2/s')
+        state, wait = throttling.refill(None, capacity, refill_rate, 100.0)
+        state, wait = throttling.refill(state, capacity, refill_rate, 100.0)
+        self.assertEqual((state, wait), ((0, 100.0), 0))
+        state, wait = throttling.refill(state, capacity, refill_rate, 100.25)
+        self.assertEqual(wait, 0.25) # half of a token is refilled, the other half takes 0.25 s
+        state, wait = throttling.refill(state, capacity, refill_rate, 101.0)
+        self.assertEqual(wait, 0)
+        self.assertEqual(throttling.parse_rate('30/min'), (30, 0.5))
+        with self.assertRaises(ValueError):
+            throttling.parse_rate('30/week')
+
+    @override_settings(THROTTLE_RATES={'register': '2/min'})
+    def test_addresses_are_throttled_before_views(self):
+        statuses = []
+        for number in range(3):
+            response = APIClient().post('/api/users/register/', {'email': f'new{number}@example.com', 'password': 'password'}, format='json')
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertIn(int(response['Retry-After']), range(28, 31)) # a token per 30 s, registering hashes for a while
+        self.assertEqual(response.request_view, 'customuser-register')
+        self.assertEqual(response.request_timings.queries, 0)
+        self.assertFalse(CustomUser.objects.filter(email='new2@example.com').exists())
+
+        other_address = APIClient(REMOTE_ADDR='10.0.0.2').post('/api/users/register/', {'email': 'new3@example.com', 'password': 'password'}, format='json')
+        self.assertEqual(other_address.status_code, 200)
+        self.assertEqual(throttling.limiter.stats()['decisions'], {('register', 'allowed'): 3, ('register', 'throttled'): 1})
+
+    @override_settings(THROTTLE_RATES={'register': '1/min'})
+    def test_forwarded_for_header_does_not_change_address(self):
+        statuses = [
+            APIClient(HTTP_X_FORWARDED_FOR=f'198.51.100.{number}').post('/api/users/register/', {'email': f'new{number}@example.com', 'password': 'password'}, format='json').status_code
+            for number in range(2)
+        ]
+        self.assertEqual(statuses, [200, 429])
+
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            request = mock.Mock(META={'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '198.51.100.7, 203.0.113.9'})
+            self.assertEqual(throttling.client_address(request), '203.0.113.9') # added by the proxy
+
+    @override_settings(THROTTLE_RATES={'booking': '1/min'})
+    def test_bookings_are_throttled_by_user(self):
+        self.assertEqual(self.book(self.client_user, self.schedules['Monday'], '10:00', '11:00').status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.book(self.client_user, self.schedules['Monday'], '12:00', '13:00')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(queries), 0)
+        other_client = CustomUser.objects.create_user(email='other@example.com', password='password')
+        self.assertEqual(self.book(other_client, self.schedules['Monday'], '12:00', '13:00').status_code, 201)
+
+    @override_settings(THROTTLE_RATES={'booking-ip': '1/min'})
+    def test_bookings_are_throttled_by_address_before_lock(self):
+        self.assertEqual(self.book(self.client_user, self.schedules['Monday'], '10:00', '11:00').status_code, 201)
+        other_client = CustomUser.objects.create_user(email='other@example.com', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.book(other_client, self.schedules['Monday'], '12:00', '13:00')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.request_view, 'schedule-add-this-schedule')
+        self.assertEqual(len(queries), 0) # no transaction or lock was started
+
+    @override_settings(LOAD_SHEDDING_MAX_IN_FLIGHT=0)
+    def test_overloaded_process_sheds_bookings(self):
+        response = self.api_client(self.client_user).post('/api/schedules/add_schedules/', {'bookings': []}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(throttling.limiter.stats()['shed'], {'schedule-add-schedules': 1})
+
+    @override_settings(LOAD_SHEDDING_MAX_IN_FLIGHT=0)
+    def test_overloaded_process_sheds_requests(self):
+        response = APIClient().post('/api/token/', {'email': 'client@example.com', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.request_timings.queries, 0)
+        self.assertEqual(throttling.limiter.stats()['in_flight'], 0)
+
+        metrics = instrumentation.metrics.render()
+        self.assertIn('fitness_load_shedding_rejected_total{view="token_obtain_pair"} 1', metrics)
+        self.assertIn('fitness_throttle_decisions_total{scope="token",result="allowed"} 1', metrics)
+
+    def test_cache_buckets_are_shared(self):
+        buckets = throttling.CacheBuckets()
+        cache.delete(throttling.BUCKET_CACHE_KEY.format('token:10.0.0.3'))
+        self.assertEqual(buckets.take('token:10.0.0.3', 1, 1 / 60), 0)
+        self.assertGreater(throttling.CacheBuckets().take('token:10.0.0.3', 1, 1 / 60), 59)
+
+
+class TrainerDirectoryTests(FitnessTestMixin, TestCase):
+
+    def setUp(self):
+        self.other_gym = Gym.objects.create(name='Gym B')
+        self.anna = CustomUser.objects.create_user(email='anna@example.com', full_name='Ánna  Smith', gender='female', role='trainer')
+        self.annabel = CustomUser.objects.create_user(email='annabel@example.com', full_name='Annabel Lee', gender='female', role='trainer')
+        self.bob = CustomUser.objects.create_user(email='bob@example.com', full_name='Bob Annan', role='trainer')
+        CustomUser.objects.create_user(email='annie@example.com', full_name='Annie Client')
+        for trainer, gym in ((self.anna, self.gym), (self.anna, self.other_gym), (self.bob, self.other_gym)):
+            Schedule.objects.create(trainer=trainer, gym=gym, day_of_week='Monday', start_time=time(8, 0), end_time=time(9, 0) if gym == self.gym else time(10, 0))
+
+    def search(self, **params):
+        response = self.api_client(self.client_user).get('/api/users/trainers/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        instrumentation.assert_query_budget(response)
+        return response
+
+    def test_names_are_normalized(self):
+        self.assertEqual(normalize_name(' Ánna  SMITH '), 'anna smith')
+        self.assertEqual(normalize_name('Әлия Ёлкина'), 'әлия елкина')
+        self.assertEqual(normalize_name(None), '')
+        self.anna.full_name = 'Anna Jones'
+        self.anna.save(update_fields=['full_name'])
+        self.assertEqual(CustomUser.objects.get(pk=self.anna.pk).search_name, 'anna jones')
+
+    def test_search_by_name_prefix_and_words(self):
+        response = self.search(q='ANN')
+        self.assertEqual([trainer['full_name'] for trainer in response.data], ['Ánna  Smith', 'Annabel Lee', 'Bob Annan'])
+        self.assertEqual(response.request_timings.queries, 2)
+        anna = response.data[0]
+        self.assertEqual({gym['name'] for gym in anna['gyms']}, {'Gym A', 'Gym B'})
+
+        self.assertEqual([trainer['full_name'] for trainer in self.search(q='anna s').data], ['Ánna  Smith'])
+        self.assertEqual([trainer['full_name'] for trainer in self.search(q='smi').data], ['Ánna  Smith'])
+        self.annabel.full_name = 'Ann😀 Lee'
+        self.annabel.save()
+        self.assertEqual([trainer['full_name'] for trainer in self.search(q='ann').data], ['Ánna  Smith', 'Ann😀 Lee', 'Bob Annan'])
+        self.assertEqual(len(self.search(limit=2).data), 2)
+
+    def test_filters_by_gym_and_gender(self):
+        response = self.search(q='ann', gym=self.other_gym.pk)
+        self.assertEqual([trainer['full_name'] for trainer in response.data], ['Ánna  Smith', 'Bob Annan'])
+        response = self.search(gym=self.gym.pk, gender='male')
+        self.assertEqual([trainer['full_name'] for trainer in response.data], ['Trainer'])
+        errors = self.api_client(self.client_user).get('/api/users/trainers/', {'gender': 'other', 'limit': 1000})
+        self.assertEqual(set(errors.data), {'gender', 'limit'})
+
+    def test_trainer_gyms_follow_schedules(self):
+        def gyms(trainer):
+            return set(TrainerGym.objects.filter(trainer=trainer).values_list('gym__name', flat=True))
+
+        self.assertEqual(gyms(self.anna), {'Gym A', 'Gym B'})
+        self.assertEqual(gyms(self.annabel), set())
+
+        schedule = Schedule.objects.get(trainer=self.bob)
+        schedule.gym = self.gym
+        schedule.save()
+        self.assertEqual(gyms(self.bob), {'Gym A'})
+        schedule.trainer = self.annabel
+        schedule.save()
+        self.assertEqual((gyms(self.bob), gyms(self.annabel)), (set(), {'Gym A'}))
+
+        Schedule.objects.filter(trainer=self.anna, gym=self.gym).delete()
+        self.assertEqual(gyms(self.anna), {'Gym B'})
+        self.other_gym.delete()
+        self.assertEqual(gyms(self.anna), set())
+
+    def test_search_reads_index_in_order(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('on PostgreSQL trainers are found by the trigram index and sorted by similarity')
+        for queryset in (UserViewSet.search_trainers('ann'), UserViewSet.search_trainers('ann', gym=self.gym.pk, gender='female')):
+            plan = queryset.explain()
+            self.assertIn('USING INDEX user_role_search_name_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan) # no sorting, the scan stops at the limit
@@ -0,0 +1,232 @@
+"""
+Rate limiting and load shedding of expensive endpoints.
+
+Booking locks a schedule and checks overlaps, registration and obtaining tokens hash passwords, so a burst of them
+takes every worker. Limits are token buckets: a bucket holds up to N tokens of the 'N/period' rate of its scope in
+THROTTLE_RATES and is refilled continuously, every request takes a token and a request finding the bucket empty is
+rejected with 429 and Retry-After. Buckets are kept by THROTTLE_BACKEND: LocalBuckets in memory of the process (no
+I/O, limits are per process), CacheBuckets in the default cache, shared by processes unless CACHE_PROFILE=local.
+
+LoadSheddingMiddleware rejects POST requests of THROTTLED_VIEWS before authentication and any query: with 429 when
+the bucket of the client address is empty, with 503 when LOAD_SHEDDING_MAX_IN_FLIGHT of them are already handled by
+the process. Per user limits need the user, they are DRF throttles (UserBookingThrottle) checked after
+authentication, which reads only the token, and before the view.
+"""
+import math
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+BUCKET_CACHE_KEY = 'fitness:throttle:{}'
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate) -> tuple:
+    """ Returns capacity and tokens per second of a rate like '10/min' (periods are s, m, h and d by first letter)"""
+    number, period = rate.split('/')
+    if period[:1] not in PERIODS:
+        raise ValueError(f'Invalid period of rate {rate!r}')
+    capacity = int(number)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+def refill(state, capacity, refill_rate, now) -> tuple:
+    """ Takes a token from the bucket state (tokens, time of update), returns the new state and seconds to wait"""
+    tokens, updated = state if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * refill_rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0.0
+    return (tokens, now), (1 - tokens) / refill_rate
+
+
+class LocalBuckets:
+    """ Buckets in memory of the process, least recently used ones are dropped if there are max_size of them"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate) -> float:
+        with self.lock:
+            state, wait = refill(self.buckets.pop(key, None), capacity, refill_rate, time.monotonic())
+            if len(self.buckets) >= self.max_size:
+                # a dropped bucket starts full again, which only lets its client in earlier
+                for old_key in list(self.buckets)[:self.max_size // 10 or 1]:
+                    del self.buckets[old_key]
+            self.buckets[key] = state
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBuckets:
+    """ Buckets in the default cache, shared by processes using the same cache
+
+    Reading and writing a bucket are two cache calls, concurrent requests of one client may both take its last token,
+    so a burst may pass a few requests over the limit.
+    """
+
+    def take(self, key, capacity, refill_rate) -> float:
+        cache_key = BUCKET_CACHE_KEY.format(key)
+        state, wait = refill(cache.get(cache_key), capacity, refill_rate, time.time())
+        # a bucket left alone for this long is full, as if it did not exist
+        cache.set(cache_key, state, timeout=math.ceil(capacity / refill_rate))
+        return wait
+
+    def clear(self):
+        pass
+
+
+class Limiter:
+    """ Token buckets of THROTTLE_RATES scopes and counters of their decisions"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.buckets.clear()
+        self.decisions = defaultdict(int) # (scope, 'allowed' or 'throttled') -> count
+        self.in_flight = 0
+        self.shed = defaultdict(int) # view -> requests rejected with 503
+
+    def take(self, scope, ident) -> float:
+        """ Returns 0 if a request of the client in the scope is allowed, else seconds until it is, scopes without
+        a rate are not limited"""
+        rate = settings.THROTTLE_RATES.get(scope)
+        if rate is None:
+            return 0.0
+        wait = self.buckets.take(f'{scope}:{ident}', *parse_rate(rate))
+        with self.lock:
+            self.decisions[scope, 'throttled' if wait else 'allowed'] += 1
+        return wait
+
+    def enter(self, view) -> bool:
+        """ Counts a request of a throttled view as handled, False if there are too many already"""
+        limit = settings.LOAD_SHEDDING_MAX_IN_FLIGHT
+        with self.lock:
+            if limit is not None and self.in_flight >= limit:
+                self.shed[view] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'decisions': dict(self.decisions), 'in_flight': self.in_flight, 'shed': dict(self.shed)}
+
+
+limiter = Limiter(import_string(settings.THROTTLE_BACKEND)())
+
+
+def client_address(request) -> str:
+    # the same address as DRF throttles use: REMOTE_ADDR, or with NUM_PROXIES > 0 the address X-Forwarded-For got
+    # from the outermost of these proxies, addresses a client puts there itself are not trusted
+    return BaseThrottle().get_ident(request)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """ DRF throttle taking a token from the bucket of the user (of the address for anonymous users) in scope"""
+    scope = None
+
+    def allow_request(self, request, view):
+        ident = request.user.pk if request.user and request.user.is_authenticated else client_address(request)
+        self.wait_seconds = limiter.take(self.scope, ident)
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UserBookingThrottle(TokenBucketThrottle):
+    scope = 'booking'
+
+
+def too_many_requests(wait) -> JsonResponse:
+    response = JsonResponse({'error': 'Too many requests'}, status=429)
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+def server_busy() -> JsonResponse:
+    response = JsonResponse({'error': 'Server is busy, try again later'}, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+
+class LoadSheddingMiddleware:
+    """ Rejects requests of THROTTLED_VIEWS early, should be right after InstrumentationMiddleware"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        view, rejected = self.admit(request)
+        if view is None:
+            return self.get_response(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return self.get_response(request)
+        finally:
+            limiter.leave()
+
+    async def __acall__(self, request):
+        view, rejected = self.admit(request)
+        if view is None:
+            return await self.get_response(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return await self.get_response(request)
+        finally:
+            limiter.leave()
+
+    @staticmethod
+    def admit(request) -> tuple:
+        """ Returns view name of a throttled request (None for others) and a response if it is rejected"""
+        # throttled views are POST only, other requests are not resolved twice
+        if request.method != 'POST':
+            return None, None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None, None
+        scope = settings.THROTTLED_VIEWS.get(match.view_name)
+        if scope is None:
+            return None, None
+
+        # rejected requests are counted in metrics of their view
+        request.resolver_match = match
+        wait = limiter.take(scope, client_address(request))
+        if wait:
+            return match.view_name, too_many_requests(wait)
+        if not limiter.enter(match.view_name):
+            return match.view_name, server_busy()
+        return match.view_name, None
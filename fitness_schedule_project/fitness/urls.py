@@ -1,5 +1,6 @@
 from django.urls import path, include
 from rest_framework import routers
+from . import async_views
 from .views import UserViewSet, ScheduleViewSet, BookingViewSet
 
 router = routers.DefaultRouter()
@@ -7,6 +8,17 @@ router.register('users', UserViewSet)
 router.register('schedules', ScheduleViewSet)
 router.register('bookings', BookingViewSet)
 
+# async versions of read endpoints, for running under ASGI
+async_urlpatterns = [
+    path('schedules/', async_views.schedule_list, name='async-schedule-list'),
+    path('schedules/get_own_schedule/', async_views.get_own_schedule, name='async-schedule-get-own-schedule'),
+    path('schedules/availability/', async_views.availability, name='async-schedule-availability'),
+    path('schedules/<int:pk>/', async_views.schedule_detail, name='async-schedule-detail'),
+    path('bookings/get_own_bookings/', async_views.get_own_bookings, name='async-booking-get-own-bookings'),
+    path('events/', async_views.event_stream, name='async-events'),
+]
+
 urlpatterns = [
+    path('async/', include(async_urlpatterns)),
     path('', include(router.urls)),
 ]
@@ -0,0 +1,96 @@
+"""
+Bulk import of trainers and clients from CSV or JSON, for onboarding staff and members of a new gym.
+
+Rows are validated without queries and emails of all rows are checked against existing users by one query per batch,
+answered from the unique index of email. Hashing of passwords takes most of the time, so they are hashed in a pool of
+processes (see hashing.py). Valid rows are inserted by bulk_create() in batches, rows with errors are skipped and
+reported with their numbers.
+"""
+import csv
+import io
+import json
+
+from django.db import IntegrityError, transaction
+
+from .hashing import hash_passwords
+from .models import CustomUser
+from .serializers import UserImportSerializer
+
+FORMATS = ('csv', 'json')
+
+EMAIL_EXISTS = 'user with this email address already exists.'
+
+
+def parse_rows(content, import_format) -> list:
+    """ Returns rows of CSV with a header line or of JSON list of objects, empty CSV cells are left out"""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    if import_format == 'csv':
+        return [{name.strip(): value for name, value in row.items() if name and value not in ('', None)}
+                for row in csv.DictReader(io.StringIO(content))]
+
+    rows = json.loads(content)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError('JSON should be a list of objects')
+    return rows
+
+
+def existing_emails(emails, batch_size) -> set:
+    existing = set()
+    for start in range(0, len(emails), batch_size):
+        existing.update(CustomUser.objects.filter(email__in=emails[start:start + batch_size]).values_list('email', flat=True))
+    return existing
+
+
+def import_users(rows, workers=None, batch_size=1000, dry_run=False) -> dict:
+    """ Creates users of valid rows, returns number of created users and errors of other rows by their numbers (from 1)"""
+    errors = []
+    valid = [] # (row number, validated data)
+    seen = set()
+    for number, row in enumerate(rows, 1):
+        serializer = UserImportSerializer(data=row)
+        if not serializer.is_valid():
+            errors.append({'row': number, 'errors': serializer.errors})
+            continue
+        data = dict(serializer.validated_data)
+        data['email'] = CustomUser.objects.normalize_email(data['email'])
+        if data['email'] in seen:
+            errors.append({'row': number, 'errors': {'email': ['Email is repeated in the import.']}})
+            continue
+        seen.add(data['email'])
+        valid.append((number, data))
+
+    existing = existing_emails([data['email'] for _number, data in valid], batch_size)
+    new = []
+    for number, data in valid:
+        if data['email'] in existing:
+            errors.append({'row': number, 'errors': {'email': [EMAIL_EXISTS]}})
+        else:
+            new.append((number, data))
+
+    created = 0
+    if not dry_run:
+        hashes = hash_passwords([data.pop('password', None) or None for _number, data in new], workers)
+        users = [(number, CustomUser(password=password, **data)) for (number, data), password in zip(new, hashes)]
+        for _number, user in users:
+            user.sync_search_name()
+        for start in range(0, len(users), batch_size):
+            created += insert_batch(users[start:start + batch_size], errors)
+
+    errors.sort(key=lambda error: error['row'])
+    return {'created': len(new) if dry_run else created, 'errors': errors}
+
+
+def insert_batch(users, errors) -> int:
+    """ Inserts (row number, user) pairs, users registered since the check are reported as errors"""
+    try:
+        with transaction.atomic():
+            CustomUser.objects.bulk_create([user for _number, user in users])
+        return len(users)
+    except IntegrityError:
+        existing = existing_emails([user.email for _number, user in users], len(users))
+        errors.extend({'row': number, 'errors': {'email': [EMAIL_EXISTS]}} for number, user in users if user.email in existing)
+        remaining = [(number, user) for number, user in users if user.email not in existing]
+        if len(remaining) == len(users):
+            raise
+        return insert_batch(remaining, errors) if remaining else 0
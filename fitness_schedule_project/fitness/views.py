@@ -1,14 +1,26 @@
-from datetime import time, datetime, timedelta
-
-from django.db import transaction
-from django.db.utils import IntegrityError
+from datetime import time, timedelta
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_save
+from django.db.utils import IntegrityError, OperationalError
 from django.utils import timezone
-from django.core.exceptions import ObjectDoesNotExist
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import CustomUser, Gym, Schedule, Booking
+from . import export, schedule_cache, user_import
+from .availability import availability_index
+from .fast_serializers import ScheduleValuesSerializer, BookingValuesSerializer
+from .filters import ScheduleFilter, BookingFilter
+from .pagination import ScheduleCursorPagination, BookingCursorPagination
+from .throttling import UserBookingThrottle
+from .models import CustomUser, Gym, Schedule, ScheduleOccurrence, ScheduleHourSummary, TrainerGym, Booking, CLOSED_UNTIL, MINUTES_IN_DAY, WEEKDAYS, minute_of_day, end_minute_of_day, minute_of_week, \
+                    end_minute_of_week, max_overlapping, normalize_name
 from .serializers import UserSerializer, UserRegisterSerializer, UserTrainerRegisterSerializer, UserAdditionalInfoSerializer, \
-                    ScheduleSerializer, ScheduleCreateSerializer, ScheduleBookingSerializer, BookingSerializer
+                    TrainerDirectorySerializer, TrainerSearchQuerySerializer, \
+                    ScheduleSerializer, ScheduleCreateSerializer, ScheduleBulkCreateSerializer, ScheduleBookingSerializer, BatchBookingSerializer, AvailabilityQuerySerializer, \
+                    CalendarQuerySerializer, AnalyticsQuerySerializer, ScheduleOccurrenceSerializer, BookingSerializer
 
 from rest_framework import viewsets, status, filters
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, AllowAny, IsAuthenticated
@@ -16,6 +28,77 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 
 
+class ExpandMixin:
+    """ Reads ?expand=trainer,gym and joins expanded relations in the same query, so nested objects cost no extra queries"""
+    expand_related = {} # name in ?expand= -> path for select_related()
+
+    def get_expand(self):
+        request = getattr(self, 'request', None)
+        if request is None:
+            return set()
+        return self.parse_expand(request.query_params, self.expand_related)
+
+    @staticmethod
+    def parse_expand(query_params, expand_related):
+        return {name for name in query_params.get('expand', '').split(',') if name in expand_related}
+
+    @staticmethod
+    def select_expanded(queryset, expand, expand_related):
+        related = [expand_related[name] for name in expand]
+        return queryset.select_related(*related) if related else queryset
+
+    def get_queryset(self):
+        return self.select_expanded(super().get_queryset(), self.get_expand(), self.expand_related)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['expand'] = self.get_expand()
+        return context
+
+
+class ValuesSerializerMixin:
+    """ Serializes rows of values_actions by values_serializer_class from values(), see fast_serializers.py"""
+    values_serializer_class = None
+    values_actions = ('list', 'retrieve')
+
+    def use_values(self) -> bool:
+        # schema generation introspects model serializers
+        return self.action in self.values_actions and not getattr(self, 'swagger_fake_view', False)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.use_values():
+            return queryset
+        # cursor pagination reads position from the ordering columns
+        ordering = [field.lstrip('-') for field in getattr(self.pagination_class, 'ordering', ())]
+        return self.values_serializer_class.values(queryset, self.get_expand(), extra=ordering)
+
+    def get_serializer(self, *args, **kwargs):
+        if not self.use_values():
+            return super().get_serializer(*args, **kwargs)
+        kwargs.setdefault('context', self.get_serializer_context())
+        return self.values_serializer_class(*args, **kwargs)
+
+
+class ExportMixin:
+    """ Streams rows matching the filterset as CSV or NDJSON instead of walking pages of the list"""
+    export_fields = ()
+    export_filename = 'export'
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def export(self, request):
+        """ Method for exporting all filtered rows, as CSV by default or as NDJSON with ?export_format=ndjson. Only for admins"""
+        if not request.user.role == "admin":
+            return Response({'error': 'Only admins can export data'}, status=status.HTTP_403_FORBIDDEN)
+
+        export_format = request.query_params.get(export.FORMAT_PARAM, 'csv')
+        if export_format not in export.CONTENT_TYPES:
+            return Response({'error': f'Export format should be one of: {", ".join(export.CONTENT_TYPES)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return export.export_response(queryset, self.export_fields, export_format, self.export_filename,
+                                      asynchronous=isinstance(request._request, ASGIRequest))
+
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = CustomUser.objects.filter(is_active=True)
 
@@ -26,6 +109,8 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
             return UserTrainerRegisterSerializer
         if self.action == 'update_additional_info':
             return UserAdditionalInfoSerializer
+        if self.action == 'trainers':
+            return TrainerSearchQuerySerializer
         return UserSerializer
 
     def get_permissions(self):
@@ -50,9 +135,7 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(data=request.data)
 
         if serializer.is_valid():
-            user = serializer.save()
-            user.set_password(password)
-            user.save()
+            serializer.save()
             return Response(serializer.data)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -67,14 +150,82 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(data=request.data)
 
         if serializer.is_valid():
-            user = serializer.save()
-            user.set_password(request.data.get('password'))
-            user.role = "trainer"
-            user.save()
+            serializer.save(role="trainer")
             return Response(serializer.data)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['get'])
+    def trainers(self, request):
+        """ Method for searching trainers by name, gym and gender
+
+        ?q= matches beginnings of the name and of its words, on PostgreSQL also similar names (ordered by similarity).
+        Trainers are found by one indexed query, their gyms are read from trainer gyms by one more query
+        """
+        serializer = self.get_serializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        trainers = self.search_trainers(normalize_name(data.get('q')), data.get('gym'), data.get('gender'))
+        trainers = trainers.only('id', 'full_name', 'gender').prefetch_related('gyms')[:data['limit']]
+        return Response(TrainerDirectorySerializer(trainers, many=True).data)
+
+    @staticmethod
+    def search_trainers(query, gym=None, gender=None):
+        trainers = CustomUser.objects.filter(role='trainer', is_active=True)
+        if gym is not None:
+            trainers = trainers.filter(gym_memberships__gym_id=gym)
+        if gender is not None:
+            trainers = trainers.filter(gender=gender)
+        if not query:
+            return trainers.order_by('search_name')
+
+        # a range of the normalized name instead of startswith, which is a case-insensitive LIKE on SQLite and can't use the index
+        # (the last code point sorts after any other in UTF-8 and UTF-16, unlike '\uffff' for characters like emoji)
+        prefix = Q(search_name__gte=query, search_name__lt=query + '\U0010ffff')
+        words = prefix | Q(search_name__contains=f' {query}')
+        if connection.vendor == 'postgresql':
+            # django.contrib.postgres needs psycopg, it is installed with the postgresql profile only
+            from django.contrib.postgres.search import TrigramWordSimilarity
+            # all conditions are answered by the trigram index of migration 0007
+            return trainers.filter(words | Q(search_name__trigram_word_similar=query)) \
+                           .annotate(similarity=TrigramWordSimilarity(query, 'search_name')).order_by('-similarity', 'search_name')
+        # trainers are read in the order of user_role_search_name_idx without sorting, so the scan stops at the limit
+        return trainers.filter(words).order_by('search_name')
+
+    # passwords of a request are hashed one by one (about 0.3 s each), bigger imports go to the import_users command
+    MAX_IMPORT_USERS = 50
+
+    @action(detail=False, methods=['post'])
+    def import_users(self, request):
+        """ Method for creating many trainers and clients at once. Only for admins
+
+        Takes a JSON list of users or a CSV or JSON file in "file" field. Users of correct rows are created, errors of
+        other rows are returned with their numbers. Passwords are hashed in the process of the request, bigger files
+        can be imported by the import_users command, which hashes them in a pool of processes.
+        """
+        if not request.user.role == "admin":
+            return Response({'error': 'Only admins can import users'}, status=status.HTTP_403_FORBIDDEN)
+
+        upload = request.FILES.get('file')
+        if upload is not None:
+            try:
+                rows = user_import.parse_rows(upload.read(), 'json' if upload.name.lower().endswith('.json') else 'csv')
+            except ValueError as error: # including JSON and unicode decoding errors
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        elif isinstance(request.data, list) and all(isinstance(row, dict) for row in request.data):
+            rows = request.data
+        else:
+            return Response({'error': 'Send a list of users or a file'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not rows or len(rows) > self.MAX_IMPORT_USERS:
+            return Response({'error': f'From 1 to {self.MAX_IMPORT_USERS} users can be imported at once'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # a pool of processes per request would multiply processes of the server
+        result = user_import.import_users(rows, workers=1)
+        return Response(result, status=status.HTTP_201_CREATED if result['created'] else status.HTTP_400_BAD_REQUEST)
+
     @action(detail=False, methods=['post'])
     def update_additional_info(self, request, pk=None):
         """ Method for updating additional information of a client
@@ -82,7 +233,9 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         Usually person only by self should can change own information
         """
 
-        serializer = self.get_serializer(instance=request.user, data=request.data)
+        # request.user may be made from token claims, so the user is loaded to be changed
+        user = CustomUser.objects.get(pk=request.user.pk)
+        serializer = self.get_serializer(instance=user, data=request.data)
         
         if serializer.is_valid():
             serializer.save()
@@ -90,19 +243,51 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class ScheduleViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Schedule.objects.all()
+class ScheduleViewSet(ValuesSerializerMixin, ExpandMixin, ExportMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Schedule.objects.order_by('start_minute', 'id')
+    expand_related = {'trainer': 'trainer', 'gym': 'gym'}
+    values_serializer_class = ScheduleValuesSerializer
+    values_actions = ('list', 'retrieve', 'get_own_schedule')
+    export_fields = ('id', 'trainer_id', 'gym_id', 'day_of_week', 'start_time', 'end_time', 'capacity')
+    export_filename = 'schedules'
+    pagination_class = ScheduleCursorPagination
     permission_classes = [IsAuthenticated]
     filter_backends = (DjangoFilterBackend,)
-    filterset_fields = ['trainer', 'gym', 'day_of_week', 'start_time', 'end_time']
+    filterset_class = ScheduleFilter
 
     def get_serializer_class(self):
         if self.action == 'create_schedule':
             return ScheduleCreateSerializer
+        if self.action == 'create_schedules':
+            return ScheduleBulkCreateSerializer
         if self.action == 'add_this_schedule':
             return ScheduleBookingSerializer
+        if self.action == 'add_schedules':
+            return BatchBookingSerializer
+        if self.action == 'availability':
+            return AvailabilityQuerySerializer
+        if self.action == 'calendar':
+            return CalendarQuerySerializer
+        if self.action == 'analytics':
+            return AnalyticsQuerySerializer
         return ScheduleSerializer
 
+    def list(self, request, *args, **kwargs):
+        scopes = schedule_cache.list_scopes(request.query_params)
+        return schedule_cache.cached_response(request, 'list', scopes, lambda: super(ScheduleViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        scopes = [schedule_cache.schedule_scope(kwargs[self.lookup_field])]
+        return schedule_cache.cached_response(request, 'retrieve', scopes, lambda: super(ScheduleViewSet, self).retrieve(request, *args, **kwargs))
+
+    @action(detail=False, methods=['get'])
+    def cache_stats(self, request):
+        """ Method for getting hit and miss counters of schedules cache in this process. Only for admins"""
+        if not request.user.role == "admin":
+            return Response({'error': 'Only admins can watch cache statistics'}, status=status.HTTP_403_FORBIDDEN)
+
+        return Response(schedule_cache.stats.as_dict())
+
     @action(detail=False, methods=['post'])
     def create_schedule(self, request):
         """ Method for creating a schedule. Only for trainers"""
@@ -118,32 +303,219 @@ class ScheduleViewSet(viewsets.ReadOnlyModelViewSet):
             start_time = serializer.validated_data['start_time']
             end_time = serializer.validated_data['end_time']
             
-            if time(0, 1) <= start_time <= time(5, 59) or time(0, 1) <= end_time <= time(5, 59):
-                return Response({'error': 'The fitness center is closed between 00:00 and 06:00'},
-                                status=status.HTTP_400_BAD_REQUEST)
+            time_error = self.schedule_time_error(start_time, end_time)
+            if time_error:
+                return Response({'error': time_error}, status=status.HTTP_400_BAD_REQUEST)
         
             if self.schedule_intersects_for_same_day(self, request.user, day_of_week, start_time, end_time):
                 return Response({'error': 'The schedule intersects with another schedule of the same trainer'},
                                  status=status.HTTP_400_BAD_REQUEST)
             
 
-            serializer.save(trainer=request.user)
+            serializer.save(trainer_id=request.user.pk)
             return Response(serializer.data)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    MAX_BULK_SCHEDULES = 100
+
+    @action(detail=False, methods=['post'])
+    def create_schedules(self, request):
+        """ Method for creating many schedules at once, for example the whole week in several gyms. Only for trainers
+
+        Takes a list of schedules. They are created all together or none of them, errors are returned for every item
+        (empty for correct ones) in the same order.
+        """
+        if not request.user.role == "trainer":
+            return Response({'error': 'Only trainers can create schedule'}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        items = serializer.validated_data
+        if not items or len(items) > self.MAX_BULK_SCHEDULES:
+            return Response({'error': f'From 1 to {self.MAX_BULK_SCHEDULES} schedules can be created at once'}, status=status.HTTP_400_BAD_REQUEST)
+
+        schedules = []
+        for item in items:
+            schedule = Schedule(trainer_id=request.user.pk, **item)
+            schedule.sync_minutes()
+            schedules.append(schedule)
+
+        try:
+            with transaction.atomic():
+                # schedules of the trainer must not change between the check and the insert
+                self.lock_trainer(request.user)
+
+                errors = self.bulk_schedule_errors(request.user, schedules)
+                if any(errors):
+                    return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+                Schedule.objects.bulk_create(schedules)
+                ScheduleOccurrence.materialize(schedules, check_existing=False)
+                ScheduleHourSummary.create_for(schedules)
+                TrainerGym.add_for(schedules)
+                # bulk_create() does not send signals, but the availability index and the cache rely on them
+                for schedule in schedules:
+                    post_save.send(sender=Schedule, instance=schedule, created=True, update_fields=None, raw=False, using=schedule._state.db)
+        except IntegrityError:
+            return Response({"error": "Failed to create schedules"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response(ScheduleCreateSerializer(schedules, many=True).data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def schedule_time_error(start_time, end_time):
+        if start_time < CLOSED_UNTIL:
+            return 'The fitness center is closed between 00:00 and 06:00'
+        if minute_of_day(start_time) >= end_minute_of_day(end_time):
+            return 'Start time of the schedule should be earlier than end time'
+        return None
+
+    @classmethod
+    def bulk_schedule_errors(cls, trainer, schedules) -> list:
+        """ Checks times and gyms of new schedules, and intersections between them and with existing schedules of the trainer
+
+        Gyms and existing schedules are read with one query each, intersections are found by sorting all intervals.
+        """
+        errors = [{} for _schedule in schedules]
+        existing_gyms = set(Gym.objects.filter(pk__in={schedule.gym_id for schedule in schedules}).values_list('pk', flat=True))
+        for index, schedule in enumerate(schedules):
+            time_error = cls.schedule_time_error(schedule.start_time, schedule.end_time)
+            if time_error:
+                errors[index]['error'] = time_error
+            elif schedule.gym_id not in existing_gyms:
+                errors[index]['gym'] = [f'Invalid pk "{schedule.gym_id}" - object does not exist.']
+
+        # (start, end, index in the request or None for existing schedules)
+        intervals = [(schedule.start_minute, schedule.end_minute, index) for index, schedule in enumerate(schedules) if not errors[index]]
+        if not intervals:
+            return errors
+        existing = Schedule.objects.filter(
+            trainer_id=trainer.pk,
+            start_minute__lt=max(end for _start, end, _index in intervals),
+            end_minute__gt=min(start for start, _end, _index in intervals),
+        ).values_list('start_minute', 'end_minute')
+        intervals.extend((start, end, None) for start, end in existing)
+
+        def add_error(index, other_index):
+            if index is not None and 'error' not in errors[index]:
+                errors[index]['error'] = ('The schedule intersects with another schedule of the same trainer' if other_index is None
+                                          else f'The schedule intersects with schedule {other_index} of the request')
+
+        # the interval that ends last among already seen ones intersects with the next interval if it starts before that end
+        last = None
+        for interval in sorted(intervals, key=lambda interval: interval[:2]):
+            if last is not None and interval[0] < last[1]:
+                add_error(interval[2], last[2])
+                add_error(last[2], interval[2])
+            if last is None or interval[1] > last[1]:
+                last = interval
+        return errors
+
     @action(detail=False, methods=['get'])
     def get_own_schedule(self, request):
         """ Method for getting all schedules that trainer have. Only for trainers"""
         if not request.user.role == "trainer":
             return Response({'error': 'This method is only for trainers'}, status=status.HTTP_403_FORBIDDEN)
 
-        queryset = self.get_queryset().filter(trainer=request.user)
+        queryset = self.get_queryset().filter(trainer_id=request.user.pk)
         serializer = self.get_serializer(queryset, many=True)
 
         return Response(serializer.data)
     
-    @action(detail=True, methods=['post'])
+    @action(detail=False, methods=['get'])
+    def availability(self, request):
+        """ Method for finding trainers that are free in the gym at given day and time
+
+        Answered from in-process index of free time, so it does not query the database unless schedules were changed
+        """
+        serializer = self.get_serializer(data=request.query_params)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        slots = availability_index.free_slots(data['gym'], data['day_of_week'], data['start_time'], data['end_time'])
+
+        return Response([self.free_slot_data(slot) for slot in slots])
+
+    @action(detail=False, methods=['get'])
+    def calendar(self, request):
+        """ Method for getting dated sessions of schedules from date_from to date_to, of a gym or a trainer if they are given"""
+        serializer = self.get_serializer(data=request.query_params)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        occurrences = ScheduleOccurrence.objects.filter(date__range=(data['date_from'], data['date_to'])).order_by('date', 'start_time', 'id')
+        if 'gym' in data:
+            occurrences = occurrences.filter(gym_id=data['gym'])
+        if 'trainer' in data:
+            occurrences = occurrences.filter(trainer_id=data['trainer'])
+
+        return Response(ScheduleOccurrenceSerializer(occurrences, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def analytics(self, request):
+        """ Method for getting booked hours of trainers, occupancy of gyms by week days and peak hours of a usual week. Only for admins
+
+        Read from summaries kept up to date on every booking, so it takes the same time for any number of bookings
+        """
+        if not request.user.role == "admin":
+            return Response({'error': 'Only admins can watch analytics'}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        summaries = ScheduleHourSummary.objects.order_by()
+        if 'gym' in data:
+            summaries = summaries.filter(gym_id=data['gym'])
+        totals = {'booked': Sum('booked_minutes'), 'capacity': Sum('capacity_minutes'), 'bookings': Sum('bookings')}
+
+        # totals are read from covering indexes of the summaries, names are joined in Python
+        trainers = summaries.values('trainer_id').annotate(**totals).order_by('-booked', 'trainer_id')
+        gyms = summaries.values('gym_id', 'weekday').annotate(**totals).order_by('gym_id', 'weekday')
+        peak_hours = summaries.values('weekday', 'hour').annotate(**totals).order_by('-bookings', '-booked', 'weekday', 'hour')[:data['peak_hours']]
+        trainer_names = dict(CustomUser.objects.filter(pk__in=summaries.values('trainer_id')).values_list('pk', 'full_name'))
+        gym_names = dict(Gym.objects.values_list('pk', 'name'))
+
+        return Response({
+            "trainers": [
+                {"trainer": row['trainer_id'], "full_name": trainer_names.get(row['trainer_id']), **self.usage_data(row)}
+                for row in trainers
+            ],
+            "gyms": [
+                {"gym": row['gym_id'], "name": gym_names.get(row['gym_id']), "day_of_week": WEEKDAYS[row['weekday']], **self.usage_data(row)}
+                for row in gyms
+            ],
+            "peak_hours": [
+                {"day_of_week": WEEKDAYS[row['weekday']], "hour": time(row['hour']), "bookings": row['bookings'], **self.usage_data(row)}
+                for row in peak_hours
+            ],
+        })
+
+    @staticmethod
+    def usage_data(row):
+        return {
+            "booked_hours": round(row['booked'] / 60, 2),
+            "capacity_hours": round(row['capacity'] / 60, 2),
+            "occupancy": round(row['booked'] / row['capacity'], 4) if row['capacity'] else None,
+        }
+
+    @staticmethod
+    def free_slot_data(slot):
+        return {
+            "schedule_id": slot.schedule_id,
+            "trainer": slot.trainer_id,
+            "free_from": time(slot.start_minute % MINUTES_IN_DAY // 60, slot.start_minute % 60),
+            "free_to": time(slot.end_minute % MINUTES_IN_DAY // 60, slot.end_minute % 60),
+        }
+
+    @action(detail=True, methods=['post'], throttle_classes=[UserBookingThrottle])
     def add_this_schedule(self, request, pk=None):
         """ Method for booking a schedule. Only for clients"""
         serializer = self.get_serializer(data=request.data)
@@ -154,38 +526,45 @@ class ScheduleViewSet(viewsets.ReadOnlyModelViewSet):
         if not request.user.role == "client":
             return Response({'error': 'Only clients can book a schedule'}, status=status.HTTP_403_FORBIDDEN)
 
-        try:
-            schedule = self.get_queryset().get(pk=pk)
-        except ObjectDoesNotExist:
-            return Response({"error": "Schedule does not exist"}, status=status.HTTP_404_NOT_FOUND)
-
         client = request.user
 
-        client_bookings = Booking.objects.filter(client=client)
-
-        for booking in client_bookings:
-            if booking.intersects_with_schedule(schedule):
-                return Response({"error": "Selected schedule intersects with existing booking"}, status=status.HTTP_400_BAD_REQUEST)
-        
         start_time = serializer.validated_data['start_time']
         end_time = serializer.validated_data['end_time']
 
-        current_date = datetime.now().date()
-
-        start_datetime = datetime.combine(current_date, start_time)
-        end_datetime = datetime.combine(current_date, end_time)
-
-        if end_datetime - start_datetime < timedelta(hours=1):
+        if end_minute_of_day(end_time) - minute_of_day(start_time) < 60:
             return Response({"error": "Selected booking gym time is not at least 1 hour"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if start_time < schedule.start_time or end_time > schedule.end_time:
-            return Response({"error": "Selected booking gym time is not within the schedule's time range. Please select time between " + schedule.start_time.__str__() + " and " + schedule.end_time.__str__()}, status=status.HTTP_400_BAD_REQUEST)
+        # occurrences beyond the horizon would be made by every request with a far date
+        if serializer.validated_data.get('date', timezone.localdate()) > self.last_occurrence_date():
+            return Response({"error": f"Sessions can be booked at most {settings.OCCURRENCE_HORIZON_DAYS} days ahead"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
             with transaction.atomic():
-                booking = Booking.objects.create(client=client, schedule=schedule, start_time=start_time, end_time=end_time)
+                # checks below and creation of booking must see the same data, so the schedule and the client are locked until commit
+                schedule = self.lock_schedule_for_booking(pk, client)
+                if schedule is None:
+                    return Response({"error": "Schedule does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+                if not self.within_schedule(schedule, start_time, end_time):
+                    return Response({"error": "Selected booking gym time is not within the schedule's time range. Please select time between " + schedule.start_time.__str__() + " and " + schedule.end_time.__str__()}, status=status.HTTP_400_BAD_REQUEST)
+
+                occurrence = None
+                if 'date' in serializer.validated_data:
+                    occurrence = self.get_occurrence(schedule, serializer.validated_data['date'])
+                    if occurrence is None:
+                        return Response({"error": "The schedule has no session on selected date"}, status=status.HTTP_400_BAD_REQUEST)
+
+                if self.booking_intersects_for_same_day(client, schedule.day_of_week, start_time, end_time, occurrence):
+                    return Response({"error": "Selected schedule intersects with existing booking"}, status=status.HTTP_400_BAD_REQUEST)
+
+                if not schedule.has_free_place(start_time, end_time, occurrence):
+                    return Response({"error": "There are no free places in the schedule at selected time"}, status=status.HTTP_400_BAD_REQUEST)
+
+                booking = Booking.objects.create(client_id=client.pk, schedule=schedule, occurrence=occurrence, start_time=start_time, end_time=end_time)
         except IntegrityError:
             return Response({"error": "Failed to create booking"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except OperationalError:
+            return self.database_busy()
         
         return Response({
             "message":"added to client schedule", 
@@ -196,27 +575,221 @@ class ScheduleViewSet(viewsets.ReadOnlyModelViewSet):
                 "start_time": schedule.start_time,
                 "end_time": schedule.end_time,
                 "week_day": schedule.day_of_week,
+                "date": occurrence.date if occurrence else None,
                 "trainer_full_name": schedule.trainer.full_name
                 }
             }, status=status.HTTP_201_CREATED)
 
+    @staticmethod
+    def last_occurrence_date():
+        return timezone.localdate() + timedelta(days=settings.OCCURRENCE_HORIZON_DAYS)
+
+    @staticmethod
+    def get_occurrence(schedule, date):
+        """ Returns occurrence of the schedule at the date, creates it if the date is not materialized yet
+
+        Returns None if the schedule has no session at the date, it has passed or is beyond OCCURRENCE_HORIZON_DAYS
+        """
+        if not timezone.localdate() <= date <= ScheduleViewSet.last_occurrence_date() or date.weekday() != schedule.weekday:
+            return None
+        occurrence, _created = ScheduleOccurrence.objects.get_or_create(schedule=schedule, date=date, defaults={
+            'trainer_id': schedule.trainer_id, 'gym_id': schedule.gym_id, 'start_time': schedule.start_time, 'end_time': schedule.end_time,
+        })
+        return occurrence
+
     
+    MAX_BATCH_BOOKINGS = 50
+
+    @action(detail=False, methods=['post'], throttle_classes=[UserBookingThrottle])
+    def add_schedules(self, request):
+        """ Method for booking several schedules at once, for example three trainings of a week. Only for clients
+
+        Takes a list of schedule, start_time and end_time. All of them are booked or none, errors are returned for
+        every slot (empty for correct ones) in the same order. The number of queries does not depend on the number of slots.
+        """
+        if not request.user.role == "client":
+            return Response({'error': 'Only clients can book a schedule'}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        slots = serializer.validated_data
+        if not slots or len(slots) > self.MAX_BATCH_BOOKINGS:
+            return Response({'error': f'From 1 to {self.MAX_BATCH_BOOKINGS} slots can be booked at once'}, status=status.HTTP_400_BAD_REQUEST)
+
+        client = request.user
+        try:
+            with transaction.atomic():
+                # like in add_this_schedule, the client and the schedules are locked until commit
+                schedules = self.lock_schedules_for_booking({slot['schedule'] for slot in slots}, client)
+
+                errors, bookings = self.batch_booking_errors(client, slots, schedules)
+                if any(errors):
+                    return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+                Booking.objects.bulk_create(bookings)
+                ScheduleHourSummary.add_bookings(bookings)
+                # bulk_create() does not send signals, but the availability index and the cache rely on them
+                for booking in bookings:
+                    post_save.send(sender=Booking, instance=booking, created=True, update_fields=None, raw=False, using=booking._state.db)
+        except IntegrityError:
+            return Response({"error": "Failed to create booking"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except OperationalError:
+            return self.database_busy()
+
+        return Response({
+            "message": "added to client schedule",
+            "client_id": client.id,
+            "bookings": [
+                {
+                    "booking_id": booking.id,
+                    "booking_details": {
+                        "schedule_id": booking.schedule.id,
+                        "start_time": booking.start_time,
+                        "end_time": booking.end_time,
+                        "week_day": booking.schedule.day_of_week,
+                        "trainer_full_name": booking.schedule.trainer.full_name
+                    }
+                }
+                for booking in bookings
+            ]
+        }, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def batch_booking_errors(client, slots, schedules):
+        """ Checks slots the same way as add_this_schedule does, but with one query for client's bookings and one for
+        bookings of the schedules. Returns errors of every slot and bookings to create
+        """
+        errors = [{} for _slot in slots]
+        bookings = {}
+        for index, slot in enumerate(slots):
+            schedule = schedules.get(slot['schedule'])
+            start_time, end_time = slot['start_time'], slot['end_time']
+            if end_minute_of_day(end_time) - minute_of_day(start_time) < 60:
+                errors[index]['error'] = "Selected booking gym time is not at least 1 hour"
+            elif schedule is None:
+                errors[index]['error'] = "Schedule does not exist"
+            elif not ScheduleViewSet.within_schedule(schedule, start_time, end_time):
+                errors[index]['error'] = "Selected booking gym time is not within the schedule's time range. Please select time between " + schedule.start_time.__str__() + " and " + schedule.end_time.__str__()
+            else:
+                booking = Booking(client_id=client.pk, schedule=schedule, start_time=start_time, end_time=end_time)
+                booking.sync_minutes(schedule)
+                bookings[index] = booking
+
+        if not bookings:
+            return errors, []
+
+        start_minute = min(booking.start_minute for booking in bookings.values())
+        end_minute = max(booking.end_minute for booking in bookings.values())
+        # (start, end, index of the slot or None for existing bookings)
+        client_booked = [
+            (start, end, None) for start, end in
+            Booking.objects.filter(client_id=client.pk, start_minute__lt=end_minute, end_minute__gt=start_minute).values_list('start_minute', 'end_minute')
+        ]
+        schedule_booked = {}
+        booked_minutes = Booking.objects.filter(schedule_id__in={booking.schedule_id for booking in bookings.values()},
+                                                start_minute__lt=end_minute, end_minute__gt=start_minute)
+        for schedule_id, start, end in booked_minutes.values_list('schedule_id', 'start_minute', 'end_minute'):
+            schedule_booked.setdefault(schedule_id, []).append((start, end))
+
+        for index, booking in list(bookings.items()):
+            start, end = booking.start_minute, booking.end_minute
+            intersecting = [other_index for booked_start, booked_end, other_index in client_booked if booked_start < end and booked_end > start]
+            if intersecting:
+                other_index = intersecting[0]
+                errors[index]['error'] = ("Selected schedule intersects with existing booking" if other_index is None
+                                          else f"Selected schedule intersects with slot {other_index} of the request")
+            elif max_overlapping((s, e) for s, e in schedule_booked.get(booking.schedule_id, ()) if s < end and e > start) >= booking.schedule.capacity:
+                errors[index]['error'] = "There are no free places in the schedule at selected time"
+            else:
+                client_booked.append((start, end, index))
+                schedule_booked.setdefault(booking.schedule_id, []).append((start, end))
+                continue
+            del bookings[index]
+
+        return errors, list(bookings.values())
+
     @staticmethod
     def schedule_intersects_for_same_day(self, user, day_of_week, start_time, end_time) -> bool:
         intersecting_schedules = Schedule.objects.filter(
-            trainer=user,
-            day_of_week=day_of_week,
-            start_time__lt=end_time,
-            end_time__gt=start_time
+            trainer_id=user.pk,
+            start_minute__lt=end_minute_of_week(day_of_week, end_time),
+            end_minute__gt=minute_of_week(day_of_week, start_time)
         )
         return intersecting_schedules.exists()
 
-class BookingViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Booking.objects.all()
+    @staticmethod
+    def within_schedule(schedule, start_time, end_time) -> bool:
+        """ Checks that booked time is in the schedule's time, a schedule and a booking may end at midnight"""
+        return minute_of_day(start_time) >= minute_of_day(schedule.start_time) and end_minute_of_day(end_time) <= end_minute_of_day(schedule.end_time)
+
+    @staticmethod
+    def database_busy() -> Response:
+        """ Response to a booking which could not take the lock, SQLite gives up after SQLITE_BUSY_TIMEOUT"""
+        return Response({"error": "Database is busy, try again later"}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
+    def lock_schedule_for_booking(self, pk, client):
+        """ Locks the client and the schedule rows (in this order, to avoid deadlocks) till the end of transaction
+
+        Returns None if schedule does not exist
+        """
+        if connection.features.has_select_for_update:
+            list(CustomUser.objects.select_for_update().filter(pk=client.pk).values_list('pk'))
+            return self.get_queryset().select_for_update(of=('self',)).select_related('trainer').filter(pk=pk).first()
+
+        # SQLite has no row locks, so an empty update takes the database write lock before the checks
+        # and concurrent bookings are done one by one
+        if not Schedule.objects.filter(pk=pk).update(capacity=F('capacity')):
+            return None
+        return self.get_queryset().select_related('trainer').filter(pk=pk).first()
+
+    def lock_schedules_for_booking(self, pks, client) -> dict:
+        """ Same as lock_schedule_for_booking() for many schedules, returns existing ones by id"""
+        queryset = Schedule.objects.select_related('trainer').filter(pk__in=pks).order_by('pk')
+        if connection.features.has_select_for_update:
+            list(CustomUser.objects.select_for_update().filter(pk=client.pk).values_list('pk'))
+            return {schedule.pk: schedule for schedule in queryset.select_for_update(of=('self',))}
+
+        Schedule.objects.filter(pk__in=pks).update(capacity=F('capacity'))
+        return {schedule.pk: schedule for schedule in queryset}
+
+    @staticmethod
+    def lock_trainer(trainer):
+        """ Locks the trainer row till the end of transaction, SQLite takes the database write lock instead"""
+        if connection.features.has_select_for_update:
+            list(CustomUser.objects.select_for_update().filter(pk=trainer.pk).values_list('pk'))
+        else:
+            CustomUser.objects.filter(pk=trainer.pk).update(role=F('role'))
+
+    @staticmethod
+    def booking_intersects_for_same_day(client, day_of_week, start_time, end_time, occurrence=None) -> bool:
+        """ Checks client's own booked times on the same week day in one query instead of loading every booking
+
+        For a booking of one occurrence dated bookings of other dates do not matter
+        """
+        intersecting_bookings = Booking.objects.filter(
+            client_id=client.pk,
+            start_minute__lt=end_minute_of_week(day_of_week, end_time),
+            end_minute__gt=minute_of_week(day_of_week, start_time)
+        )
+        if occurrence is not None:
+            intersecting_bookings = intersecting_bookings.filter(Q(occurrence__isnull=True) | Q(occurrence__date=occurrence.date))
+        return intersecting_bookings.exists()
+
+class BookingViewSet(ValuesSerializerMixin, ExpandMixin, ExportMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Booking.objects.order_by('id')
+    # trainer and gym are expanded inside of expanded schedule
+    expand_related = {'client': 'client', 'schedule': 'schedule', 'trainer': 'schedule__trainer', 'gym': 'schedule__gym'}
+    values_serializer_class = BookingValuesSerializer
+    values_actions = ('list', 'retrieve', 'get_own_bookings')
+    export_fields = ('id', 'client_id', 'schedule_id', 'occurrence_id', 'start_time', 'end_time')
+    export_filename = 'bookings'
+    pagination_class = BookingCursorPagination
     serializer_class = BookingSerializer
     permission_class = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ['client', 'schedule', 'start_time', 'end_time', 'schedule__day_of_week', 'schedule__start_time', 'schedule__end_time']
+    filterset_class = BookingFilter
     
     @action(detail=False, methods=['get'])
     def get_own_bookings(self, request):
@@ -224,7 +797,29 @@ class BookingViewSet(viewsets.ReadOnlyModelViewSet):
         if not request.user.role == "client":
             return Response({'error': 'Only clients have permissions to watch booking'}, status=status.HTTP_403_FORBIDDEN)
         
-        queryset = self.get_queryset().filter(client=request.user)
+        queryset = self.get_queryset().filter(client_id=request.user.pk)
         serializer = self.get_serializer(queryset, many=True)
 
         return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def calendar(self, request):
+        """ Method for getting client's bookings by dates from date_from to date_to. Only for clients
+
+        Weekly bookings are shown at every occurrence of their schedule, dated ones at their date
+        """
+        if not request.user.role == "client":
+            return Response({'error': 'Only clients have permissions to watch booking'}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = CalendarQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        date_range = (serializer.validated_data['date_from'], serializer.validated_data['date_to'])
+        bookings = self.get_queryset().filter(client_id=request.user.pk)
+        dated = bookings.filter(occurrence__date__range=date_range).annotate(date=F('occurrence__date'))
+        weekly = bookings.filter(occurrence__isnull=True, schedule__occurrences__date__range=date_range).annotate(date=F('schedule__occurrences__date'))
+        entries = sorted([*dated, *weekly], key=lambda booking: (booking.date, booking.start_minute, booking.pk))
+
+        data = self.get_serializer(entries, many=True).data
+        return Response([{'date': booking.date, 'booking': booking_data} for booking, booking_data in zip(entries, data)])